@@ -1,7 +1,7 @@
 // ==UserScript==
 // @name         Auto Click Script-MOD (WebSocket Client)
-// @version      2.14
-// @description  Applies price changes instantly on Apply.
+// @version      2.24
+// @description  Resubmits with the price ladder computed by the panel.
 // @author       You
 // @match        https://csp.aliexpress.com/m_apps/aechoice-product-bidding/biddingRegistration*
 // @grant        none
@@ -16,12 +16,19 @@
     let STATE = {
         checkTimer: null,
         processTimer: null,
+        fireHandler: null,
         isRunning: false,
         ws: null,
+        serverUrl: null, // Worker URL from a sharded panel's redirect; null connects to the panel itself
+        redirecting: false,
+        inbox: null, // Promise chain while compressed frames are inflated; keeps messages in order
+        knownGlobals: null, // { version, params } from the last "globals" message (protocol 2)
+        lastCommand: 0, // Highest command number handled on this connection (protocol 4)
         reconnectTimer: null,
         infoPollTimer: null,
         globalSettings: {},
-        specificSettings: {}
+        specificSettings: {},
+        hasSettings: false // Set once the panel sent settings; a reloaded page starts without them
     };
 
     // --- UI Functions ---
@@ -49,6 +56,18 @@
         console.log(`[AC-WS] Status: ${text}`);
     }
 
+    // --- Telemetry ---
+    // Streams state transitions to the panel with this tab's clock reading; the panel
+    // corrects them by the measured clock offset. `t` is taken before any send work.
+    function reportTelemetry(event, fields, t) {
+        if (!STATE.ws || STATE.ws.readyState !== WebSocket.OPEN) return;
+        try {
+            STATE.ws.send(JSON.stringify({ type: "telemetry", event, t: t || Date.now(), ...fields }));
+        } catch (e) {
+            console.error("[AC-WS] Failed to send telemetry:", e);
+        }
+    }
+
     // --- RELIABLE KEYBOARD SIMULATION (Used for decrementing) ---
     function simulateKeyInput(element, text, callback) {
         let index = 0;
@@ -167,7 +186,11 @@
             const price = prices[currentIndex];
             const formattedPrice = parseFloat(price).toFixed(2);
 
-            if (!isNaN(formattedPrice)) {
+            if (item.element.value === formattedPrice) {
+                // Already showing this price; re-typing it would only re-trigger the page's handlers
+                currentIndex++;
+                processNextInput();
+            } else if (!isNaN(formattedPrice)) {
                 console.log(`[AC-WS] Typing price ${formattedPrice} into element found by: ${item.xpath}`);
                 simulateRealisticTyping(item.element, formattedPrice, () => {
                     currentIndex++;
@@ -208,12 +231,14 @@
         STATE.isRunning = false;
         STATE.checkTimer = null;
         STATE.processTimer = null;
+        STATE.fireHandler = null;
         console.log("[AC-WS] All timers stopped.");
         updateStatus("IDLE", "blue");
     }
 
     // +++ REFACTORED: startAutoClick now handles multi-SKU price decrement +++
-    function startAutoClick() {
+    // With waitForFire the tab does not poll the clock; the panel sends "fire" at the deadline.
+    function startAutoClick(waitForFire) {
         if (STATE.isRunning) {
             console.warn("[AC-WS] Already running. Ignoring start command.");
             return;
@@ -235,58 +260,81 @@
         stopAutoClick(); // Reset previous state
         STATE.isRunning = true;
         updateStatus("ARMED", "orange");
-        console.log("[AC-WS] Start command processed. Waiting for target time.");
 
         const { targetHour, targetMinute, targetSecond, decrementValue, checkDelay, resultCheckDelay, resubmitDelay } = STATE.globalSettings;
-        const { minValues, skuPrices, autoDecrement, randomDelay } = STATE.specificSettings;
+        const { minValues, skuPrices, autoDecrement, randomDelay, ladder, slotPeriod } = STATE.specificSettings;
 
         // Initialize current prices from the settings
         let currentPrices = [...skuPrices];
+        let attempt = 0;
+        let firstClickAt = null;
+
+        // With a fire slot plan (slotPeriod), retries go out only on this tab's first click time plus
+        // whole periods, so the fleet's resubmits stay as spread as its first submissions
+        const resubmitWait = () => {
+            if (!slotPeriod || firstClickAt === null) return resubmitDelay;
+            const now = Date.now();
+            const periods = Math.ceil((now + resubmitDelay - firstClickAt) / slotPeriod);
+            return firstClickAt + periods * slotPeriod - now;
+        };
 
         const checkSubmitSuccess = () => document.querySelector('div[aria-modal="true"][aria-labelledby^="dialog-title-"]');
 
         const processSubmission = () => {
             if (!STATE.isRunning) return;
 
+            const clickedAt = Date.now();
+            if (firstClickAt === null) firstClickAt = clickedAt;
             submitButton.click();
+            reportTelemetry("click", { attempt: ++attempt, prices: currentPrices }, clickedAt);
 
             STATE.processTimer = setTimeout(() => {
                 if (!STATE.isRunning) return;
 
                 if (checkSubmitSuccess()) {
                     console.log("[AC-WS] Submission successful!");
+                    reportTelemetry("result", { outcome: "success", attempts: attempt, prices: currentPrices });
                     updateStatus("SUCCESS", "green");
                     stopAutoClick();
                 } else {
                     console.log("[AC-WS] Submission failed. Checking auto-decrement...");
                     if (autoDecrement) {
                         let stopDecrementing = false;
-                        // Decrement all prices
-                        currentPrices = currentPrices.map((price, i) => {
-                            const newPrice = Math.round((price - decrementValue) * 100) / 100;
-                            // Check against the corresponding minimum value
-                            if (newPrice < minValues[i]) {
-                                console.log(`[AC-WS] SKU ${i+1} reached minimum value (${minValues[i]}). Stopping further decrements.`);
-                                stopDecrementing = true;
-                            }
-                            return newPrice;
-                        });
+                        if (Array.isArray(ladder)) {
+                            // Panel-computed ladder (rows of cents): the next row, already checked against the minimums
+                            stopDecrementing = attempt > ladder.length;
+                            if (!stopDecrementing) currentPrices = ladder[attempt - 1].map(cents => cents / 100);
+                        } else {
+                            // Older panel: decrement all prices here
+                            currentPrices = currentPrices.map((price, i) => {
+                                const newPrice = Math.round((price - decrementValue) * 100) / 100;
+                                // Check against the corresponding minimum value
+                                if (newPrice < minValues[i]) {
+                                    console.log(`[AC-WS] SKU ${i+1} reached minimum value (${minValues[i]}). Stopping further decrements.`);
+                                    stopDecrementing = true;
+                                }
+                                return newPrice;
+                            });
+                        }
 
                         if (stopDecrementing) {
+                            reportTelemetry("result", { outcome: "min_reached", attempts: attempt, prices: currentPrices });
                             updateStatus("MIN VAL REACHED", "red");
                             stopAutoClick();
                             return;
                         }
 
                         console.log(`[AC-WS] Resubmitting with new prices:`, currentPrices);
+                        reportTelemetry("resubmit", { attempt: attempt + 1, prices: currentPrices });
                         updateStatus("RESUBMITTING", "#FFC300");
                         
                         // Apply the new prices to the page and then try submitting again
                         setSkuPrices(currentPrices, (success) => {
                             if (success) {
-                                STATE.processTimer = setTimeout(processSubmission, resubmitDelay);
+                                STATE.processTimer = setTimeout(processSubmission, resubmitWait());
                             } else {
                                 console.error("[AC-WS] Failed to apply new prices during resubmission. Stopping.");
+                                reportTelemetry("result", { outcome: "apply_fail", attempts: attempt, prices: currentPrices });
                                 updateStatus("APPLY FAIL", "red");
                                 stopAutoClick();
                             }
@@ -294,6 +342,7 @@
 
                     } else {
                         console.log("[AC-WS] Auto-decrement is disabled. Stopping.");
+                        reportTelemetry("result", { outcome: "submit_fail", attempts: attempt, prices: currentPrices });
                         updateStatus("SUBMIT FAIL", "red");
                         stopAutoClick();
                     }
@@ -301,17 +350,34 @@
             }, resultCheckDelay);
         };
 
+        if (waitForFire) {
+            STATE.fireHandler = processSubmission;
+            reportTelemetry("armed", { mode: "fire", prices: currentPrices });
+            updateStatus("ARMED (WAIT FIRE)", "orange");
+            console.log("[AC-WS] Arm command processed. Waiting for fire from panel.");
+            return;
+        }
+        console.log("[AC-WS] Start command processed. Waiting for target time.");
+        reportTelemetry("armed", { mode: "poll", prices: currentPrices });
+
+        const { targetTimestamp } = STATE.specificSettings;
+
         const checkTargetTime = () => {
             if (!STATE.isRunning) return;
             const now = new Date();
-            const targetTime = new Date(now.getFullYear(), now.getMonth(), now.getDate(), targetHour, targetMinute, targetSecond);
+            // Prefer the panel's deadline, already corrected for this tab's clock offset
+            const targetTime = targetTimestamp
+                ? new Date(targetTimestamp)
+                : new Date(now.getFullYear(), now.getMonth(), now.getDate(), targetHour, targetMinute, targetSecond);
 
             if (now >= targetTime) {
                 console.log("[AC-WS] Target time reached. Starting submission process.");
                 updateStatus("SUBMITTING", "purple");
                 processSubmission();
+                reportTelemetry("fired", { mode: "poll" }, now.getTime());
             } else {
-                STATE.checkTimer = setTimeout(checkTargetTime, checkDelay);
+                // The last wait ends on the target itself, so the tab clicks in its fire slot, not up to checkDelay later
+                STATE.checkTimer = setTimeout(checkTargetTime, Math.min(checkDelay, targetTime - now));
             }
         };
         
@@ -326,12 +392,156 @@
     }
 
     // --- WebSocket Connection ---
+    const PANEL_URL = 'ws://localhost:8765';
+
+    // Protocol 2 frames: one-character commands, "globals" by version, zlib-compressed binary frames.
+    // Protocol 3: "settings_delta" carries only changed fields and is acknowledged with "settings_ack".
+    // Protocol 4: commands carry a number "c" and are acknowledged with {type: "ack", c} once handled.
+    // Protocol 1 JSON messages are still understood, so an older panel works unchanged.
+    const PROTOCOL_VERSION = 4;
+    const COMPACT_FRAMES = { F: { type: 'fire' }, S: { type: 'stop' } };
+
+    function inflate(buffer) {
+        const stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream('deflate'));
+        return new Response(stream).text();
+    }
+
+    function resolveGlobals(message) {
+        if (message.globalParams) return message.globalParams;
+        if (STATE.knownGlobals && STATE.knownGlobals.version === message.g) return STATE.knownGlobals.params;
+        console.warn(`[AC-WS] Unknown global settings version ${message.g}; keeping the current ones.`);
+        return STATE.globalSettings;
+    }
+
+    function receiveFrame(data) {
+        // Text frames are handled synchronously unless a compressed frame ahead of them is still inflating
+        if (typeof data === 'string' && !STATE.inbox) {
+            handleFrame(data);
+            return;
+        }
+        const text = typeof data === 'string' ? data : inflate(data);
+        const pending = (STATE.inbox || Promise.resolve())
+            .then(() => text)
+            .then(handleFrame)
+            .catch(e => console.error("[AC-WS] Error inflating frame:", e))
+            .finally(() => { if (STATE.inbox === pending) STATE.inbox = null; });
+        STATE.inbox = pending;
+    }
+
+    function handleFrame(text) {
+        try {
+            handleMessage(COMPACT_FRAMES[text] || JSON.parse(text));
+        } catch (e) {
+            console.error("[AC-WS] Error processing message:", e);
+        }
+    }
+
+    function handleMessage(message) {
+        if (message.type !== 'ping') console.log("[AC-WS] Received message from panel:", message);
+
+        if (message.type === 'ping') {
+            // Time sync: echo the panel's t0 with our own clock reading, as fast as possible
+            STATE.ws.send(JSON.stringify({ type: "pong", t0: message.t0, t1: Date.now() }));
+            return;
+        }
+
+        if (message.type === 'redirect') {
+            // Sharded panel: this product is served by a worker; reconnect there right away
+            console.log(`[AC-WS] Redirected to ${message.url}`);
+            STATE.serverUrl = message.url;
+            STATE.redirecting = true;
+            STATE.ws.close();
+            return;
+        }
+
+        if (message.type === 'globals') {
+            STATE.knownGlobals = { version: message.v, params: message.globalParams };
+            return;
+        }
+
+        if (message.type === 'fire') {
+            const handler = STATE.fireHandler;
+            STATE.fireHandler = null;
+            if (handler && STATE.isRunning) {
+                const firedAt = Date.now();
+                handler();
+                reportTelemetry("fired", { mode: "fire" }, firedAt);
+                updateStatus("SUBMITTING", "purple");
+                console.log("[AC-WS] Fire received. Submission started.");
+            } else {
+                console.warn("[AC-WS] Fire received but not armed. Ignoring.");
+            }
+            return;
+        }
+
+        if (message.c !== undefined) {
+            // A resend of a command already handled (its ack was lost or late) is only acknowledged again
+            if (message.c > STATE.lastCommand) {
+                STATE.lastCommand = message.c;
+                runCommand(message);
+            }
+            STATE.ws.send(JSON.stringify({ type: "ack", c: message.c }));
+            return;
+        }
+        runCommand(message);
+    }
+
+    function runCommand(message) {
+        if (message.type !== 'stop') STATE.hasSettings = true;
+        if (message.type === 'settings_delta') {
+            STATE.globalSettings = Object.assign({}, STATE.globalSettings, message.globalParams);
+            STATE.specificSettings = Object.assign({}, STATE.specificSettings, message.specificParams);
+            const ws = STATE.ws;
+            const ack = (ok) => {
+                if (ws.readyState === WebSocket.OPEN) ws.send(JSON.stringify({ type: "settings_ack", sv: message.sv, ok }));
+            };
+            if (message.specificParams && message.specificParams.skuPrices) {
+                console.log("[AC-WS] SKU prices changed. Applying to page.");
+                setSkuPrices(STATE.specificSettings.skuPrices, ack); // Acknowledged once typed into the page
+            } else {
+                ack(true);
+            }
+            return;
+        }
+
+        if (message.type === 'apply_settings') {
+            STATE.globalSettings = resolveGlobals(message);
+            STATE.specificSettings = message.specificParams;
+            console.log("[AC-WS] Settings stored. Applying SKU prices to page immediately.");
+            setSkuPrices(STATE.specificSettings.skuPrices);
+
+        } else if (message.type === 'start') {
+            console.log("[AC-WS] Received start command with full settings.");
+            // Store all settings from the start message
+            STATE.globalSettings = resolveGlobals(message);
+            STATE.specificSettings = message.specificParams;
+            console.log("[AC-WS] Settings updated from start command.");
+            
+            // The `startAutoClick` function will now use these fresh settings
+            startAutoClick();
+
+        } else if (message.type === 'arm') {
+            console.log("[AC-WS] Received arm command with full settings.");
+            STATE.globalSettings = resolveGlobals(message);
+            STATE.specificSettings = message.specificParams;
+            startAutoClick(true);
+
+        } else if (message.type === 'stop') {
+            console.log("[AC-WS] Received stop command.");
+            stopAutoClick();
+        }
+    }
+
     function connectWebSocket(productInfo) {
         if (STATE.ws && (STATE.ws.readyState === WebSocket.OPEN || STATE.ws.readyState === WebSocket.CONNECTING)) {
             return;
         }
         
-        STATE.ws = new WebSocket('ws://localhost:8765');
+        STATE.ws = new WebSocket(STATE.serverUrl || PANEL_URL);
+        STATE.ws.binaryType = 'arraybuffer';
+        STATE.inbox = null;
+        STATE.knownGlobals = null; // The panel re-sends globals on every new connection
+        STATE.lastCommand = 0; // Command numbers are per connection
         updateStatus("CONNECTING", "gray");
 
         STATE.ws.onopen = () => {
@@ -339,42 +549,25 @@
             STATE.ws.send(JSON.stringify({
                 type: "register",
                 productId: productInfo.productId,
-                imageUrl: productInfo.imageUrl
+                imageUrl: productInfo.imageUrl,
+                protocol: PROTOCOL_VERSION,
+                // On a reconnect the panel re-sends settings only if this tab lost them, and never while it is running
+                hasSettings: STATE.hasSettings,
+                running: STATE.isRunning
             }));
             updateStatus("REGISTERED", "blue");
         };
 
-        STATE.ws.onmessage = (event) => {
-            try {
-                const message = JSON.parse(event.data);
-                console.log("[AC-WS] Received message from panel:", message);
-
-                if (message.type === 'apply_settings') {
-                    STATE.globalSettings = message.globalParams;
-                    STATE.specificSettings = message.specificParams;
-                    console.log("[AC-WS] Settings stored. Applying SKU prices to page immediately.");
-                    setSkuPrices(STATE.specificSettings.skuPrices);
-
-                } else if (message.type === 'start') {
-                    console.log("[AC-WS] Received start command with full settings.");
-                    // Store all settings from the start message
-                    STATE.globalSettings = message.globalParams;
-                    STATE.specificSettings = message.specificParams;
-                    console.log("[AC-WS] Settings updated from start command.");
-                    
-                    // The `startAutoClick` function will now use these fresh settings
-                    startAutoClick();
-
-                } else if (message.type === 'stop') {
-                    console.log("[AC-WS] Received stop command.");
-                    stopAutoClick();
-                }
-            } catch (e) {
-                console.error("[AC-WS] Error processing message:", e);
-            }
-        };
+        STATE.ws.onmessage = (event) => receiveFrame(event.data);
 
         STATE.ws.onclose = () => {
+            clearTimeout(STATE.reconnectTimer);
+            if (STATE.redirecting) {
+                STATE.redirecting = false;
+                connectWebSocket(productInfo);
+                return;
+            }
+            STATE.serverUrl = null; // Go back through the panel, which may route to a different worker
             updateStatus("DISCONNECTED", "red");
             console.log("[AC-WS] WebSocket closed. Attempting to reconnect in 5 seconds...");
             clearTimeout(STATE.reconnectTimer);
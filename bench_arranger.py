@@ -0,0 +1,149 @@
+# bench_arranger.py
+#
+# Benchmarks browser_grid_arranger's URL launch pipeline and grid layout against the
+# simulated window backend (window_backends.FakeBackend), so it runs on any OS:
+#
+#   python bench_arranger.py --urls 36 --concurrency 1 4 8 0 --urls-per-window 1 4 --output bench_arranger.json
+#
+# "legacy" replays the old open_urls_from_file loop (one Popen per URL, then a full
+# window poll every 0.5 s) and the old arrange_windows loop (per-window restore,
+# move/resize and sleeps). Results are JSON, one object per configuration.
+
+import argparse
+import json
+import platform
+import time
+from datetime import datetime
+
+from browser_grid_arranger import LaunchPipeline
+from panel_engine import percentiles
+from window_backends import FakeBackend, is_browser_title
+from window_layout import compute_layout, verify_layout
+
+TWO_MONITORS = [{"work": (0, 0, 1920, 1040), "primary": True}, {"work": (1920, 0, 2560, 1400), "primary": False}]
+
+
+def fake_backend(args):
+    return FakeBackend(base_delay=args.base_delay, jitter=args.jitter, seed=args.seed, existing=args.existing)
+
+
+def run_legacy(backend, urls, timeout=30.0, poll_interval=0.5):
+    started = time.perf_counter()
+    before = {hwnd for hwnd, title in backend.list_windows().items() if is_browser_title(title)}
+    for url in urls:
+        backend.launch(["chrome", url, "--new-window"])
+    new = set()
+    while time.perf_counter() - started < timeout:
+        new = {hwnd for hwnd, title in backend.list_windows().items() if is_browser_title(title)} - before
+        if len(new) >= len(urls):
+            break
+        time.sleep(poll_interval)
+    return {"mode": "legacy", "windows": len(new), "mapped": 0, "launches": backend.launches,
+            "elapsed_s": time.perf_counter() - started}
+
+
+def run_pipeline(backend, urls, concurrency, urls_per_window, timeout=30.0):
+    pipeline = LaunchPipeline(backend, "chrome", concurrency=concurrency, urls_per_window=urls_per_window, timeout=timeout)
+    result = pipeline.run(urls)
+    mapped_correctly = sum(1 for hwnd, batch in result["windows"].items() if backend.tabs.get(hwnd) == batch)
+    return {
+        "mode": "pipeline",
+        "concurrency": concurrency,
+        "urls_per_window": urls_per_window,
+        "windows": len(result["windows"]),
+        "mapped": mapped_correctly,
+        "missing": len(result["missing"]),
+        "launches": backend.launches,
+        "elapsed_s": result["elapsed_s"],
+        "window_s": percentiles(result["window_s"]),
+    }
+
+
+def layout_backend(windows, minimized_every):
+    backend = FakeBackend(existing=windows, monitors=TWO_MONITORS, min_size=(500, 0))
+    hwnds = sorted(backend.list_windows())
+    for hwnd in hwnds[::minimized_every]:
+        backend.minimize(hwnd)
+    return backend, hwnds
+
+
+def run_legacy_layout(windows, minimized_every):
+    """The old loop: primary monitor only, one window at a time with its sleeps."""
+    backend, hwnds = layout_backend(windows, minimized_every)
+    started = time.perf_counter()
+    rects = compute_layout(len(hwnds), backend.monitors(), "primary")
+    for hwnd, rect in zip(hwnds, rects):
+        if backend.is_minimized(hwnd):
+            time.sleep(0.2)
+        backend.apply_layout([(hwnd, rect)])
+        time.sleep(0.1)
+    return {"mode": "legacy_layout", "windows": windows, "elapsed_s": time.perf_counter() - started}
+
+
+def run_layout(windows, minimized_every):
+    backend, hwnds = layout_backend(windows, minimized_every)
+    started = time.perf_counter()
+    rects = compute_layout(len(hwnds), backend.monitors(), "all")
+    computed = time.perf_counter()
+    placements = list(zip(hwnds, rects))
+    errors = backend.apply_layout(placements)
+    applied = time.perf_counter()
+    verified = verify_layout(backend, placements, timeout=0)
+    return {
+        "mode": "layout",
+        "windows": windows,
+        "compute_ms": (computed - started) * 1000,
+        "apply_ms": (applied - computed) * 1000,
+        "elapsed_s": applied - started, # Blocking part; verification runs in the background in the GUI
+        "verify_ms": (time.perf_counter() - applied) * 1000,
+        "failed": len(errors),
+        "mismatched": len(verified["mismatched"]), # Cells narrower than the simulated 500px minimum width
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the arranger's URL launch pipeline on a simulated backend")
+    parser.add_argument("--urls", type=int, default=36)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 0], help="0: no limit")
+    parser.add_argument("--urls-per-window", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--base-delay", type=float, default=0.4, help="Simulated seconds before a launched window appears")
+    parser.add_argument("--jitter", type=float, default=0.6)
+    parser.add_argument("--existing", type=int, default=5, help="Browser windows already open")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--layout-windows", type=int, nargs="+", default=[36, 100])
+    parser.add_argument("--minimized-every", type=int, default=4, help="Every Nth window starts minimized")
+    parser.add_argument("--skip-legacy", action="store_true")
+    parser.add_argument("--output", help="Write results JSON here instead of stdout")
+    args = parser.parse_args()
+
+    urls = [f"https://example.invalid/item/{i}" for i in range(args.urls)]
+    results = []
+    if not args.skip_legacy:
+        results.append(run_legacy(fake_backend(args), urls))
+    for urls_per_window in args.urls_per_window:
+        for concurrency in args.concurrency:
+            results.append(run_pipeline(fake_backend(args), urls, concurrency, urls_per_window))
+    for windows in args.layout_windows:
+        if not args.skip_legacy:
+            results.append(run_legacy_layout(windows, args.minimized_every))
+        results.append(run_layout(windows, args.minimized_every))
+
+    output = {
+        "benchmark": "arranger",
+        "format": 1,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "urls": args.urls,
+        "results": results,
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+# bench_load.py
+#
+# Load-test harness: runs a PanelEngine on localhost and N simulated userscript
+# clients speaking the same protocol as "Auto Click Script-MOD (WebSocket Client).js"
+# (register / redirect / ping-pong / globals / apply_settings / start / arm / fire / stop / telemetry),
+# in wire protocol 1 or 2.
+#
+#   python bench_load.py --clients 100 500 1000 --output bench_results.json
+#   python bench_load.py --clients 1000 --shards 0 4    # single-process vs 4 worker processes
+#
+# Each client count runs in a fresh subprocess so CPU and memory figures are not
+# shared between runs. Results are JSON, one object per client count.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import zlib
+from datetime import datetime
+
+import websockets
+
+from panel_engine import PanelEngine, now_ms, percentiles
+
+try:
+    import resource # Unix only
+except ImportError:
+    resource = None
+
+
+def spread(values):
+    return max(values) - min(values) if values else None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb():
+    """Current resident set size. Falls back to peak RSS where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+    return None
+
+
+def raise_fd_limit():
+    if resource:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+
+
+# --- Simulated userscript ---
+COMPACT_FRAMES = {"F": {"type": "fire"}, "S": {"type": "stop"}} # Protocol 2 and later, as in the userscript
+
+
+class SimClient:
+    def __init__(self, product_id, url, protocol=4):
+        self.product_id = product_id
+        self.url = url
+        self.protocol = protocol # Offered at register; 1 behaves like userscripts before 2.19, 2 like 2.19, 3 like 2.20
+        self.bytes_received = 0
+        self.known_globals = None
+        self.ws = None
+        self.reconnect_delay = 5.0 # Same back-off as the userscript
+        self.stopping = False
+        self.register_sent = None
+        self.received = {} # Maps message type to perf_counter of the latest receipt
+        self.received_ms = {} # Same, as panel-clock epoch ms
+        self.settings = None
+        self.redirect_url = None # Worker URL from a sharded panel's redirect
+
+    async def run(self):
+        while not self.stopping:
+            redirected = self.redirect_url
+            try:
+                async with websockets.connect(self.redirect_url or self.url, max_queue=None) as ws:
+                    self.ws = ws
+                    self.register_sent = time.perf_counter()
+                    register = {"type": "register", "productId": self.product_id,
+                                "imageUrl": f"https://example.invalid/{self.product_id}.jpg"}
+                    if self.protocol > 1:
+                        register["protocol"] = self.protocol
+                    self.known_globals = None
+                    await ws.send(json.dumps(register))
+                    async for raw in ws:
+                        message = self.decode(raw)
+                        await self.handle(message)
+                        if "c" in message:
+                            await ws.send(json.dumps({"type": "ack", "c": message["c"]}))
+            except (OSError, websockets.exceptions.WebSocketException):
+                pass
+            self.ws = None
+            if self.redirect_url and self.redirect_url != redirected:
+                continue # Same as the userscript: follow a redirect at once
+            self.redirect_url = None
+            if not self.stopping:
+                await asyncio.sleep(self.reconnect_delay)
+
+    def decode(self, raw):
+        self.bytes_received += len(raw)
+        if isinstance(raw, bytes):
+            raw = zlib.decompress(raw).decode("utf-8")
+        return COMPACT_FRAMES.get(raw) or json.loads(raw)
+
+    async def handle(self, message):
+        msg_type = message.get("type")
+        self.received[msg_type] = time.perf_counter()
+        self.received_ms[msg_type] = now_ms()
+        if msg_type == "redirect":
+            self.redirect_url = message["url"]
+            await self.ws.close()
+        elif msg_type == "ping":
+            await self.ws.send(json.dumps({"type": "pong", "t0": message["t0"], "t1": time.time() * 1000}))
+        elif msg_type == "settings_delta":
+            self.settings = message
+            await self.ws.send(json.dumps({"type": "settings_ack", "sv": message["sv"], "ok": True}))
+        elif msg_type == "globals":
+            self.known_globals = (message["v"], message["globalParams"])
+        elif msg_type in ("apply_settings", "start", "arm"):
+            if "globalParams" not in message:
+                assert self.known_globals and self.known_globals[0] == message["g"], "command references unknown globals"
+            self.settings = message
+            if msg_type == "arm":
+                await self.telemetry("armed", mode="fire")
+        elif msg_type == "fire":
+            # Same sequence as the userscript: click first, then report; the page "accepts" immediately
+            fired_at = time.time() * 1000
+            await self.telemetry("click", fired_at, attempt=1)
+            await self.telemetry("fired", fired_at, mode="fire")
+            await self.telemetry("result", outcome="success", attempts=1)
+
+    async def telemetry(self, event, t=None, **fields):
+        await self.ws.send(json.dumps({"type": "telemetry", "event": event, "t": t or time.time() * 1000, **fields}))
+
+    async def drop(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+
+# --- Benchmark run ---
+class LoadBenchmark:
+    def __init__(self, n_clients, timeout, shards=0, protocol=4, submit_rate=0.0):
+        self.n_clients = n_clients
+        self.timeout = timeout
+        self.shards = shards
+        self.protocol = protocol
+        self.engine = PanelEngine(port=free_port(), shards=shards)
+        self.engine.max_submits_per_second = submit_rate
+        self.registered_at = {} # Maps product_id to perf_counter of the engine's latest client_registered event
+        self.registrations = 0
+        self.listening = None
+        self.engine.subscribe(self.on_event)
+
+    def on_event(self, event, data):
+        # Runs on the engine thread; perf_counter is process-wide so timings are comparable
+        if event in ("client_registered", "client_resumed"):
+            self.registered_at[data["product_id"]] = time.perf_counter()
+            self.registrations += 1
+        elif event == "listening":
+            self.listening = time.perf_counter()
+
+    async def wait_until(self, condition, timeout=None):
+        deadline = time.perf_counter() + (timeout or self.timeout)
+        while not condition():
+            if time.perf_counter() > deadline:
+                return False
+            await asyncio.sleep(0.005)
+        return True
+
+    async def server_cpu(self):
+        """CPU seconds consumed so far by the engine's server thread (the coordinator's, when sharded)."""
+        async def read():
+            return time.thread_time()
+        return await asyncio.wrap_future(self.engine.submit(read()))
+
+    async def run(self):
+        self.engine.start_thread()
+        await self.wait_until(lambda: self.listening is not None)
+        rss_idle = rss_mb()
+        cpu_start = await self.server_cpu()
+        result = {"clients": self.n_clients, "shards": self.shards, "protocol": self.protocol,
+                  "submit_rate": self.engine.max_submits_per_second}
+
+        # Registration: register sent -> engine client_registered (the point the GUI builds the card)
+        clients = [SimClient(f"sim{i:05d}", self.engine.url, self.protocol) for i in range(self.n_clients)]
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(client.run()) for client in clients]
+        complete = await self.wait_until(lambda: len(self.registered_at) >= self.n_clients)
+        result["registration"] = {
+            "complete": complete,
+            "registered": len(self.registered_at),
+            "all_registered_s": time.perf_counter() - started,
+            "latency_ms": percentiles([(self.registered_at[c.product_id] - c.register_sent) * 1000
+                                       for c in clients if c.product_id in self.registered_at]),
+        }
+        await asyncio.sleep(1.0) # Let the time-sync bursts settle
+        result["rss_mb_connected"] = rss_mb()
+        result["rss_mb_idle"] = rss_idle
+
+        # Apply: first to every tab, then after editing a single product (only that tab is out of date)
+        result["apply_all"] = await self.measure_apply()
+        self.engine.set_product_params(clients[0].product_id, {"skuPrices": [1.0]})
+        result["apply_one_edit"] = await self.measure_apply()
+
+        # Start fan-out (polling "start" command)
+        self.engine.server_fire = False
+        result["start_fanout"] = await self.measure_fanout(clients, "start", self.engine.start_all)
+
+        # Server-pushed fire at a whole-second deadline, like the GUI's H:M:S target; each client in its fire slot
+        self.engine.server_fire = True
+        target = datetime.fromtimestamp(time.time() + 2)
+        self.engine.set_global_params({"targetHour": target.hour, "targetMinute": target.minute, "targetSecond": target.second})
+        slots = {slot["productId"]: slot["slot_ms"] for slot in await self.fire_plan()}
+        span_s = (max(slots.values()) - min(slots.values())) / 1000 if slots else 0.0
+        for client in clients:
+            client.received.pop("fire", None)
+        cpu_before = await self.server_cpu()
+        await asyncio.wrap_future(self.engine.submit(self.engine.start_all()))
+        complete = await self.wait_until(lambda: all("fire" in c.received for c in clients), timeout=self.timeout + 3 + span_s)
+        fired = {c.product_id: c.received_ms["fire"] for c in clients if "fire" in c.received}
+        result["fire"] = {
+            "complete": complete,
+            "received": len(fired),
+            "client_skew_ms": spread(list(fired.values())), # The slot span plus fan-out skew when rate-limited
+            "slot_span_ms": span_s * 1000,
+            "lateness_ms": percentiles([t - slots[product_id] for product_id, t in fired.items()]),
+            "server_cpu_s": await self.server_cpu() - cpu_before,
+        }
+        await self.wait_until(lambda: self.engine.server.telemetry.stats()["outcomes"].get("success", 0) >= len(fired), timeout=5)
+        result["telemetry"] = self.engine.server.telemetry.stats()
+        await asyncio.wrap_future(self.engine.submit(self.engine.stop_all()))
+
+        # Reconnect storm: every client drops at once and reconnects immediately (resumes its session)
+        registrations_before = self.registrations
+        for client in clients:
+            client.reconnect_delay = 0
+        cpu_before = await self.server_cpu()
+        started = time.perf_counter()
+        await asyncio.gather(*(client.drop() for client in clients))
+        complete = await self.wait_until(lambda: self.registrations - registrations_before >= self.n_clients
+                                         and self.engine.client_count() >= self.n_clients)
+        result["reconnect_storm"] = {
+            "complete": complete,
+            "re_registered": self.registrations - registrations_before,
+            "connected": self.engine.client_count(),
+            "recovery_s": time.perf_counter() - started,
+            "server_cpu_s": await self.server_cpu() - cpu_before,
+        }
+
+        result["server_cpu_s"] = await self.server_cpu() - cpu_start
+        result["rss_mb_peak"] = rss_mb()
+        for client in clients:
+            client.stopping = True
+        await asyncio.gather(*(client.drop() for client in clients))
+        for task in tasks:
+            task.cancel()
+        return result
+
+    async def fire_plan(self):
+        """The fire slots start_all will use, read on the server loop."""
+        async def plan():
+            return self.engine.plan_fire_slots()
+        return await asyncio.wrap_future(self.engine.submit(plan()))
+
+    async def measure_apply(self):
+        """Apply until every tab it sent to has acknowledged (protocol 3) or was sent its settings (older protocols)."""
+        cpu_before = await self.server_cpu()
+        started = time.perf_counter()
+        report = await asyncio.wrap_future(self.engine.submit(self.engine.apply_all()))
+        complete = await self.wait_until(lambda: all(self.engine.settings_status(pid) == "synced" for pid in report["sent"]))
+        return {
+            "complete": complete,
+            "sent": len(report["sent"]),
+            "up_to_date": report["up_to_date"],
+            "synced_ms": (time.perf_counter() - started) * 1000,
+            "server_cpu_s": await self.server_cpu() - cpu_before,
+        }
+
+    async def measure_fanout(self, clients, msg_type, command):
+        for client in clients:
+            client.received.pop(msg_type, None)
+        bytes_before = sum(client.bytes_received for client in clients)
+        cpu_before = await self.server_cpu()
+        submitted = time.perf_counter()
+        report = await asyncio.wrap_future(self.engine.submit(command()))
+        complete = await self.wait_until(lambda: all(msg_type in c.received for c in clients))
+        receipts = [c.received[msg_type] for c in clients if msg_type in c.received]
+        return {
+            "complete": complete,
+            "received": len(receipts),
+            "client_skew_ms": spread(receipts) * 1000 if receipts else None,
+            "first_receive_ms": (min(receipts) - submitted) * 1000 if receipts else None,
+            "last_receive_ms": (max(receipts) - submitted) * 1000 if receipts else None,
+            "server_skew_ms": report["skew_ms"],
+            "bytes_per_client": (sum(c.bytes_received for c in clients) - bytes_before) / max(1, len(clients)),
+            "send_ms": percentiles(list(report["sent"].values())),
+            "acked": len(report["delivered"]) + len(report["late"]),
+            "late": len(report["late"]),
+            "failed": len(report["failed"]),
+            "ack_ms": percentiles(list(report["delivered"].values()) + list(report["late"].values())),
+            "server_cpu_s": await self.server_cpu() - cpu_before,
+        }
+
+
+def run_one(n_clients, timeout, shards, protocol, submit_rate):
+    raise_fd_limit()
+    logging.basicConfig(level=logging.ERROR)
+    return asyncio.run(LoadBenchmark(n_clients, timeout, shards, protocol, submit_rate).run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the panel engine with simulated userscript clients")
+    parser.add_argument("--clients", type=int, nargs="+", default=[100, 500, 1000])
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for each phase")
+    parser.add_argument("--shards", type=int, nargs="+", default=[0], help="Worker processes (0: single-process server)")
+    parser.add_argument("--protocol", type=int, nargs="+", default=[4], help="Wire protocol the clients offer")
+    parser.add_argument("--submit-rate", type=float, default=0.0,
+                        help="Fire slot rate for the fire phase (max_submits_per_second; 0: every client at the deadline)")
+    parser.add_argument("--output", help="Write results JSON here instead of stdout")
+    parser.add_argument("--run-one", type=int, help=argparse.SUPPRESS) # Internal: one client count, result on stdout
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, args.timeout, args.shards[0], args.protocol[0], args.submit_rate)))
+        return
+
+    results = []
+    for protocol in args.protocol:
+        for shards in args.shards:
+            for n_clients in args.clients:
+                print(f"Running {n_clients} clients, {shards} shards, protocol {protocol}...", file=sys.stderr)
+                proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-one", str(n_clients),
+                                       "--timeout", str(args.timeout), "--shards", str(shards), "--protocol", str(protocol),
+                                       "--submit-rate", str(args.submit_rate)],
+                                      capture_output=True, text=True)
+                if proc.returncode != 0:
+                    results.append({"clients": n_clients, "shards": shards, "protocol": protocol,
+                                    "error": proc.stderr.strip().splitlines()[-1:]})
+                else:
+                    results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    output = {
+        "benchmark": "load",
+        "format": 1,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
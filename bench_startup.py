@@ -0,0 +1,140 @@
+# bench_startup.py
+#
+# Startup benchmark: launches the control panel (or the headless engine) N times
+# and measures, from process start,
+#   accept_s     - the WebSocket port accepts TCP connections
+#   handshake_s  - a WebSocket handshake completes (the server loop is serving)
+#   bound_s / listening_s / window_s - milestones the panel prints when
+#                  PANEL_STARTUP_TRACE is set (window_s is the main window's first map)
+#
+#   python bench_startup.py --runs 10 --mode gui headless --output bench_startup.json
+#
+# Without a display the GUI process exits early; its runs report the error and the
+# port timings measured until then. Results are JSON, one object per mode.
+
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import websockets.sync.client
+
+from bench_load import free_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ("accept_s", "handshake_s", "bound_s", "listening_s", "window_s")
+
+
+def command(mode, port):
+    if mode == "gui":
+        return [sys.executable, os.path.join(HERE, "control_panel.py"), "--port", str(port)]
+    return [sys.executable, os.path.join(HERE, "panel_engine.py"), "--port", str(port), "--control-port", str(free_port())]
+
+
+def wait_for_accept(port, deadline, interval=0.002):
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("localhost", port), timeout=0.5):
+                return time.time()
+        except OSError:
+            time.sleep(interval)
+    return None
+
+
+def wait_for_handshake(port, deadline, interval=0.002):
+    while time.time() < deadline:
+        try:
+            with websockets.sync.client.connect(f"ws://localhost:{port}", open_timeout=max(0.1, deadline - time.time())):
+                return time.time()
+        except (OSError, TimeoutError, websockets.exceptions.WebSocketException):
+            time.sleep(interval)
+    return None
+
+
+def run_once(mode, timeout):
+    port = free_port()
+    env = dict(os.environ, PANEL_STARTUP_TRACE="1")
+    with tempfile.TemporaryDirectory() as workdir: # Keeps log files out of the repo
+        started = time.time()
+        proc = subprocess.Popen(command(mode, port), cwd=workdir, env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, text=True)
+        deadline = started + timeout
+        stages = {}
+
+        def read_trace():
+            for line in proc.stdout:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(entry, dict) and "startup" in entry:
+                    stages[f"{entry['startup']}_s"] = entry["t"] - started
+        reader = threading.Thread(target=read_trace, daemon=True)
+        reader.start()
+
+        accepted = wait_for_accept(port, deadline)
+        handshake = wait_for_handshake(port, deadline) if accepted else None
+        while mode == "gui" and "window_s" not in stages and proc.poll() is None and time.time() < deadline:
+            time.sleep(0.005)
+        exited = proc.poll()
+        proc.kill()
+        _, stderr = proc.communicate()
+        reader.join(timeout=1)
+
+    result = {"accept_s": accepted - started if accepted else None,
+              "handshake_s": handshake - started if handshake else None}
+    result.update(stages)
+    if exited is not None:
+        result["error"] = (stderr.strip().splitlines() or [f"exited with {exited}"])[-1]
+    return result
+
+
+def summarize(mode, runs):
+    summary = {"mode": mode, "runs": len(runs), "errors": sorted({run["error"] for run in runs if "error" in run})}
+    for stage in STAGES:
+        values = [run[stage] for run in runs if run.get(stage) is not None]
+        if values:
+            summary[stage] = {"median": statistics.median(values), "min": min(values), "max": max(values)}
+    summary["samples"] = runs
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure time-to-window and time-to-listening of the control panel")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mode", nargs="+", choices=["gui", "headless"], default=["gui", "headless"])
+    parser.add_argument("--timeout", type=float, default=15.0, help="Seconds to wait for each run")
+    parser.add_argument("--output", help="Write results JSON here instead of stdout")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.mode:
+        print(f"Starting {mode} x{args.runs}...", file=sys.stderr)
+        results.append(summarize(mode, [run_once(mode, args.timeout) for _ in range(args.runs)]))
+
+    output = {
+        "benchmark": "startup",
+        "format": 1,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
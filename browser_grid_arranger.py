@@ -1,25 +1,34 @@
 # browser_grid_arranger.py
+#
+# Opens the listing URLs and arranges browser windows in a grid. GridArranger is the
+# headless service (open / refresh / arrange / close) that the control panel imports
+# and keeps alive; BrowserGridArrangerApp is its Tk front end, in its own root window
+# when run as a script or in a Toplevel inside the panel.
 
 import tkinter as tk
-import pygetwindow as gw
-import math
-import win32api, win32con, win32gui
 import os
-import subprocess
 import time
 import logging
+import threading
+import argparse
+from collections import OrderedDict
+from window_backends import default_backend, is_browser_title
+from window_layout import compute_layout, verify_layout
+
+log = logging.getLogger("arranger")
 
 def setup_logging():
+    """Standalone runs only; when imported, records go to the host's logging setup."""
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s',
         filename='log.txt',
         filemode='a'
     )
-    logging.info("--- Application Started ---")
+    log.info("--- Application Started ---")
 
 def find_chrome_executable():
-    logging.info("Attempting to find Chrome executable.")
+    log.info("Attempting to find Chrome executable.")
     """查找 Google Chrome 可执行文件的绝对路径。"""
     possible_paths = [
         r"C:\Users\Administrator\AppData\Local\Google\Chrome\Bin\chrome.exe",
@@ -29,23 +38,213 @@ def find_chrome_executable():
     ]
     for path in possible_paths:
         if os.path.exists(path):
-            logging.info(f"Found Chrome executable at: {path}")
+            log.info(f"Found Chrome executable at: {path}")
             return path
-    logging.warning("Chrome executable not found.")
+    log.warning("Chrome executable not found.")
     return None
 
+def read_url_file(path):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+# --- Launch Pipeline ---
+class LaunchPipeline:
+    """
+    Opens URLs in browser windows and maps each new window back to its URLs.
+    URLs are grouped urls_per_window to a browser invocation (one window, several tabs),
+    and at most `concurrency` launched windows are waited for at a time (0: no limit). Detection is
+    driven by the backend's window-change notifications, so each window is matched as
+    soon as it appears. Launches carry a --window-name marker; a new window whose title
+    does not show a marker is given to the oldest launch still waiting for one.
+    """
+
+    def __init__(self, backend, browser_path, concurrency=4, urls_per_window=1, timeout=30.0, marker_prefix="AC-"):
+        self.backend = backend
+        self.browser_path = browser_path
+        self.concurrency = concurrency if concurrency > 0 else float("inf")
+        self.urls_per_window = max(1, urls_per_window)
+        self.timeout = timeout
+        self.marker_prefix = marker_prefix
+
+    def batches(self, urls):
+        return [urls[i:i + self.urls_per_window] for i in range(0, len(urls), self.urls_per_window)]
+
+    def run(self, urls, on_window=None):
+        """
+        Blocks until every batch has a window or the timeout passes. on_window(hwnd, urls, seconds)
+        is called as each window is matched. Returns {"windows": {hwnd: urls}, "missing": [urls, ...],
+        "elapsed_s", "window_s": [seconds per window]}.
+        """
+        batches = self.batches(urls)
+        started = time.perf_counter()
+        generation = self.backend.generation
+        known = set(self.backend.list_windows()) # Windows that existed before (or are already matched)
+        pending = list(range(len(batches)))
+        pending.reverse() # pop() launches in order
+        in_flight = OrderedDict() # Maps batch index to launch time, oldest first
+        markers = {}
+        windows, window_s = {}, []
+
+        while pending or in_flight:
+            while pending and len(in_flight) < self.concurrency:
+                index = pending.pop()
+                markers[index] = f"{self.marker_prefix}{index + 1}"
+                args = [self.browser_path, "--new-window", f"--window-name={markers[index]}", *batches[index]]
+                try:
+                    self.backend.launch(args)
+                    in_flight[index] = time.perf_counter()
+                except Exception as e:
+                    log.error(f"打开 URL 时出错 ({batches[index]}): {e}")
+
+            remaining = self.timeout - (time.perf_counter() - started)
+            if remaining <= 0:
+                break
+            if not in_flight:
+                continue
+            generation = self.backend.wait_for_change(generation, remaining)
+
+            for hwnd, title in self.backend.list_windows().items():
+                if hwnd in known or not in_flight:
+                    continue
+                known.add(hwnd)
+                if not is_browser_title(title) and not title.startswith(self.marker_prefix):
+                    continue
+                index = next((i for i in in_flight if title.startswith(markers[i] + " ") or title == markers[i]), None)
+                if index is None:
+                    index = next(iter(in_flight)) # No marker in the title: oldest launch first
+                seconds = time.perf_counter() - in_flight.pop(index)
+                windows[hwnd] = batches[index]
+                window_s.append(seconds)
+                log.info(f"Window {hwnd} ('{title}') opened for {batches[index]} after {seconds:.2f}s")
+                if on_window:
+                    on_window(hwnd, batches[index], seconds)
+
+        matched = set(map(tuple, windows.values()))
+        missing = [batch for batch in batches if tuple(batch) not in matched]
+        return {"windows": windows, "missing": missing, "elapsed_s": time.perf_counter() - started, "window_s": window_s}
+
+# --- Service ---
+class ArrangerError(Exception):
+    """A problem to show the operator as-is (no browser, no URL file, nothing selected...)."""
+
+
+class GridArranger:
+    """
+    The arranger as an in-process service. Owns the window backend and remembers which
+    windows it opened. open() and close() block until the windows appear or go away,
+    so GUIs call them from a worker thread; everything else returns immediately.
+    """
+
+    def __init__(self, backend=None, concurrency=8, urls_per_window=1, url_file=None, browser_path=None):
+        self.backend = backend or default_backend()
+        self.concurrency = concurrency
+        self.urls_per_window = urls_per_window
+        self.url_file = url_file or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'itemurl.txt')
+        self.browser_path = browser_path # Looked up on first open when not given
+        self.opened = {} # Maps hwnd of each window opened here to its URLs
+        self.monitors = self.backend.monitors() # Re-read by refresh_monitors() and before every arrange
+
+    def refresh_monitors(self):
+        """Re-reads the displays' work areas, since displays can be added, removed or resized at any time."""
+        self.monitors = self.backend.monitors()
+        return self.monitors
+
+    def load_urls(self):
+        log.info(f"Looking for URL file at: {self.url_file}")
+        if not os.path.exists(self.url_file):
+            raise ArrangerError(f"错误：URL 文件未找到，路径：{self.url_file}")
+        urls = read_url_file(self.url_file)
+        log.info(f"Found {len(urls)} URLs in {os.path.basename(self.url_file)}.")
+        if not urls:
+            raise ArrangerError(f"信息：{os.path.basename(self.url_file)} 文件为空，没有要打开的 URL。")
+        return urls
+
+    def open(self, urls=None, on_window=None):
+        """Opens `urls` (default: the URL file) and waits for their windows. Returns the LaunchPipeline result."""
+        if self.browser_path is None:
+            self.browser_path = find_chrome_executable()
+        if not self.browser_path:
+            raise ArrangerError("错误：未找到 Google Chrome 浏览器。请检查安装路径。")
+        urls = urls or self.load_urls()
+        log.info(f"正在打开 {len(urls)} 个网址...")
+        pipeline = LaunchPipeline(self.backend, self.browser_path, concurrency=self.concurrency,
+                                  urls_per_window=self.urls_per_window)
+
+        def matched(hwnd, batch, seconds):
+            self.opened[hwnd] = batch
+            if on_window:
+                on_window(hwnd, batch, seconds)
+        result = pipeline.run(urls, matched)
+        if result["missing"]:
+            log.warning(f"No window detected for: {result['missing']}")
+        log.info(f"已识别 {len(result['windows'])} 个新窗口, 用时 {result['elapsed_s']:.1f} 秒。")
+        return result
+
+    def refresh(self):
+        """Browser windows, plus any window opened here, as {hwnd: title}."""
+        return {hwnd: title for hwnd, title in self.backend.list_windows().items()
+                if is_browser_title(title) or hwnd in self.opened}
+
+    def close(self, hwnds=None, wait=2.0):
+        """Closes the given windows (default: every window opened here) and waits up to `wait` s for them to go."""
+        closing = set(self.opened if hwnds is None else hwnds)
+        log.info(f"正在关闭 {len(closing)} 个窗口...")
+        generation = self.backend.generation
+        for hwnd in closing:
+            try:
+                self.backend.close(hwnd)
+            except Exception as e:
+                log.error(f"关闭窗口 {hwnd} 时出错: {e}")
+            self.opened.pop(hwnd, None)
+        deadline = time.perf_counter() + wait
+        while closing & set(self.backend.list_windows()) and time.perf_counter() < deadline:
+            generation = self.backend.wait_for_change(generation, deadline - time.perf_counter())
+        return closing - set(self.backend.list_windows())
+
+    def arrange(self, hwnds, target="all"):
+        """
+        Lays `hwnds` out in a grid on `target` ("all", "primary" or a monitor index) in one batch.
+        Returns {"placements": [(hwnd, rect)], "errors": {hwnd: error}, "apply_ms"}.
+        """
+        if not hwnds:
+            raise ArrangerError("没有选中需要排列的窗口。")
+        monitors = self.refresh_monitors()
+        if isinstance(target, int) and target >= len(monitors):
+            raise ArrangerError(f"显示器 {target + 1} 已断开，请重新选择显示器。")
+        rects = compute_layout(len(hwnds), monitors, target)
+        placements = list(zip(hwnds, rects))
+        log.info(f"Arrangement for {len(hwnds)} windows on {target}: {rects}")
+        started = time.perf_counter()
+        errors = self.backend.apply_layout(placements)
+        apply_ms = (time.perf_counter() - started) * 1000
+        for hwnd, error in errors.items():
+            log.error(f"无法移动/调整窗口 {hwnd}: {error}")
+        return {"placements": [(hwnd, rect) for hwnd, rect in placements if hwnd not in errors],
+                "errors": errors, "apply_ms": apply_ms}
+
+    def verify(self, placements):
+        """Blocks up to a second while windows apply their moves; see window_layout.verify_layout."""
+        return verify_layout(self.backend, placements)
+
+
+# --- GUI ---
 class BrowserGridArrangerApp:
-    def __init__(self, master):
-        setup_logging()
+    """Tk front end for a GridArranger; `master` may be a Tk root or a Toplevel."""
+
+    def __init__(self, master, arranger=None, watch=False):
         self.master = master
         master.title("浏览器网格排列工具")
 
-        self.browser_windows = {}
-        self.selected_windows = {}
-        self.opened_windows_by_script = [] # 用于追踪由脚本打开的窗口
+        self.arranger = arranger or GridArranger()
+        self.browser_windows = {} # Maps hwnd to title
+        self.selected_windows = {} # Maps hwnd to its Checkbutton's BooleanVar
+        self.window_rows = {} # Maps hwnd to its Checkbutton
+        self.watching = False
+        self.watch_debounce = 0.05
 
         self.frame = tk.Frame(master)
         self.frame.pack(padx=10, pady=10)
+        self.frame.bind("<Destroy>", lambda e: setattr(self, "watching", False))
 
         # --- 功能按钮 ---
         self.open_urls_button = tk.Button(self.frame, text="一键打开所有网址", command=self.open_urls_from_file)
@@ -58,184 +257,208 @@ class BrowserGridArrangerApp:
         self.refresh_button = tk.Button(self.frame, text="刷新窗口列表", command=self.refresh_windows)
         self.refresh_button.pack(pady=5)
 
+        self.watch_var = tk.BooleanVar(value=watch)
+        tk.Checkbutton(self.frame, text="自动刷新窗口列表", variable=self.watch_var, command=self.toggle_watcher).pack()
+
         self.arrange_button = tk.Button(self.frame, text="排列选中的窗口", command=self.arrange_windows)
         self.arrange_button.pack(pady=5)
 
+        # Which display(s) to lay the grid out on; the list follows display changes (see update_monitor_choices)
+        self.monitor_var = tk.StringVar(value="全部显示器")
+        self.monitor_menu = tk.OptionMenu(self.frame, self.monitor_var, "全部显示器")
+        self.monitor_menu.pack(pady=5)
+        self.update_monitor_choices()
+
+        self.status_var = tk.StringVar()
+        tk.Label(self.frame, textvariable=self.status_var, anchor="w").pack(fill="x")
+
         self.window_list_frame = tk.LabelFrame(self.frame, text="检测到的浏览器窗口")
         self.window_list_frame.pack(pady=10, fill="both", expand=True)
+        self.empty_label = tk.Label(self.window_list_frame, text="未找到打开的浏览器窗口。")
 
         self.refresh_windows()
+        self.toggle_watcher()
 
-    def open_urls_from_file(self):
-        logging.info("open_urls_from_file called.")
-        chrome_path = find_chrome_executable()
-        if not chrome_path:
-            logging.error("错误：未找到 Google Chrome 浏览器。请检查安装路径。")
-            print("错误：未找到 Google Chrome 浏览器。请检查安装路径。")
-            return
+    def show_status(self, text):
+        log.info(text)
+        print(text)
+        self.status_var.set(text)
 
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        url_file_path = os.path.join(script_dir, 'itemurl.txt')
-        logging.info(f"Looking for URL file at: {url_file_path}")
-
-        if not os.path.exists(url_file_path):
-            logging.error(f"错误：URL 文件未找到，路径：{url_file_path}")
-            print(f"错误：URL 文件未找到，路径：{url_file_path}")
-            return
-
-        with open(url_file_path, 'r') as f:
-            urls = [line.strip() for line in f if line.strip()]
-        logging.info(f"Found {len(urls)} URLs in itemurl.txt.")
-
-        if not urls:
-            logging.info("信息：itemurl.txt 文件为空，没有要打开的 URL。")
-            print("信息：itemurl.txt 文件为空，没有要打开的 URL。")
-            return
-
-        browser_titles = ["Chrome", "Firefox", "Edge", "Brave", "Opera", "谷歌浏览器"]
-        all_windows_before = {win._hWnd for win in gw.getAllWindows() if win.title and any(b in win.title for b in browser_titles)}
-
-        logging.info(f"正在打开 {len(urls)} 个网址...")
-        print(f"正在打开 {len(urls)} 个网址...")
-        for url in urls:
+    def in_background(self, name, work, done):
+        """Runs work() on a worker thread and done(result, error) back on the Tk thread."""
+        def run():
             try:
-                logging.info(f"Opening URL: {url}")
-                subprocess.Popen([chrome_path, url, "--new-window"])
+                result, error = work(), None
             except Exception as e:
-                logging.error(f"打开 URL 时出错 ({url}): {e}")
-                print(f"打开 URL 时出错 ({url}): {e}")
-
-        logging.info("正在等待新窗口加载...")
-        print("正在等待新窗口加载...")
-        start_time = time.time()
-        timeout = 30
-        newly_opened_handles = set()
-        while time.time() - start_time < timeout:
-            all_windows_after = gw.getAllWindows()
-            current_handles = {win._hWnd for win in all_windows_after if win.title and any(b in win.title for b in browser_titles)}
-            newly_opened_handles = current_handles - all_windows_before
-            if len(newly_opened_handles) >= len(urls):
-                break
-            time.sleep(0.5)
-        
-        self.opened_windows_by_script = [win for win in gw.getAllWindows() if win._hWnd in newly_opened_handles]
-        logging.info(f"已识别 {len(self.opened_windows_by_script)} 个新窗口。")
-        print(f"已识别 {len(self.opened_windows_by_script)} 个新窗口。")
+                result, error = None, e
+            try:
+                self.master.after(0, done, result, error)
+            except (RuntimeError, tk.TclError): # Window was closed meanwhile
+                pass
+        threading.Thread(target=run, name=name, daemon=True).start()
+
+    def open_urls_from_file(self):
+        log.info("open_urls_from_file called.")
+        self.status_var.set("正在打开网址...")
+        self.open_urls_button.config(state="disabled")
+
+        # The pipeline blocks until every window appears; keep it off the Tk thread
+        def on_window(hwnd, urls, seconds):
+            self.master.after(0, self.on_window_opened)
+        self.in_background("LaunchPipeline", lambda: self.arranger.open(on_window=on_window), self.on_urls_opened)
+
+    def on_window_opened(self):
+        self.status_var.set(f"已识别 {len(self.arranger.opened)} 个已打开窗口...")
+
+    def on_urls_opened(self, result, error):
+        self.open_urls_button.config(state="normal")
+        if error:
+            self.show_status(str(error) if isinstance(error, ArrangerError) else f"打开网址时出错: {error}")
+            return
+        status = f"已识别 {len(result['windows'])} 个新窗口, 用时 {result['elapsed_s']:.1f} 秒。"
+        if result["missing"]:
+            status += f" {len(result['missing'])} 组网址未检测到窗口。"
+        self.show_status(status)
         self.refresh_windows()
 
     def close_opened_windows(self):
-        logging.info("close_opened_windows called.")
-        if not self.opened_windows_by_script:
-            logging.info("没有由脚本打开的窗口可供关闭。")
-            print("没有由脚本打开的窗口可供关闭。")
+        log.info("close_opened_windows called.")
+        if not self.arranger.opened:
+            self.show_status("没有由脚本打开的窗口可供关闭。")
             return
-
-        logging.info(f"正在关闭 {len(self.opened_windows_by_script)} 个窗口...")
-        print(f"正在关闭 {len(self.opened_windows_by_script)} 个窗口...")
-        for window in list(self.opened_windows_by_script):
-            try:
-                logging.info(f"Closing window: {window.title}")
-                window.close()
-            except Exception as e:
-                logging.error(f"关闭窗口 '{window.title}' 时出错: {e}")
-                print(f"关闭窗口 '{window.title}' 时出错: {e}")
-        
-        self.opened_windows_by_script = []
-        logging.info("所有由脚本打开的窗口已关闭。正在刷新列表...")
-        print("所有由脚本打开的窗口已关闭。正在刷新列表...")
-        time.sleep(1)
+        self.status_var.set(f"正在关闭 {len(self.arranger.opened)} 个窗口...")
+        self.in_background("CloseWindows", self.arranger.close, self.on_windows_closed)
+
+    def on_windows_closed(self, closed, error):
+        if error:
+            self.show_status(f"关闭窗口时出错: {error}")
+        else:
+            self.show_status(f"已关闭 {len(closed)} 个由脚本打开的窗口。")
         self.refresh_windows()
 
-    def refresh_windows(self):
-        logging.info("refresh_windows called.")
-        """（可靠版）清空并重新检测所有窗口，默认全部选中。"""
-        for widget in self.window_list_frame.winfo_children():
-            widget.destroy()
-
-        self.browser_windows = {}
-        self.selected_windows = {}
-
-        all_windows = gw.getAllWindows()
-        browser_titles = ["Chrome", "Firefox", "Edge", "Brave", "Opera", "谷歌浏览器"]
-
-        detected_count = 0
-        for window in all_windows:
-            if window.title and any(browser in window.title for browser in browser_titles):
-                self.browser_windows[window._hWnd] = window
-                var = tk.BooleanVar(value=True) # 简化逻辑：总是新建变量并默认选中
-                self.selected_windows[window._hWnd] = var
-                cb = tk.Checkbutton(self.window_list_frame, text=window.title, variable=var)
-                cb.pack(anchor="w")
-                detected_count += 1
-        logging.info(f"Detected {detected_count} browser windows.")
-
-        if not self.browser_windows:
-            tk.Label(self.window_list_frame, text="未找到打开的浏览器窗口。").pack()
+    def update_monitor_choices(self):
+        """Rebuilds the display menu from the arranger's last monitor list; a vanished display falls back to all."""
+        self.monitor_choices = {"全部显示器": "all", "主显示器": "primary"}
+        for i, monitor in enumerate(self.arranger.monitors):
+            left, top, width, height = monitor["work"]
+            self.monitor_choices[f"显示器 {i + 1} ({width}x{height})"] = i
+        menu = self.monitor_menu["menu"]
+        menu.delete(0, "end")
+        for label in self.monitor_choices:
+            menu.add_command(label=label, command=tk._setit(self.monitor_var, label))
+        if self.monitor_var.get() not in self.monitor_choices:
+            self.monitor_var.set("全部显示器")
+
+    def refresh_windows(self, windows=None):
+        """按窗口句柄增量更新列表：只增删有变化的行，已有窗口保留勾选状态，新窗口默认选中。"""
+        if windows is None:
+            windows = self.arranger.refresh()
+            self.arranger.refresh_monitors()
+            self.update_monitor_choices()
+
+        removed = [hwnd for hwnd in self.browser_windows if hwnd not in windows]
+        for hwnd in removed:
+            self.window_rows.pop(hwnd).destroy()
+            del self.browser_windows[hwnd]
+            del self.selected_windows[hwnd]
+
+        added = 0
+        for hwnd, title in windows.items():
+            if hwnd not in self.browser_windows:
+                var = tk.BooleanVar(value=True)
+                self.selected_windows[hwnd] = var
+                row = self.window_rows[hwnd] = tk.Checkbutton(self.window_list_frame, text=title, variable=var)
+                row.pack(anchor="w")
+                added += 1
+            elif self.browser_windows[hwnd] != title:
+                self.window_rows[hwnd].config(text=title) # Tab title changed
+            self.browser_windows[hwnd] = title
+
+        if added or removed:
+            log.info(f"Window list updated: +{added} -{len(removed)}, {len(self.browser_windows)} browser windows.")
+        if self.browser_windows:
+            self.empty_label.pack_forget()
+        else:
+            self.empty_label.pack()
+
+    def toggle_watcher(self):
+        if self.watch_var.get():
+            if not self.watching:
+                self.watching = True
+                threading.Thread(target=self.watch_windows, name="WindowWatcher", daemon=True).start()
+        else:
+            self.watching = False
+
+    def watch_windows(self):
+        """Background watcher: re-enumerates on window changes and posts only actual differences to the Tk thread."""
+        backend = self.arranger.backend
+        generation = backend.generation
+        last_seen = None
+        while self.watching:
+            generation = backend.wait_for_change(generation, 1.0)
+            if not self.watching:
+                break
+            time.sleep(self.watch_debounce) # A new window fires several events; enumerate once
+            windows = self.arranger.refresh()
+            if windows == last_seen:
+                continue
+            last_seen = windows
+            try:
+                self.master.after(0, self.refresh_windows, windows)
+            except (RuntimeError, tk.TclError): # Window was closed
+                break
+        self.watching = False
 
     def arrange_windows(self):
-        logging.info("arrange_windows called.")
-        """（可靠版）排列当前在界面上被勾选的窗口。"""
-        selected_browser_windows = []
-        for hwnd, var in self.selected_windows.items():
-            if var.get(): # 只相信当前界面的勾选状态
-                if hwnd in self.browser_windows:
-                    selected_browser_windows.append(self.browser_windows[hwnd])
-
-        num_windows = len(selected_browser_windows)
-        logging.info(f"Number of selected windows for arrangement: {num_windows}")
-        if num_windows == 0:
-            print("没有选中需要排列的窗口。")
-            logging.info("No windows selected for arrangement.")
-            return
-
+        log.info("arrange_windows called.")
+        """排列当前在界面上被勾选的窗口：先算出整个网格，再一次性批量应用，最后在后台校验。"""
+        selected = [hwnd for hwnd, var in self.selected_windows.items() if var.get() and hwnd in self.browser_windows]
+        log.info(f"Number of selected windows for arrangement: {len(selected)}")
         try:
-            monitor_info = win32api.GetMonitorInfo(win32api.MonitorFromPoint((0,0)))
-            work_area = monitor_info.get("Work")
-            screen_left, screen_top, screen_width, screen_height = work_area
-            logging.info(f"Screen work area: Left={screen_left}, Top={screen_top}, Width={screen_width}, Height={screen_height}")
+            result = self.arranger.arrange(selected, self.monitor_choices[self.monitor_var.get()])
+        except ArrangerError as e:
+            self.update_monitor_choices()
+            self.show_status(str(e))
+            return
         except Exception as e:
-            logging.error(f"Error getting monitor info: {e}")
-            print(f"Error getting monitor info: {e}")
+            log.error(f"Error arranging windows: {e}", exc_info=True)
+            self.show_status(f"排列窗口时出错: {e}")
             return
+        self.update_monitor_choices()
+        failed, apply_ms = len(result["errors"]), result["apply_ms"]
+        self.status_var.set(f"已排列 {len(result['placements'])} 个窗口 ({apply_ms:.0f}ms), 校验中...")
 
-        cols = math.ceil(math.sqrt(num_windows))
-        rows = math.ceil(num_windows / cols)
+        # Windows apply moves asynchronously; check the result off the Tk thread
+        self.in_background("LayoutVerify", lambda: self.arranger.verify(result["placements"]),
+                           lambda verified, error: self.on_layout_verified(verified, error, failed, apply_ms))
 
-        window_width = screen_width // cols
-        window_height = screen_height // rows
-        logging.info(f"Arrangement grid: {rows} rows, {cols} columns. Window size: {window_width}x{window_height}")
-
-        for i, window in enumerate(selected_browser_windows):
-            row = i // cols
-            col = i % cols
-            x = screen_left + col * window_width
-            y = screen_top + row * window_height
-
-            try:
-                logging.info(f"Processing window '{window.title}': Current pos=({window.left},{window.top}), size=({window.width},{window.height})")
-                # Restore window to normal state if minimized or maximized
-                if window.isMinimized or window.isMaximized:
-                    logging.info(f"Window '{window.title}' is minimized or maximized, restoring to normal.")
-                    window.restore()
-                    time.sleep(0.2) # Give it a moment to restore
-
-                logging.info(f"Moving/resizing window '{window.title}' to ({x},{y}) {window_width}x{window_height}")
-                window.moveTo(x, y)
-                window.resizeTo(window_width, window_height)
-                window.activate()
-
-                # Verify actual position and size after operation
-                time.sleep(0.1) # Give OS a moment to apply changes
-                logging.info(f"Window '{window.title}' actual pos=({window.left},{window.top}), size=({window.width},{window.height})")
-                logging.info(f"Successfully moved/resized window '{window.title}'.")
-            except Exception as e:
-                logging.error(f"无法移动/调整窗口 '{window.title}': {e}")
-                print(f"无法移动/调整窗口 '{window.title}': {e}")
+    def on_layout_verified(self, result, error, failed, apply_ms):
+        if error:
+            log.error(f"Layout verification failed: {error}")
+            return
+        for hwnd, (expected, actual) in result["mismatched"].items():
+            log.warning(f"Window '{self.browser_windows.get(hwnd, hwnd)}' expected {expected}, actual {actual}")
+        status = f"已排列 {len(result['ok'])} 个窗口 ({apply_ms:.0f}ms)"
+        if result["mismatched"]:
+            status += f", {len(result['mismatched'])} 个位置/大小不符 (可能受最小窗口尺寸限制)"
+        if failed or result["gone"]:
+            status += f", {failed + len(result['gone'])} 个失败"
+        log.info(status)
+        self.status_var.set(status)
 
 if __name__ == "__main__":
+    setup_logging()
+    parser = argparse.ArgumentParser(description="浏览器网格排列工具")
+    parser.add_argument("--backend", choices=["win32", "fake"], default=None, help="Window backend (default: win32 where available)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Windows waited for at a time while opening URLs (0: no limit)")
+    parser.add_argument("--urls-per-window", type=int, default=1, help="URLs opened as tabs of one browser window")
+    parser.add_argument("--watch", action="store_true", help="Keep the window list current from a background watcher")
+    args = parser.parse_args()
     try:
         root = tk.Tk()
-        app = BrowserGridArrangerApp(root)
+        arranger = GridArranger(default_backend(args.backend), args.concurrency, args.urls_per_window,
+                                browser_path="chrome" if args.backend == "fake" else None)
+        app = BrowserGridArrangerApp(root, arranger, args.watch)
         root.mainloop()
     except Exception as e:
-        logging.critical(f"Unhandled exception in main loop: {e}", exc_info=True)
\ No newline at end of file
+        log.critical(f"Unhandled exception in main loop: {e}", exc_info=True)
\ No newline at end of file
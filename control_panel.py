@@ -1,97 +1,515 @@
 import tkinter as tk
 from tkinter import ttk
-import asyncio
-import websockets
-import functools
 import threading
-import json
-from PIL import Image, ImageTk
-import requests
 from io import BytesIO
-import random
 import logging
 from datetime import datetime, timedelta
-import subprocess
+import importlib
+import argparse
+import json
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from panel_engine import PanelEngine
+from price_ladder import STRATEGY_LABELS, describe as describe_ladder
+from fire_slots import describe as describe_slots, period_warning
+from settings_store import SettingsStore, read_file as read_settings_file, write_file as write_settings_file
+from event_log import setup_logging
 
 # --- Setup Logging ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename='control_panel_log.txt',
-    filemode='a'
-)
-
-# --- WebSocket Server ---
-class WebSocketServer:
-    def __init__(self, app_instance):
-        self.clients = {} # Maps websocket to product_id
-        self.app = app_instance
-        self.loop = None # Will hold the event loop for this thread
-        self.server_task = None
-
-    async def handle_connection(self, websocket, path=None):
-        client_id = None
+# Queue-based JSONL log written by a background thread; nothing touches the disk on the GUI or server threads
+LOG_FILE = 'control_panel_log.jsonl'
+LOG_CATEGORY_LEVELS = {"panel.sync": logging.WARNING} # Per-ping records only when debugging time sync
+LOG_SAMPLE_RATES = {} # e.g. {"panel.recv": 0.1} keeps every 10th received-message record
+setup_logging(LOG_FILE, category_levels=LOG_CATEGORY_LEVELS, sample_rates=LOG_SAMPLE_RATES)
+
+log = logging.getLogger("panel.gui")
+status_log = logging.getLogger("panel.status")
+
+STARTUP_TRACE = bool(os.environ.get("PANEL_STARTUP_TRACE")) # Set by bench_startup.py
+
+def trace_startup(stage):
+    """Prints a startup milestone as a JSON line on stdout when PANEL_STARTUP_TRACE is set."""
+    if STARTUP_TRACE:
+        print(json.dumps({"startup": stage, "t": time.time()}), flush=True)
+
+# --- Thumbnail Loader ---
+class ThumbnailLoader:
+    """
+    Fetches product thumbnails on a bounded worker pool over one keep-alive session.
+    Concurrent requests for the same URL share a single download, and finished
+    thumbnails are kept in an on-disk LRU cache (mtime = last use) capped by size.
+    Callbacks run on a worker thread as callback(image, error). PIL and requests are
+    imported on first use, not at startup.
+    """
+
+    def __init__(self, cache_dir, max_workers=4, max_cache_bytes=20 * 1024 * 1024, size=(50, 50)):
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.size = size
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_workers = max_workers
+        self.session = None # Created by the first download
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="thumbnail")
+        self.lock = threading.Lock()
+        self.in_flight = {} # Maps url to the callbacks waiting for it
+        self.cache_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    def cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".png")
+
+    def get_cached(self, url):
+        """Returns the cached thumbnail or None. Cheap enough to call on the GUI thread."""
+        from PIL import Image
+        path = self.cache_path(url)
         try:
-            logging.info(f"New client connected: {websocket.remote_address}")
-            async for message in websocket:
-                data = json.loads(message)
-                logging.info(f"Received message: {data}")
-                
-                if data.get("type") == "register":
-                    product_id = data.get("productId")
-                    image_url = data.get("imageUrl")
-                    client_id = product_id
-                    
-                    if product_id and product_id not in self.clients.values():
-                        self.clients[websocket] = product_id
-                        # Schedule GUI update in the main thread
-                        self.app.master.after(0, self.app.add_product_card, product_id, image_url, websocket)
-                    else:
-                        logging.warning(f"Product {product_id} is already registered or ID is null.")
-
-        except websockets.exceptions.ConnectionClosed as e:
-            logging.info(f"Client {client_id or websocket.remote_address} disconnected. Reason: {e.code} {e.reason}")
-        except Exception as e:
-            logging.error(f"Error handling client {client_id or websocket.remote_address}: {e}", exc_info=True)
-        finally:
-            if websocket in self.clients:
-                product_id_to_remove = self.clients.pop(websocket)
-                self.app.master.after(0, self.app.remove_product_card, product_id_to_remove)
+            img = Image.open(path)
+            img.load()
+            os.utime(path) # Mark as recently used
+            return img
+        except (OSError, ValueError):
+            return None
+
+    def load(self, url, callback):
+        with self.lock:
+            if url in self.in_flight:
+                self.in_flight[url].append(callback)
+                return
+            self.in_flight[url] = [callback]
+        self.executor.submit(self._fetch, url)
+
+    def _get_session(self):
+        with self.lock:
+            if self.session is None:
+                import requests
+                self.session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+                self.session.mount("http://", adapter)
+                self.session.mount("https://", adapter)
+            return self.session
 
-    async def send_message(self, websocket, message):
+    def _fetch(self, url):
+        from PIL import Image
+        img, error = None, None
         try:
-            await websocket.send(json.dumps(message))
-            logging.info(f"Sent message to {self.clients.get(websocket, 'unknown')}: {message}")
-        except websockets.exceptions.ConnectionClosed:
-            # The main handler will deal with cleanup
-            pass
+            img = self.get_cached(url)
+            if img is None:
+                response = self._get_session().get(url, timeout=10)
+                response.raise_for_status()
+                img = Image.open(BytesIO(response.content))
+                img.thumbnail(self.size)
+                if img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+                    img = img.convert("RGBA")
+                self._store(url, img)
         except Exception as e:
-            logging.error(f"Failed to send message: {e}")
+            img, error = None, e
+        with self.lock:
+            callbacks = self.in_flight.pop(url, [])
+        for callback in callbacks:
+            callback(img, error)
+
+    def _store(self, url, img):
+        path = self.cache_path(url)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        img.save(tmp_path, format="PNG")
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.cache_bytes += os.path.getsize(path)
+            if self.cache_bytes > self.max_cache_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Deletes least recently used thumbnails until the cache is back under 90% of its cap. Caller holds the lock."""
+        entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".png")),
+                         key=lambda entry: entry.stat().st_mtime)
+        self.cache_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.cache_bytes <= self.max_cache_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.cache_bytes -= size
+            except OSError as e:
+                log.warning(f"Failed to evict thumbnail {entry.path}: {e}")
+
+# --- GUI Update Queue ---
+class UiQueue:
+    """
+    GUI updates from any thread, run by one periodic tick on the Tk thread instead of a
+    master.after(0, ...) each. An update posted under a key replaces the pending one with that
+    key and moves to the back, so a burst of status or per-card updates runs once per tick.
+    A tick runs at most max_per_tick updates or budget_ms of work; the rest wait for the next one.
+    """
+
+    def __init__(self, master, interval_ms=50, max_per_tick=200, budget_ms=15.0):
+        self.master = master
+        self.interval_ms = interval_ms
+        self.max_per_tick = max_per_tick
+        self.budget_ms = budget_ms
+        self.lock = threading.Lock()
+        self.pending = OrderedDict() # Maps key to (callback, args), oldest first
+        self.coalesced = 0 # Updates replaced by a later one before they ran
+        master.after(interval_ms, self.tick)
+
+    def post(self, key, callback, *args):
+        """Queues callback(*args) for the Tk thread. Updates posted with key None are never merged."""
+        with self.lock:
+            if key is None:
+                key = object()
+            elif self.pending.pop(key, None) is not None:
+                self.coalesced += 1
+            self.pending[key] = (callback, args)
+
+    def tick(self):
+        deadline = time.perf_counter() + self.budget_ms / 1000
+        for _ in range(self.max_per_tick):
+            with self.lock:
+                if not self.pending:
+                    break
+                _, (callback, args) = self.pending.popitem(last=False)
+            try:
+                callback(*args)
+            except Exception as e:
+                log.error(f"GUI update {getattr(callback, '__name__', callback)} failed: {e}", exc_info=True)
+            if time.perf_counter() >= deadline:
+                break
+        self.master.after(self.interval_ms, self.tick)
+
+# --- Product Cards ---
+INVALID_BACKGROUND = "#ffd6d6"
+
+# Card labels for client telemetry states and outcomes
+TELEMETRY_LABELS = {
+    "armed": "已布防", "fired": "已触发", "click": "已提交", "resubmit": "重新提交中",
+    "success": "成功", "min_reached": "已达最低值", "apply_fail": "改价失败", "submit_fail": "提交失败",
+}
+
+# Settings sync state of a card's tab (PanelEngine.settings_status) -> label text and colour
+SYNC_LABELS = {
+    "synced": ("已同步", "green"), "pending": ("等待确认", "orange"), "failed": ("应用失败", "red"),
+    "stale": ("未应用", "red"), "offline": ("离线", "gray"),
+}
+
+# Maps CardModel text fields to the engine's parameter fields
+CARD_PARAM_FIELDS = {"min_values_text": "minValues", "sku_prices_text": "skuPrices", "target_time_text": "targetTime",
+                     "ladder_steps_text": "ladderSteps", "priority_text": "priority", "fire_offset_text": "fireOffsetMs"}
+STRATEGY_BY_LABEL = {label: strategy for strategy, label in STRATEGY_LABELS.items()}
+# Maps every persisted CardModel field to its settings_store field
+CARD_SETTINGS_FIELDS = {**CARD_PARAM_FIELDS, "auto_decrement": "autoDecrement", "ladder_strategy": "ladderStrategy"}
+
+class CardModel:
+    """Per-product card data. Lives independently of widgets so only visible cards need any."""
+    __slots__ = ("product_id", "image_url", "min_values_text", "sku_prices_text", "auto_decrement",
+                 "target_time_text", "ladder_strategy", "ladder_steps_text", "priority_text", "fire_offset_text",
+                 "clock_text", "telemetry_text", "photo", "image_text", "invalid")
+
+    def __init__(self, product_id, image_url):
+        self.product_id = product_id
+        self.image_url = image_url
+        self.min_values_text = "0.0" # Default value
+        self.sku_prices_text = "0.0" # Default value
+        self.auto_decrement = True
+        self.target_time_text = ""
+        self.ladder_strategy = "linear"
+        self.ladder_steps_text = "" # Blank: every SKU steps by the global decrement value (百分比: 1%)
+        self.priority_text = "0" # Higher gets an earlier fire slot
+        self.fire_offset_text = "0" # ms added to the deadline before slots are assigned
+        self.clock_text = "时钟: 同步中..."
+        self.telemetry_text = ""
+        self.photo = None # Keep a reference!
+        self.image_text = "加载图片中..."
+        self.invalid = set() # Text fields whose last edit did not parse cleanly
+
+
+class CardSlot:
+    """A reusable card widget set. Edits are written straight through to the bound CardModel and reported to the grid."""
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.model = None
+        self.loading = False
+        card = self.frame = ttk.Frame(grid.canvas, padding="2", relief=tk.RIDGE, borderwidth=1)
+
+        # Image
+        self.img_label = ttk.Label(card)
+        self.img_label.grid(row=0, column=0, rowspan=3, padx=2, pady=2)
+
+        # Info
+        self.id_var = tk.StringVar()
+        ttk.Label(card, textvariable=self.id_var, font=("Helvetica", 10, "bold")).grid(row=0, column=1, sticky="w", padx=5)
+        self.sync_label = ttk.Label(card) # Whether the tab has the card's current settings
+        self.sync_label.grid(row=0, column=2, sticky="w", padx=5)
+
+        # Optional per-product target time, overrides the global one
+        ttk.Label(card, text="单独目标(时:分:秒):").grid(row=0, column=3, sticky="w", padx=5)
+        self.target_time_var = tk.StringVar()
+        self.target_time_entry = ttk.Entry(card, textvariable=self.target_time_var, width=10)
+        self.target_time_entry.grid(row=0, column=4, sticky="w", padx=5)
+
+        # Min Values (changed to Text widget)
+        ttk.Label(card, text="最低值(每行一个):").grid(row=1, column=1, sticky="nw", padx=5)
+        self.min_values_text = tk.Text(card, width=10, height=3) # Text widget for multi-line input
+        self.min_values_text.grid(row=1, column=2, sticky="w", padx=5)
+
+        # SKU Prices
+        ttk.Label(card, text="SKU价格(每行一个):").grid(row=1, column=3, sticky="nw", padx=5) # Use "nw" for alignment
+        self.sku_prices_text = tk.Text(card, width=15, height=3) # Text widget for multi-line input
+        self.sku_prices_text.grid(row=1, column=4, sticky="w", padx=5)
+
+        # Auto Decrement
+        self.auto_decrement_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(card, text="自动递减", variable=self.auto_decrement_var).grid(row=2, column=1, columnspan=2, sticky="w", padx=5)
+
+        # Clock offset / RTT from time sync
+        self.clock_var = tk.StringVar()
+        ttk.Label(card, textvariable=self.clock_var).grid(row=2, column=3, columnspan=2, sticky="w", padx=5)
+
+        # Latest run as reported by the tab: state, fire-to-click, click-to-result, resubmits
+        self.telemetry_var = tk.StringVar()
+        ttk.Label(card, textvariable=self.telemetry_var).grid(row=3, column=1, columnspan=4, sticky="w", padx=5)
+
+        # Resubmit price ladder: strategy, per-SKU steps, and a preview of what the tab will be armed with
+        ladder_frame = ttk.Frame(card)
+        ladder_frame.grid(row=4, column=1, columnspan=4, sticky="w", padx=5)
+        ttk.Label(ladder_frame, text="递减策略:").pack(side=tk.LEFT)
+        self.ladder_strategy_var = tk.StringVar()
+        ttk.Combobox(ladder_frame, textvariable=self.ladder_strategy_var, values=list(STRATEGY_LABELS.values()),
+                     state="readonly", width=9).pack(side=tk.LEFT, padx=2)
+        ttk.Label(ladder_frame, text="步长:").pack(side=tk.LEFT, padx=(5, 0))
+        self.ladder_steps_var = tk.StringVar()
+        self.ladder_steps_entry = ttk.Entry(ladder_frame, textvariable=self.ladder_steps_var, width=10)
+        self.ladder_steps_entry.pack(side=tk.LEFT, padx=2)
+        self.ladder_var = tk.StringVar()
+        ttk.Label(ladder_frame, textvariable=self.ladder_var).pack(side=tk.LEFT, padx=5)
+        ttk.Button(ladder_frame, text="预览", width=5,
+                   command=lambda: self.model and grid.on_preview and grid.on_preview(self.model)).pack(side=tk.LEFT)
+
+        # Fire slot: priority among the fleet and an offset from the deadline (see fire_slots)
+        slot_frame = ttk.Frame(card)
+        slot_frame.grid(row=5, column=1, columnspan=4, sticky="w", padx=5)
+        ttk.Label(slot_frame, text="优先级:").pack(side=tk.LEFT)
+        self.priority_var = tk.StringVar()
+        self.priority_entry = ttk.Entry(slot_frame, textvariable=self.priority_var, width=5)
+        self.priority_entry.pack(side=tk.LEFT, padx=2)
+        ttk.Label(slot_frame, text="触发偏移(毫秒):").pack(side=tk.LEFT, padx=(5, 0))
+        self.fire_offset_var = tk.StringVar()
+        self.fire_offset_entry = ttk.Entry(slot_frame, textvariable=self.fire_offset_var, width=7)
+        self.fire_offset_entry.pack(side=tk.LEFT, padx=2)
+
+        self.min_values_text.bind("<<Modified>>", lambda e: self.on_text_modified(self.min_values_text, "min_values_text"))
+        self.sku_prices_text.bind("<<Modified>>", lambda e: self.on_text_modified(self.sku_prices_text, "sku_prices_text"))
+        self.target_time_var.trace_add("write", lambda *a: self.on_var_written(self.target_time_var, "target_time_text"))
+        self.auto_decrement_var.trace_add("write", lambda *a: self.on_var_written(self.auto_decrement_var, "auto_decrement"))
+        self.ladder_steps_var.trace_add("write", lambda *a: self.on_var_written(self.ladder_steps_var, "ladder_steps_text"))
+        self.ladder_strategy_var.trace_add("write", lambda *a: self.on_strategy_written())
+        self.priority_var.trace_add("write", lambda *a: self.on_var_written(self.priority_var, "priority_text"))
+        self.fire_offset_var.trace_add("write", lambda *a: self.on_var_written(self.fire_offset_var, "fire_offset_text"))
+
+        self.window = grid.canvas.create_window(0, 0, window=card, anchor="nw", state="hidden")
+
+    def on_text_modified(self, widget, field):
+        if not widget.edit_modified():
+            return # The event for clearing the flag below, or for a load that bind() already cleared
+        if self.model is not None and not self.loading:
+            setattr(self.model, field, widget.get("1.0", "end-1c"))
+            self.edited(field)
+        widget.edit_modified(False) # Re-arm <<Modified>>
+
+    def on_var_written(self, var, field):
+        if self.model is not None and not self.loading:
+            setattr(self.model, field, var.get())
+            self.edited(field)
+
+    def on_strategy_written(self):
+        if self.model is not None and not self.loading:
+            self.model.ladder_strategy = STRATEGY_BY_LABEL[self.ladder_strategy_var.get()]
+            self.edited("ladder_strategy")
+
+    def edited(self, field):
+        if self.grid.on_edit:
+            self.grid.on_edit(self.model, field)
+        self.show_invalid()
+
+    def show_invalid(self):
+        invalid = self.model.invalid
+        for field, widget in (("min_values_text", self.min_values_text), ("sku_prices_text", self.sku_prices_text)):
+            widget.config(background=INVALID_BACKGROUND if field in invalid else "white")
+        self.target_time_entry.config(style="Invalid.TEntry" if "target_time_text" in invalid else "TEntry")
+        self.ladder_steps_entry.config(style="Invalid.TEntry" if "ladder_steps_text" in invalid else "TEntry")
+        self.priority_entry.config(style="Invalid.TEntry" if "priority_text" in invalid else "TEntry")
+        self.fire_offset_entry.config(style="Invalid.TEntry" if "fire_offset_text" in invalid else "TEntry")
+
+    def bind(self, model):
+        if self.model is model:
+            return
+        focused = self.frame.focus_get()
+        if focused is not None and str(focused).startswith(str(self.frame)):
+            self.grid.canvas.focus_set() # Don't keep typing into a card that now shows another product
+        self.model = model
+        self.loading = True
+        try:
+            self.id_var.set(f"商品ID: {model.product_id}")
+            self.target_time_var.set(model.target_time_text)
+            self.auto_decrement_var.set(model.auto_decrement)
+            self.ladder_strategy_var.set(STRATEGY_LABELS[model.ladder_strategy])
+            self.ladder_steps_var.set(model.ladder_steps_text)
+            self.priority_var.set(model.priority_text)
+            self.fire_offset_var.set(model.fire_offset_text)
+            self.clock_var.set(model.clock_text)
+            self.telemetry_var.set(model.telemetry_text)
+            for widget, text in ((self.min_values_text, model.min_values_text), (self.sku_prices_text, model.sku_prices_text)):
+                widget.delete("1.0", tk.END)
+                widget.insert(tk.END, text)
+                widget.edit_reset() # Undo history belongs to the previous product
+                widget.edit_modified(False) # <<Modified>> arrives after bind() returns; the cleared flag marks it as a load
+            self.show_image()
+            self.show_invalid()
+            self.show_sync()
+            self.show_ladder()
+        finally:
+            self.loading = False
+
+    def show_sync(self):
+        if self.grid.sync_status:
+            text, color = SYNC_LABELS[self.grid.sync_status(self.model.product_id)]
+            self.sync_label.config(text=text, foreground=color)
+
+    def show_ladder(self):
+        if self.grid.ladder_rows:
+            self.ladder_var.set(describe_ladder(self.grid.ladder_rows(self.model.product_id)))
+
+    def show_image(self):
+        if self.model.photo is not None:
+            self.img_label.config(image=self.model.photo, text="")
+        else:
+            self.img_label.config(image="", text=self.model.image_text)
+
+
+class VirtualCardGrid:
+    """
+    Scrollable card grid that only creates widgets for the visible rows.
+    Cards have a fixed row height, so the scroll region is computed instead of measured,
+    and slots are re-bound to other models as the view scrolls.
+    """
+
+    def __init__(self, parent, columns=3, on_edit=None, sync_status=None, ladder_rows=None, on_preview=None, post=None):
+        self.columns = columns
+        self.post = post # UiQueue.post; adds and removes then share one relayout per tick
+        self.on_edit = on_edit # Called as on_edit(model, field) after each edit in a card
+        self.sync_status = sync_status # Called as sync_status(product_id) -> a SYNC_LABELS key
+        self.ladder_rows = ladder_rows # Called as ladder_rows(product_id) -> the price ladder the tab would be armed with
+        self.on_preview = on_preview # Called as on_preview(model) from a card's preview button
+        self.models = []
+        self.slots = []
+        self.slot_by_product = {} # Maps product_id to the slot currently showing it
+        self.row_height = None # Measured from the first slot
+
+        self.canvas = tk.Canvas(parent, highlightthickness=0)
+        scrollbar = ttk.Scrollbar(parent, orient="vertical", command=self.on_scroll)
+        self.canvas.configure(yscrollcommand=scrollbar.set, yscrollincrement=10)
+        self.canvas.bind("<Configure>", lambda e: self.refresh())
+        self.canvas.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+
+    def on_scroll(self, *args):
+        self.canvas.yview(*args)
+        self.refresh()
+
+    def add(self, model):
+        self.models.append(model)
+        self.request_refresh()
+
+    def remove(self, product_id):
+        self.models = [model for model in self.models if model.product_id != product_id]
+        self.request_refresh()
+
+    def request_refresh(self):
+        if self.post:
+            self.post("card_grid_refresh", self.refresh)
+        else:
+            self.refresh()
+
+    def slot_for(self, product_id):
+        return self.slot_by_product.get(product_id)
+
+    def refresh_sync(self):
+        """Re-reads the sync state of the visible cards only."""
+        for slot in self.slot_by_product.values():
+            slot.show_sync()
+
+    def refresh_ladders(self):
+        for slot in self.slot_by_product.values():
+            slot.show_ladder()
+
+    def reload(self, product_id):
+        """Re-reads a visible card's fields from its model after they were changed outside the card."""
+        slot = self.slot_by_product.get(product_id)
+        if slot:
+            model, slot.model = slot.model, None
+            slot.bind(model)
 
-    async def _websocket_handler(self, websocket, path=None):
-        await self.handle_connection(websocket, path)
+    def new_slot(self):
+        slot = CardSlot(self)
+        self.slots.append(slot)
+        if self.row_height is None:
+            slot.frame.update_idletasks()
+            self.row_height = slot.frame.winfo_reqheight() + 4
+        return slot
 
-    def start(self):
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-        self.loop.run_until_complete(self.main())
+    def refresh(self):
+        width = max(self.canvas.winfo_width(), 1)
+        height = max(self.canvas.winfo_height(), 1)
+        if self.row_height is None:
+            self.new_slot()
+        row_height = self.row_height
+        col_width = max(width // self.columns, 40)
+        total_rows = -(-len(self.models) // self.columns)
+        self.canvas.configure(scrollregion=(0, 0, width, max(total_rows * row_height, height)))
+
+        first_row = max(0, int(self.canvas.canvasy(0)) // row_height)
+        visible_rows = height // row_height + 2
+        first_index = first_row * self.columns
+        needed = min(visible_rows * self.columns, max(0, len(self.models) - first_index))
+        while len(self.slots) < needed:
+            self.new_slot()
+
+        self.slot_by_product = {}
+        for i, slot in enumerate(self.slots):
+            index = first_index + i
+            if i >= needed:
+                slot.model = None
+                self.canvas.itemconfigure(slot.window, state="hidden")
+                continue
+            model = self.models[index]
+            slot.bind(model)
+            self.slot_by_product[model.product_id] = slot
+            row, col = divmod(index, self.columns)
+            self.canvas.coords(slot.window, col * col_width + 2, row * row_height + 2)
+            self.canvas.itemconfigure(slot.window, state="normal", width=col_width - 4, height=row_height - 4)
 
-    async def main(self):
-        self.loop = asyncio.get_running_loop()
-        async with websockets.serve(self._websocket_handler, "localhost", 8765):
-            logging.info("WebSocket server started on ws://localhost:8765")
-            self.app.master.after(0, self.app.update_status, f"监听中: ws://localhost:8765. 已连接客户端: {len(self.clients)}")
-            await asyncio.Future()  # run forever
 
 # --- GUI Application ---
 class ControlPanelApp:
-    def __init__(self, master):
+    def __init__(self, master, engine=None):
         self.master = master
         master.title("中央控制面板")
         master.geometry("950x700") # Adjusted for better layout
         
-        self.ws_server = WebSocketServer(self)
-        self.product_cards = {} # Maps product_id to its card frame and widgets
+        # The engine may already be running (started before the window); events it emitted so far are replayed here
+        self.engine = engine or PanelEngine()
+        self.ui = UiQueue(master) # Engine, loader and worker threads hand GUI updates to this
+        self.engine.subscribe(self.on_engine_event)
+        self.product_cards = {} # Maps product_id to its CardModel; widgets exist only for visible cards
+        self.arranger = None # browser_grid_arranger.GridArranger, loaded once in the background
+        self.arranger_lock = threading.Lock()
+        self.arranger_window = None
+        self.thumbnails = ThumbnailLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), "thumb_cache"))
+        # Card settings saved per productId; loads on its own thread while the window is built, cards added before it finishes are filled after
+        self.store = SettingsStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), "panel_settings.db"),
+                                   on_loaded=lambda: self.ui.post("settings_loaded", self.apply_loaded_settings))
 
         # --- Main Layout ---
         main_frame = ttk.Frame(master, padding="10")
@@ -109,9 +527,12 @@ class ControlPanelApp:
         self.min_var = tk.StringVar(value=now.strftime("%M"))
         self.sec_var = tk.StringVar(value=now.strftime("%S"))
 
-        ttk.Entry(settings_frame, textvariable=self.hour_var, width=5).grid(row=0, column=1, padx=2)
-        ttk.Entry(settings_frame, textvariable=self.min_var, width=5).grid(row=0, column=2, padx=2)
-        ttk.Entry(settings_frame, textvariable=self.sec_var, width=5).grid(row=0, column=3, padx=2)
+        hour_entry = ttk.Entry(settings_frame, textvariable=self.hour_var, width=5)
+        hour_entry.grid(row=0, column=1, padx=2)
+        min_entry = ttk.Entry(settings_frame, textvariable=self.min_var, width=5)
+        min_entry.grid(row=0, column=2, padx=2)
+        sec_entry = ttk.Entry(settings_frame, textvariable=self.sec_var, width=5)
+        sec_entry.grid(row=0, column=3, padx=2)
 
         # Set Time + 30s Button
         set_time_button = ttk.Button(settings_frame, text="当前时间+30秒", command=self.set_time_plus_30s)
@@ -129,41 +550,59 @@ class ControlPanelApp:
         # Decrement Value
         ttk.Label(settings_frame, text="递减值:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
         self.decrement_var = tk.StringVar(value="0.1")
-        ttk.Entry(settings_frame, textvariable=self.decrement_var, width=7).grid(row=1, column=1, padx=5)
+        decrement_entry = ttk.Entry(settings_frame, textvariable=self.decrement_var, width=7)
+        decrement_entry.grid(row=1, column=1, padx=5)
+
+        # Server-side trigger: arm clients now, push "fire" from the panel at the deadline
+        self.server_fire_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(settings_frame, text="服务器精确触发", variable=self.server_fire_var).grid(row=1, column=2, columnspan=3, padx=5, sticky="w")
+
+        # Fleet-wide submission rate: each product gets its own fire slot instead of a random delay
+        ttk.Label(settings_frame, text="每秒最多提交:").grid(row=1, column=5, padx=15, pady=5, sticky="w")
+        self.submit_rate_var = tk.StringVar(value=f"{self.engine.max_submits_per_second:g}")
+        self.submit_rate_entry = ttk.Entry(settings_frame, textvariable=self.submit_rate_var, width=7)
+        self.submit_rate_entry.grid(row=1, column=6, columnspan=2, padx=2, sticky="w")
+        self.submit_rate_var.trace_add("write", lambda *a: self.on_submit_rate_edited())
 
         # Delays
         ttk.Label(settings_frame, text="检查间隔 (毫秒):").grid(row=2, column=0, padx=5, pady=5, sticky="w")
         self.check_delay_var = tk.StringVar(value="500")
-        ttk.Entry(settings_frame, textvariable=self.check_delay_var, width=7).grid(row=2, column=1, padx=5)
+        check_delay_entry = ttk.Entry(settings_frame, textvariable=self.check_delay_var, width=7)
+        check_delay_entry.grid(row=2, column=1, padx=5)
         
         ttk.Label(settings_frame, text="结果检查间隔 (毫秒):").grid(row=2, column=2, padx=5, pady=5, sticky="w")
         self.result_delay_var = tk.StringVar(value="1500")
-        ttk.Entry(settings_frame, textvariable=self.result_delay_var, width=7).grid(row=2, column=3, padx=5)
+        result_delay_entry = ttk.Entry(settings_frame, textvariable=self.result_delay_var, width=7)
+        result_delay_entry.grid(row=2, column=3, padx=5)
 
         ttk.Label(settings_frame, text="重新提交间隔 (毫秒):").grid(row=2, column=4, padx=5, pady=5, sticky="w")
         self.resubmit_delay_var = tk.StringVar(value="500")
-        ttk.Entry(settings_frame, textvariable=self.resubmit_delay_var, width=7).grid(row=2, column=5, padx=5)
+        resubmit_delay_entry = ttk.Entry(settings_frame, textvariable=self.resubmit_delay_var, width=7)
+        resubmit_delay_entry.grid(row=2, column=5, padx=5)
+
+        # Settings are parsed into the engine as they are edited, so clicks only send
+        ttk.Style().configure("Invalid.TEntry", foreground="red", fieldbackground=INVALID_BACKGROUND)
+        global_fields = {
+            "targetHour": (self.hour_var, hour_entry),
+            "targetMinute": (self.min_var, min_entry),
+            "targetSecond": (self.sec_var, sec_entry),
+            "decrementValue": (self.decrement_var, decrement_entry),
+            "checkDelay": (self.check_delay_var, check_delay_entry),
+            "resultCheckDelay": (self.result_delay_var, result_delay_entry),
+            "resubmitDelay": (self.resubmit_delay_var, resubmit_delay_entry),
+        }
+        for field, (var, entry) in global_fields.items():
+            self.engine.globals.set_text(field, var.get())
+            var.trace_add("write", lambda *a, f=field, v=var, e=entry: self.on_global_edited(f, v, e))
+        self.server_fire_var.trace_add("write", lambda *a: setattr(self.engine, "server_fire", self.server_fire_var.get()))
 
         # --- Product List ---
         list_frame = ttk.LabelFrame(main_frame, text="已连接商品", padding="10")
         list_frame.pack(fill=tk.BOTH, expand=True, pady=5)
 
-        canvas = tk.Canvas(list_frame)
-        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=canvas.yview)
-        self.scrollable_frame = ttk.Frame(canvas)
-        self.current_row = 0
-        self.current_col = 0
-
-        self.scrollable_frame.bind("<Configure>", lambda e: canvas.configure(scrollregion=canvas.bbox("all")))
-        canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scrollbar.set)
-
-        # Configure columns to expand equally for 3-column layout
-        for i in range(3):
-            self.scrollable_frame.grid_columnconfigure(i, weight=1)
-
-        canvas.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
+        self.card_grid = VirtualCardGrid(list_frame, columns=3, on_edit=self.on_card_edited,
+                                         sync_status=self.engine.settings_status, ladder_rows=self.engine.product_ladder,
+                                         on_preview=self.preview_ladder, post=self.ui.post)
 
         # --- Action Buttons ---
         action_frame = ttk.Frame(main_frame)
@@ -181,6 +620,24 @@ class ControlPanelApp:
         self.browser_grid_button = ttk.Button(action_frame, text="Browser Grid Arranger", command=self.run_browser_grid_arranger)
         self.browser_grid_button.pack(side=tk.LEFT, padx=5)
 
+        self.export_telemetry_button = ttk.Button(action_frame, text="导出遥测", command=self.export_telemetry)
+        self.export_telemetry_button.pack(side=tk.LEFT, padx=5)
+
+        self.import_settings_button = ttk.Button(action_frame, text="导入设置", command=self.import_settings)
+        self.import_settings_button.pack(side=tk.LEFT, padx=5)
+
+        # Enabled once the store has loaded (apply_loaded_settings), so exporting never waits on the disk
+        self.export_settings_button = ttk.Button(action_frame, text="导出设置", command=self.export_settings, state=tk.DISABLED)
+        self.export_settings_button.pack(side=tk.LEFT, padx=5)
+
+        self.preview_slots_button = ttk.Button(action_frame, text="预览时间线", command=self.preview_fire_slots)
+        self.preview_slots_button.pack(side=tk.LEFT, padx=5)
+
+        # --- Run Telemetry Summary ---
+        self.telemetry_summary_var = tk.StringVar(value="本轮遥测: 无")
+        ttk.Label(main_frame, textvariable=self.telemetry_summary_var, anchor="w").pack(fill=tk.X)
+        self.telemetry_refresh_pending = False
+
         # --- Status Bar ---
         self.status_var = tk.StringVar(value="初始化中...")
         status_bar = ttk.Label(master, textvariable=self.status_var, relief=tk.SUNKEN, anchor="w")
@@ -189,13 +646,32 @@ class ControlPanelApp:
         # Start updating current system time display
         self.update_live_system_time()
 
+        # Load the grid arranger (pywin32 imports, window backend) once the window is up, so the first click is instant
+        master.after(1000, lambda: threading.Thread(target=self.get_arranger, name="ArrangerPrewarm", daemon=True).start())
+
+    def get_arranger(self):
+        """The shared in-process arranger service; imported and created on first use."""
+        with self.arranger_lock:
+            if self.arranger is None:
+                browser_grid_arranger = importlib.import_module("browser_grid_arranger")
+                self.arranger = browser_grid_arranger.GridArranger()
+                log.info("Browser grid arranger loaded")
+            return self.arranger
+
     def run_browser_grid_arranger(self):
+        """Shows the arranger in a Toplevel; repeat clicks raise the open one."""
+        if self.arranger_window is not None and self.arranger_window.winfo_exists():
+            self.arranger_window.deiconify()
+            self.arranger_window.lift()
+            return
         try:
-            subprocess.Popen(['python', 'browser_grid_arranger.py'])
-            self.update_status("Started Browser Grid Arranger")
-        except FileNotFoundError:
-            self.update_status("Error: 'python' command not found or browser_grid_arranger.py not found.")
+            arranger = self.get_arranger()
+            window = tk.Toplevel(self.master)
+            importlib.import_module("browser_grid_arranger").BrowserGridArrangerApp(window, arranger)
+            self.arranger_window = window
+            self.update_status("已打开浏览器网格排列工具")
         except Exception as e:
+            log.error(f"Error starting Browser Grid Arranger: {e}", exc_info=True)
             self.update_status(f"Error starting Browser Grid Arranger: {e}")
 
     def update_live_system_time(self):
@@ -206,8 +682,18 @@ class ControlPanelApp:
         self.master.after(1000, self.update_live_system_time) # Schedule next update in 1 second
 
     def update_status(self, text):
+        """Shows a status line; of several posted within one tick only the last is shown and logged."""
+        self.ui.post("status", self.show_status, text)
+
+    def show_status(self, text):
         self.status_var.set(text)
-        logging.info(f"Status Update: {text}")
+        status_log.info("Status Update: %s", text)
+
+    def update_connection_status(self):
+        self.ui.post("status", self.show_connection_status) # Built once per tick, however many tabs came and went
+
+    def show_connection_status(self):
+        self.show_status(f"监听中: {self.engine.url}. 已连接客户端: {self.engine.client_count()}")
 
     def set_time_plus_30s(self):
         now = datetime.now() + timedelta(seconds=30)
@@ -215,220 +701,419 @@ class ControlPanelApp:
         self.min_var.set(now.strftime("%M"))
         self.sec_var.set(now.strftime("%S"))
 
-    def add_product_card(self, product_id, image_url, websocket):
+    def add_product_card(self, product_id, image_url):
         if product_id in self.product_cards:
-            logging.warning(f"Card for product {product_id} already exists.")
+            log.warning(f"Card for product {product_id} already exists.")
             return
 
-        card = ttk.Frame(self.scrollable_frame, padding="2", relief=tk.RIDGE, borderwidth=1)
-        card.grid(row=self.current_row, column=self.current_col, padx=2, pady=2, sticky="nsew")
+        model = CardModel(product_id, image_url)
+        self.product_cards[product_id] = model
+        saved = self.store.get(product_id)
+        if saved:
+            self.hydrate_card(model, saved)
+        else:
+            self.push_card_params(model)
+        self.card_grid.add(model)
+        self.load_image(model)
+        self.update_connection_status()
+        log.info(f"Added card for product {product_id}")
 
-        # Image
-        img_label = ttk.Label(card, text="加载图片中...")
-        img_label.grid(row=0, column=0, rowspan=3, padx=2, pady=2)
-        threading.Thread(target=self.load_image, args=(image_url, img_label), daemon=True).start()
+    def apply_loaded_settings(self):
+        """Fills the cards that were added while the settings store was still loading, and allows exporting."""
+        self.export_settings_button.config(state=tk.NORMAL)
+        filled = 0
+        for product_id, model in self.product_cards.items():
+            saved = self.store.get(product_id)
+            if saved:
+                self.hydrate_card(model, saved)
+                self.card_grid.reload(product_id)
+                filled += 1
+        if filled:
+            log.info(f"Filled {filled} cards from settings loaded after they connected")
 
-        # Info
-        ttk.Label(card, text=f"商品ID: {product_id}", font=("Helvetica", 10, "bold")).grid(row=0, column=1, sticky="w", padx=5)
+    def hydrate_card(self, model, saved):
+        """Fills a card from saved settings (settings_store fields) and parses them into the engine."""
+        for field, saved_field in CARD_SETTINGS_FIELDS.items():
+            if saved_field in saved:
+                setattr(model, field, saved[saved_field])
+        self.push_card_params(model)
 
-        # Min Values (changed to Text widget)
-        ttk.Label(card, text="最低值(每行一个):").grid(row=1, column=1, sticky="nw", padx=5)
-        min_values_text = tk.Text(card, width=10, height=3) # Text widget for multi-line input
-        min_values_text.grid(row=1, column=2, sticky="w", padx=5)
-        min_values_text.insert(tk.END, "0.0") # Default value
-
-        # SKU Prices
-        ttk.Label(card, text="SKU价格(每行一个):").grid(row=1, column=3, sticky="nw", padx=5) # Use "nw" for alignment
-        sku_prices_text = tk.Text(card, width=15, height=3) # Text widget for multi-line input
-        sku_prices_text.grid(row=1, column=4, sticky="w", padx=5)
-        sku_prices_text.insert(tk.END, "0.0") # Default value
+    def push_card_params(self, model):
+        """Parses every field of a card into the engine's parameter model."""
+        params = self.engine.product(model.product_id)
+        params.set_auto_decrement(model.auto_decrement)
+        params.set_ladder_strategy(model.ladder_strategy)
+        for field, param_field in CARD_PARAM_FIELDS.items():
+            params.set_text(param_field, getattr(model, field))
+        self.mark_invalid(model, params)
 
-        # Auto Decrement
-        auto_decrement_var = tk.BooleanVar(value=True)
-        ttk.Checkbutton(card, text="自动递减", variable=auto_decrement_var).grid(row=2, column=1, columnspan=2, sticky="w", padx=5)
-
-        self.product_cards[product_id] = {
-            "frame": card,
-            "min_values_text": min_values_text, # Store the text widget
-            "sku_prices_text": sku_prices_text, # Store the text widget
-            "auto_decrement_var": auto_decrement_var,
-            "websocket": websocket
-        }
-        self.update_status(f"监听中: ws://localhost:8765. 已连接客户端: {len(self.ws_server.clients)}")
-        logging.info(f"Added card for product {product_id}")
+    def mark_invalid(self, model, params):
+        model.invalid = {f for f, param_field in CARD_PARAM_FIELDS.items() if param_field in params.errors}
+        if "lengths" in params.errors:
+            model.invalid |= {"min_values_text", "sku_prices_text"}
 
-        self.current_col += 1
-        if self.current_col >= 3:
-            self.current_col = 0
-            self.current_row += 1
+    def card_settings(self, model):
+        return {saved_field: getattr(model, field) for field, saved_field in CARD_SETTINGS_FIELDS.items()}
 
     def remove_product_card(self, product_id):
         if product_id in self.product_cards:
-            self.product_cards[product_id]["frame"].destroy()
             del self.product_cards[product_id]
-            self.update_status(f"监听中: ws://localhost:8765. 已连接客户端: {len(self.ws_server.clients)}")
-            logging.info(f"Removed card for product {product_id}")
+            self.card_grid.remove(product_id)
+            self.update_connection_status()
+            log.info(f"Removed card for product {product_id}")
+
+    def update_clock_info(self, product_id, offset_ms, rtt_ms):
+        session = self.engine.server.sessions.get(product_id)
+        protocol = session.protocol if session else 1
+        self.set_card_clock_text(product_id, f"时钟偏差: {offset_ms:+.0f}ms  RTT: {rtt_ms:.1f}ms  协议 v{protocol}")
+
+    def set_card_clock_text(self, product_id, text):
+        model = self.product_cards.get(product_id)
+        if model:
+            model.clock_text = text
+            slot = self.card_grid.slot_for(product_id)
+            if slot:
+                slot.clock_var.set(text)
+
+    def update_telemetry(self, product_id, summary):
+        model = self.product_cards.get(product_id)
+        if model:
+            state = summary["outcome"] or summary["state"]
+            parts = [TELEMETRY_LABELS.get(state, state)]
+            if summary["clicks"]:
+                parts.append(f"点击 {summary['clicks']} 次")
+            if summary["fire_to_first_click_ms"] is not None:
+                parts.append(f"触发→点击 {summary['fire_to_first_click_ms']:.0f}ms")
+            if summary["click_to_result_ms"] is not None:
+                parts.append(f"点击→结果 {summary['click_to_result_ms']:.0f}ms")
+            if summary["resubmits"]:
+                parts.append(f"重新提交 {summary['resubmits']} 次")
+            model.telemetry_text = "  ".join(parts)
+            slot = self.card_grid.slot_for(product_id)
+            if slot:
+                slot.telemetry_var.set(model.telemetry_text)
+        if not self.telemetry_refresh_pending:
+            # Aggregates are recomputed at most twice a second, not per event
+            self.telemetry_refresh_pending = True
+            self.master.after(500, self.refresh_telemetry_summary)
+
+    def clear_telemetry(self):
+        """A new run replaces the previous run's timelines."""
+        for product_id, model in self.product_cards.items():
+            model.telemetry_text = ""
+            slot = self.card_grid.slot_for(product_id)
+            if slot:
+                slot.telemetry_var.set("")
+        self.refresh_telemetry_summary()
+
+    def refresh_telemetry_summary(self):
+        self.telemetry_refresh_pending = False
+        stats = self.engine.server.telemetry.stats()
+        fmt = lambda p: f"p50 {p['p50']:.0f}ms / p95 {p['p95']:.0f}ms" if p else "-"
+        outcomes = ", ".join(f"{TELEMETRY_LABELS.get(k, k)} {v}" for k, v in stats["outcomes"].items()) or "进行中"
+        summary = (f"本轮遥测 #{stats['run']} ({stats['products']} 个): {outcomes}"
+                   f" | 触发延迟 {fmt(stats['fire_lateness_ms'])}"
+                   f" | 触发→点击 {fmt(stats['fire_to_first_click_ms'])}"
+                   f" | 点击→结果 {fmt(stats['click_to_result_ms'])}")
+        if stats["resubmits_per_success"] is not None:
+            summary += f" | 重新提交/成功 {stats['resubmits_per_success']:.2f}"
+        self.telemetry_summary_var.set(summary)
+
+    def export_telemetry(self):
+        from tkinter import filedialog
+        path = filedialog.asksaveasfilename(
+            title="导出遥测", defaultextension=".json", filetypes=[("JSON", "*.json")],
+            initialfile=f"telemetry_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        if not path:
+            return
+        future = self.engine.submit(self.engine.export_telemetry(path))
+        future.add_done_callback(lambda f: self.ui.post(None, self.report_export, f, path))
+
+    def report_export(self, future, path):
+        try:
+            stats = future.result()
+            self.update_status(f"已导出第 {stats['run']} 轮遥测 ({stats['products']} 个商品) 到 {path}")
+        except Exception as e:
+            log.error(f"Telemetry export failed: {e}", exc_info=True)
+            self.update_status(f"错误: 遥测导出失败: {e}")
+
+    def set_card_connection(self, product_id, connected):
+        """The card and its settings survive a reconnect inside the engine's grace period."""
+        if connected:
+            self.set_card_clock_text(product_id, "已重连, 时钟同步中...")
+            log.info(f"Card for product {product_id} resumed")
+        else:
+            self.set_card_clock_text(product_id, f"连接断开, 保留 {self.engine.server.session_grace_period:.0f} 秒...")
+        self.update_connection_status()
+        self.card_grid.refresh_sync()
+
+    def load_image(self, model):
+        url = model.image_url
+        if not url:
+            model.image_text = "无图片"
+            self.refresh_card_image(model.product_id)
+            return
+        img = self.thumbnails.get_cached(url)
+        if img is not None:
+            self.show_image(model.product_id, url, img, None) # Seen before: no network at all
+            return
+        # Safely update the GUI from the main thread
+        self.thumbnails.load(url, lambda img, error: self.ui.post(("image", model.product_id), self.show_image,
+                                                                  model.product_id, url, img, error))
+
+    def show_image(self, product_id, url, img, error):
+        model = self.product_cards.get(product_id)
+        if model is None: # Card was removed while loading
+            return
+        if img is None:
+            model.image_text = "图片加载失败"
+            log.error(f"Failed to load image from {url}: {error}")
+        else:
+            from PIL import ImageTk
+            model.photo = ImageTk.PhotoImage(img)
+        self.refresh_card_image(product_id)
+
+    def refresh_card_image(self, product_id):
+        slot = self.card_grid.slot_for(product_id)
+        if slot:
+            slot.show_image()
+
+    def on_global_edited(self, field, var, entry):
+        error = self.engine.globals.set_text(field, var.get())
+        entry.config(style="Invalid.TEntry" if error else "TEntry")
+        if error:
+            self.update_status(f"错误: {error}")
+        self.card_grid.refresh_sync() # Every tab is out of date after a global change
+        if field == "decrementValue":
+            self.card_grid.refresh_ladders()
+
+    def on_submit_rate_edited(self):
+        text = self.submit_rate_var.get().strip()
+        try:
+            rate = float(text or 0)
+            if rate < 0:
+                raise ValueError(text)
+        except ValueError:
+            self.submit_rate_entry.config(style="Invalid.TEntry")
+            self.update_status(f"错误: 每秒最多提交无效: '{text}' (0 表示不限速)")
+            return
+        self.submit_rate_entry.config(style="TEntry")
+        self.engine.max_submits_per_second = rate
+
+    def on_card_edited(self, model, field):
+        """Parses one edited card field into the engine's parameter model."""
+        params = self.engine.product(model.product_id)
+        if field == "auto_decrement":
+            params.set_auto_decrement(model.auto_decrement)
+            error = params.errors.get("lengths")
+        elif field == "ladder_strategy":
+            params.set_ladder_strategy(model.ladder_strategy)
+            error = None
+        else:
+            error = params.set_text(CARD_PARAM_FIELDS[field], getattr(model, field))
+        self.mark_invalid(model, params)
+        self.store.put(model.product_id, self.card_settings(model))
+        if error:
+            log.warning(f"Product {model.product_id}: {error}")
+            self.update_status(f"商品 {model.product_id}: {error}")
+        slot = self.card_grid.slot_for(model.product_id)
+        if slot:
+            slot.show_sync()
+            slot.show_ladder()
+
+    def preview_ladder(self, model):
+        """Lists every resubmit step of a card's price ladder, as the tab would be armed with it now."""
+        rows = self.engine.product_ladder(model.product_id)
+        params = self.engine.product(model.product_id)
+        window = tk.Toplevel(self.master)
+        window.title(f"价格阶梯 - {model.product_id}")
+        text = tk.Text(window, width=60, height=min(25, len(rows) + 3))
+        text.pack(fill=tk.BOTH, expand=True)
+        lines = [f"策略: {STRATEGY_LABELS[params.ladder_strategy]}  {describe_ladder(rows)}",
+                 f"第 1 次: {' / '.join(f'{price:.2f}' for price in params.sku_prices)}"]
+        lines += [f"第 {i} 次: {' / '.join(f'{cents / 100:.2f}' for cents in row)}" for i, row in enumerate(rows, 2)]
+        text.insert(tk.END, "\n".join(lines))
+        text.config(state="disabled")
+
+    def preview_fire_slots(self):
+        """Shows the fire slots the current cards would get from '全部开始' now, in firing order."""
+        slots = self.engine.plan_fire_slots(list(self.product_cards))
+        rate = self.engine.max_submits_per_second
+        window = tk.Toplevel(self.master)
+        window.title("触发时间线")
+        text = tk.Text(window, width=90, height=min(30, len(slots) + 3))
+        text.pack(fill=tk.BOTH, expand=True)
+        lines = [describe_slots(slots, rate, self.engine.global_params["resubmitDelay"])]
+        first = slots[0]["slot_ms"] if slots else 0
+        for slot in slots:
+            at = datetime.fromtimestamp(slot["slot_ms"] / 1000).strftime("%H:%M:%S.%f")[:-3]
+            lines.append(f"{at}  +{slot['slot_ms'] - first:7.0f}ms  {slot['productId']}  优先级 {slot['priority']}"
+                         f"  偏移 {slot['offset_ms']:+.0f}ms  等待 {slot['wait_ms']:.0f}ms")
+        text.insert(tk.END, "\n".join(lines))
+        text.config(state="disabled")
 
-    def load_image(self, url, label):
+    def import_settings(self):
+        """Saves settings for many products from a CSV or JSON file; connected cards take them at once."""
+        from tkinter import filedialog
+        path = filedialog.askopenfilename(title="导入设置", filetypes=[("CSV / JSON", "*.csv *.json"), ("所有文件", "*.*")])
+        if not path:
+            return
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            img_data = response.content
-            img = Image.open(BytesIO(img_data))
-            # Set image size to 50x50 pixels
-            img.thumbnail((50, 50))
-            photo = ImageTk.PhotoImage(img)
-            
-            # Safely update the GUI from the main thread
-            def update_gui():
-                label.config(image=photo)
-                label.image = photo # Keep a reference!
-            
-            self.master.after(0, update_gui)
+            imported, errors = read_settings_file(path)
+        except (OSError, ValueError) as e:
+            log.error(f"Settings import from {path} failed: {e}")
+            self.update_status(f"错误: 设置导入失败: {e}")
+            return
+        for product_id, settings in imported.items():
+            self.store.put(product_id, settings)
+            model = self.product_cards.get(product_id)
+            if model is not None:
+                self.hydrate_card(model, settings)
+                self.card_grid.reload(product_id)
+        connected = sum(1 for product_id in imported if product_id in self.product_cards)
+        log.info(f"Imported settings for {len(imported)} products from {path} ({connected} connected, {len(errors)} skipped)")
+        status = f"已导入 {len(imported)} 个商品的设置 (其中 {connected} 个已连接)"
+        if errors:
+            log.warning(f"Skipped settings rows: {'; '.join(errors)}")
+            status += f", 跳过 {len(errors)} 条: {'; '.join(errors[:3])}" + (" ..." if len(errors) > 3 else "")
+        self.update_status(status)
 
+    def export_settings(self):
+        """Writes the saved settings of every product, including connected cards, as CSV or JSON."""
+        from tkinter import filedialog
+        path = filedialog.asksaveasfilename(
+            title="导出设置", defaultextension=".csv", filetypes=[("CSV", "*.csv"), ("JSON", "*.json")],
+            initialfile=f"settings_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+        if not path:
+            return
+        settings = self.store.all()
+        settings.update((product_id, self.card_settings(model)) for product_id, model in self.product_cards.items())
+        try:
+            write_settings_file(path, settings)
+        except OSError as e:
+            log.error(f"Settings export to {path} failed: {e}")
+            self.update_status(f"错误: 设置导出失败: {e}")
+            return
+        self.update_status(f"已导出 {len(settings)} 个商品的设置到 {path}")
+
+    def run_command(self, coro, label, note=""):
+        """Sends a command in the engine; its report, followed by `note`, becomes the status line."""
+        if not self.product_cards:
+            coro.close()
+            self.update_status(f"没有已连接的客户端, 未发送 '{label}' 命令。")
+            return
+        future = self.engine.submit(coro)
+        future.add_done_callback(lambda f: self.ui.post(None, self.report_broadcast, f, label, note))
+
+    def report_broadcast(self, future, label, note=""):
+        try:
+            report = future.result()
         except Exception as e:
-            def update_gui_fail():
-                label.config(text="图片加载失败")
-            self.master.after(0, update_gui_fail)
-            logging.error(f"Failed to load image from {url}: {e}")
+            log.error(f"Broadcast '{label}' failed: {e}", exc_info=True)
+            self.update_status(f"错误: '{label}' 命令发送失败: {e}")
+            return
+        sent, failed, skew_ms = report["sent"], report["failed"], report["skew_ms"]
+        status = f"已向 {len(sent)} 个客户端发送 '{label}' 命令, 发送偏差 {skew_ms:.1f}ms"
+        if report.get("up_to_date"):
+            status += f", {report['up_to_date']} 个已是最新"
+        acked = {**report.get("delivered", {}), **report.get("late", {})}
+        if acked:
+            status += f", 已确认 {len(acked)} 个 (最慢 {max(acked.values()):.0f}ms)"
+        if report.get("late"):
+            status += f", 其中 {len(report['late'])} 个重发后才确认"
+        if report.get("unconfirmed"):
+            status += f", {len(report['unconfirmed'])} 个旧脚本无法确认"
+        if failed:
+            status += f", 失败 {len(failed)} 个: {', '.join(map(str, failed))}"
+        if skew_ms > self.engine.server.max_fanout_skew_ms:
+            status += f" (超过上限 {self.engine.server.max_fanout_skew_ms:.0f}ms)"
+        if note:
+            status += f"; {note}"
+        self.update_status(status)
 
     def start_all_tasks(self):
-        logging.info("--- '全部开始' clicked ---")
+        log.info("--- '全部开始' clicked ---")
+        if self.refuse_invalid_globals("全部开始"):
+            return
         try:
-            # Gather fresh global parameters at the moment the button is clicked
-            global_params = {
-                "targetHour": int(self.hour_var.get()),
-                "targetMinute": int(self.min_var.get()),
-                "targetSecond": int(self.sec_var.get()),
-                "decrementValue": float(self.decrement_var.get()),
-                "checkDelay": int(self.check_delay_var.get()),
-                "resultCheckDelay": int(self.result_delay_var.get()),
-                "resubmitDelay": int(self.resubmit_delay_var.get()),
-            }
-            logging.info(f"Global parameters for start: {global_params}")
-
-            # Iterate through each client and send their specific settings with the start command
-            for product_id, card_info in self.product_cards.items():
-                min_values_str = card_info["min_values_text"].get("1.0", tk.END).strip()
-                min_values = []
-                for p in min_values_str.splitlines():
-                    p_stripped = p.strip()
-                    if p_stripped:
-                        try:
-                            min_values.append(float(p_stripped))
-                        except ValueError:
-                            logging.warning(f"Invalid min value input skipped for product {product_id}: '{p_stripped}'")
-
-                sku_prices_str = card_info["sku_prices_text"].get("1.0", tk.END).strip()
-                sku_prices = []
-                for p in sku_prices_str.splitlines():
-                    p_stripped = p.strip()
-                    if p_stripped:
-                        try:
-                            sku_prices.append(float(p_stripped))
-                        except ValueError:
-                            logging.warning(f"Invalid SKU price input skipped for product {product_id}: '{p_stripped}'")
-
-                specific_params = {
-                    "minValues": min_values, # Changed from minValue
-                    "skuPrices": sku_prices, # Changed from realPosValue
-                    "autoDecrement": card_info["auto_decrement_var"].get(),
-                    "randomDelay": random.randint(0, 500)  # Add a small random delay
-                }
-                
-                message = {
-                    "type": "start",
-                    "globalParams": global_params,
-                    "specificParams": specific_params
-                }
-                
-                asyncio.run_coroutine_threadsafe(
-                    self.ws_server.send_message(card_info["websocket"], message),
-                    self.ws_server.loop
-                )
-            self.update_status(f"已向 {len(self.product_cards)} 个客户端发送带有最新设置的 '开始' 命令。")
+            warning = period_warning(len(self.product_cards), self.engine.max_submits_per_second,
+                                     self.engine.global_params["resubmitDelay"])
+            self.run_command(self.engine.start_all(), "布防" if self.engine.server_fire else "开始", warning)
         except Exception as e:
-            logging.error(f"Error in start_all_tasks: {e}", exc_info=True)
+            log.error(f"Error in start_all_tasks: {e}", exc_info=True)
             self.update_status(f"错误: {e}")
 
+    def refuse_invalid_globals(self, label):
+        errors = self.engine.globals.errors
+        if errors:
+            self.update_status(f"全局设置无效, 未发送 '{label}' 命令: {'; '.join(errors.values())}")
+        return bool(errors)
+
     def stop_all_tasks(self):
-        logging.info("--- '全部停止' clicked ---")
-        message = {"type": "stop"}
-        for product_id, card_info in self.product_cards.items():
-            asyncio.run_coroutine_threadsafe(
-                self.ws_server.send_message(card_info["websocket"], message),
-                self.ws_server.loop # Use the loop created in the server thread
-            )
-        self.update_status(f"已向 {len(self.product_cards)} 个客户端发送 '停止' 命令。")
+        log.info("--- '全部停止' clicked ---")
+        self.run_command(self.engine.stop_all(), "停止")
 
     def apply_all_changes(self):
-        logging.info("--- '应用更改' clicked ---")
+        log.info("--- '应用更改' clicked ---")
+        if self.refuse_invalid_globals("应用更改"):
+            return
         try:
-            global_params = {
-                "targetHour": int(self.hour_var.get()),
-                "targetMinute": int(self.min_var.get()),
-                "targetSecond": int(self.sec_var.get()),
-                "decrementValue": float(self.decrement_var.get()),
-                "checkDelay": int(self.check_delay_var.get()),
-                "resultCheckDelay": int(self.result_delay_var.get()),
-                "resubmitDelay": int(self.resubmit_delay_var.get()),
-            }
-            logging.info(f"Global parameters for apply: {global_params}")
-
-            for product_id, card_info in self.product_cards.items():
-                min_values_str = card_info["min_values_text"].get("1.0", tk.END).strip()
-                min_values = []
-                for p in min_values_str.splitlines():
-                    p_stripped = p.strip()
-                    if p_stripped:
-                        try:
-                            min_values.append(float(p_stripped))
-                        except ValueError:
-                            logging.warning(f"Invalid min value input skipped for product {product_id}: '{p_stripped}'")
-
-                sku_prices_str = card_info["sku_prices_text"].get("1.0", tk.END).strip()
-                sku_prices = []
-                for p in sku_prices_str.splitlines():
-                    p_stripped = p.strip()
-                    if p_stripped:
-                        try:
-                            sku_prices.append(float(p_stripped))
-                        except ValueError:
-                            logging.warning(f"Invalid SKU price input skipped for product {product_id}: '{p_stripped}'")
-
-                specific_params = {
-                    "minValues": min_values, # Changed from minValue
-                    "skuPrices": sku_prices, # Changed from realPosValue
-                    "autoDecrement": card_info["auto_decrement_var"].get(),
-                }
-                
-                message = {
-                    "type": "apply_settings",
-                    "globalParams": global_params,
-                    "specificParams": specific_params
-                }
-                
-                asyncio.run_coroutine_threadsafe(
-                    self.ws_server.send_message(card_info["websocket"], message),
-                    self.ws_server.loop
-                )
-            self.update_status(f"已向 {len(self.product_cards)} 个客户端发送 '应用更改' 命令。")
+            self.run_command(self.engine.apply_all(), "应用更改")
         except Exception as e:
-            logging.error(f"Error in apply_all_changes: {e}", exc_info=True)
+            log.error(f"Error in apply_all_changes: {e}", exc_info=True)
             self.update_status(f"错误: {e}")
 
+    def on_engine_event(self, event, data):
+        """Engine events arrive on the server thread; hand them to the Tk thread through the update queue."""
+        post = self.ui.post
+        if event == "listening":
+            trace_startup("listening")
+            self.update_connection_status()
+        elif event == "client_registered":
+            post(None, self.add_product_card, data["product_id"], data["image_url"])
+        elif event == "client_removed":
+            post(None, self.remove_product_card, data["product_id"])
+        elif event == "client_disconnected":
+            post(("connection", data["product_id"]), self.set_card_connection, data["product_id"], False)
+        elif event == "client_resumed":
+            post(("connection", data["product_id"]), self.set_card_connection, data["product_id"], True)
+        elif event == "clock":
+            post(("clock", data["product_id"]), self.update_clock_info, data["product_id"], data["offset_ms"], data["rtt_ms"])
+        elif event in ("settings_sent", "settings_acked"):
+            post("refresh_sync", self.card_grid.refresh_sync)
+        elif event == "run_started":
+            post(None, self.clear_telemetry)
+        elif event == "telemetry":
+            post(("telemetry", data["product_id"]), self.update_telemetry, data["product_id"], data["summary"])
+        elif event == "fired":
+            report = data["report"]
+            self.update_status(f"已触发 {len(report['sent'])} 个客户端 (延迟 {data['lateness_ms']:.1f}ms, 偏差 {report['skew_ms']:.1f}ms)")
+
     def start_server_thread(self):
-        self.server_thread = threading.Thread(target=self.ws_server.start, daemon=True)
-        # The loop is now created and managed inside the thread's target function (self.ws_server.start)
-        self.server_thread.start()
+        # The loop is created and managed inside the engine's thread; does nothing if it is already running
+        self.engine.start_thread()
 
 if __name__ == "__main__":
-    logging.info("--- Application Starting ---")
+    log.info("--- Application Starting ---")
+    parser = argparse.ArgumentParser(description="中央控制面板")
+    parser.add_argument("--port", type=int, default=None, help="WebSocket port (default 8765)")
+    parser.add_argument("--shards", type=int, default=0, help="Worker processes for tab connections (see panel_shards.py)")
+    args = parser.parse_args()
+
+    # Bind the port and start the WebSocket server before building the window, so tabs can connect right away
+    engine = PanelEngine(port=args.port, shards=args.shards) if args.port else PanelEngine(shards=args.shards)
+    engine.start_thread()
+    trace_startup("bound")
+
     root = tk.Tk()
-    app = ControlPanelApp(root)
-    
-    # Start the WebSocket server in a separate thread
-    app.start_server_thread()
-    
+    app = ControlPanelApp(root, engine)
+    app.start_server_thread() # No-op here; starts the engine when the app is created without one
+
+    def on_first_map(event):
+        if event.widget is root:
+            root.unbind("<Map>")
+            trace_startup("window")
+    root.bind("<Map>", on_first_map)
+
     root.mainloop()
-    logging.info("--- Application Closed ---")
\ No newline at end of file
+    log.info("--- Application Closed ---")
@@ -0,0 +1,273 @@
+# delay_simulator.py
+#
+# Deterministic simulator for tuning the global delays (checkDelay, resultCheckDelay, resubmitDelay,
+# decrementValue) and the fire slot rate. It replays the userscript's run (wait for the product's
+# fire slot, click submit, wait resultCheckDelay, step down the price ladder, type the prices, wait
+# resubmitDelay and the next slot period, click again) against a modeled bidding backend on a
+# virtual clock, so thousands of products times a whole parameter sweep take seconds:
+#
+#   python delay_simulator.py --products 2000 --result-check-delay 600 1000 1500 --resubmit-delay 200 500 --output sweep.json
+#
+# The backend: a submission reaches the site after an upload latency and its answer comes back
+# after a download latency (each lognormal, median half of --latency-ms). It is accepted if every
+# SKU price is at or under the product's hidden acceptance price, the target time has passed, no
+# competitor has taken the slot yet (exponential, mean --slot-close-ms after the target) and the
+# product's previous submission arrived at least --min-gap-ms earlier. Once accepted the success
+# dialog stays up, and the tab sees it at its next result check.
+#
+# Products (prices, acceptance price, slot close time, per-attempt latencies, arm time) are
+# drawn once per seed and reused for every configuration, so configurations are compared on the
+# same products. Results are JSON, one object per configuration, best first.
+#
+# checkDelay only matters in poll mode. Since userscript 2.23 the tab's last clock check is clamped to
+# end on its slot, so checkDelay no longer delays the first click; it sets how often the tab wakes up
+# before the slot (clock_checks_per_tab). With --timer-align-ms (hidden tabs: the browser runs their
+# timers on whole-second boundaries) every wake, the last one included, waits for the next boundary,
+# and first_click_late_ms shows what that costs whatever checkDelay is.
+
+import argparse
+import heapq
+import itertools
+import json
+import math
+import platform
+import random
+import time
+from collections import Counter
+from datetime import datetime
+
+from panel_engine import percentiles
+from price_ladder import STRATEGIES, build_ladder
+import fire_slots
+
+TYPE_MS_PER_SKU = 100 # simulateRealisticTyping waits this long after setting each changed input
+
+
+class Product:
+    """One simulated product: the card's prices and the backend's hidden rules for it. Times are ms from the target."""
+
+    def __init__(self, index, args):
+        rng = random.Random(f"{args.seed}/{index}")
+        self.index = index
+        self.prices = [round(rng.uniform(5, 200), 2) for _ in range(rng.randint(1, args.max_skus))]
+        self.floors = [round(price * (1 - args.max_discount), 2) for price in self.prices]
+        accept_ratio = 1 - rng.uniform(0, args.accept_depth)
+        self.accept_cents = [math.floor(price * 100 * accept_ratio) for price in self.prices]
+        self.slot_close_ms = rng.expovariate(1 / args.slot_close_ms) if args.slot_close_ms else math.inf
+        self.armed_ms = -rng.uniform(args.arm_lead_ms / 2, args.arm_lead_ms) # When the start command arrived
+        self.latency_seed = rng.random()
+        self.median_leg_ms = args.latency_ms / 2
+        self.latency_sigma = args.latency_sigma
+        self.timer_phase_ms = rng.uniform(0, args.timer_align_ms) # Where this tab's timer boundaries fall
+        self.ladders = {} # Maps (strategy, decrement) to ladder rows (cents)
+        self.legs = [] # Drawn latencies, by attempt
+
+    def latencies(self, attempt):
+        """(upload, download) ms for the n-th submission; the same in every configuration."""
+        while len(self.legs) < attempt:
+            rng = random.Random(f"{self.latency_seed}/{len(self.legs) + 1}")
+            self.legs.append(tuple(rng.lognormvariate(math.log(self.median_leg_ms), self.latency_sigma)
+                                   if self.median_leg_ms > 0 else 0.0 for _ in range(2)))
+        return self.legs[attempt - 1]
+
+    def ladder(self, strategy, decrement):
+        key = (strategy, decrement)
+        if key not in self.ladders:
+            self.ladders[key] = build_ladder(strategy, self.prices, self.floors, decrement)
+        return self.ladders[key]
+
+
+class SimTab:
+    """
+    The userscript's startAutoClick state machine for one product, plus the backend's view of that
+    product. Products do not interact, so each tab runs on its own virtual clock: time jumps straight
+    from one click or check to the next, and submissions in flight wait in a heap until they arrive.
+    """
+
+    def __init__(self, product, slot_ms, config, args):
+        self.product = product
+        self.slot_ms = slot_ms # From fire_slots.plan
+        self.config = config
+        self.args = args
+        self.ladder = product.ladder(args.strategy, config["decrementValue"])
+        self.row = [round(price * 100) for price in product.prices]
+        self.attempt = 0
+        self.first_click_ms = None
+        self.clock_checks = 0 # Poll mode: checkTargetTime runs before the first click
+        self.premature_checks = 0 # Result checks that ran while an accepting answer was on its way
+        self.outcome = "timeout"
+        self.done_ms = None
+        # Backend state
+        self.in_flight = [] # (arrival ms, attempt, row, download ms)
+        self.last_arrival_ms = -math.inf
+        self.accepted_row = None
+        self.dialog_ms = None # When the success dialog appears on the page
+
+    def first_click(self):
+        if self.config["mode"] == "fire":
+            # Armed tabs click when the panel's fire frame for their slot arrives
+            return self.slot_ms + self.args.fire_ms
+        # Polling: checkTargetTime runs every checkDelay, the last wait clamped to end on the slot
+        check_delay, align_ms = self.config["checkDelay"], self.args.timer_align_ms
+        now = self.product.armed_ms
+        if not align_ms:
+            self.clock_checks = 1 + max(0, math.ceil((self.slot_ms - now) / check_delay)) if check_delay > 0 else 1
+            return max(self.slot_ms, now)
+        phase_ms = self.product.timer_phase_ms
+        while True:
+            self.clock_checks += 1
+            if now >= self.slot_ms:
+                return now
+            wake_ms = now + min(check_delay, self.slot_ms - now)
+            now = phase_ms + math.ceil((wake_ms - phase_ms) / align_ms) * align_ms
+
+    def resubmit_at(self, ready_ms, period_ms):
+        """The userscript's resubmitWait: the first slot period boundary after resubmitDelay has passed."""
+        if not period_ms:
+            return ready_ms
+        periods = math.ceil((ready_ms - self.first_click_ms) / period_ms)
+        return self.first_click_ms + periods * period_ms
+
+    def run(self, horizon_ms, period_ms):
+        now = self.first_click_ms = self.first_click()
+        while now <= horizon_ms:
+            self.attempt += 1
+            upload_ms, download_ms = self.product.latencies(self.attempt)
+            heapq.heappush(self.in_flight, (now + upload_ms, self.attempt, self.row, download_ms))
+            now += self.config["resultCheckDelay"]
+            while self.in_flight and self.in_flight[0][0] <= now:
+                self.arrive(*heapq.heappop(self.in_flight))
+            if now > horizon_ms:
+                return
+            if self.check(now):
+                self.done_ms = now
+                return
+            next_row = self.ladder[self.attempt - 1]
+            typing_ms = TYPE_MS_PER_SKU * sum(1 for old, new in zip(self.row, next_row) if old != new)
+            self.row = next_row
+            now = self.resubmit_at(now + typing_ms + self.config["resubmitDelay"], period_ms)
+
+    def arrive(self, now, attempt, row, download_ms):
+        """The backend receives a submission."""
+        too_soon = now - self.last_arrival_ms < self.args.min_gap_ms
+        self.last_arrival_ms = now
+        if self.accepted_row is not None or too_soon or now < 0 or now > self.product.slot_close_ms:
+            return
+        if all(cents <= limit for cents, limit in zip(row, self.product.accept_cents)):
+            self.accepted_row = row
+            self.dialog_ms = now + download_ms
+
+    def check(self, now):
+        """The result check; True once the run is over."""
+        if self.dialog_ms is not None and self.dialog_ms <= now:
+            self.outcome = "success"
+            return True
+        self.premature_checks += self.dialog_ms is not None
+        if self.attempt > len(self.ladder):
+            self.outcome = "min_reached"
+            return True
+        return False
+
+
+def simulate(products, config, args):
+    rate = config["maxSubmitsPerSecond"]
+    slots = {slot["productId"]: slot["slot_ms"] for slot in fire_slots.plan([(product.index, 0.0, 0, 0.0) for product in products], rate)}
+    period_ms = fire_slots.period_ms(len(products), rate)
+    tabs = [SimTab(product, slots[product.index], config, args) for product in products]
+    for tab in tabs:
+        tab.run(args.horizon_ms, period_ms)
+    return summarize(tabs, config)
+
+
+def summarize(tabs, config):
+    outcomes = Counter(tab.outcome for tab in tabs)
+    successes = [tab for tab in tabs if tab.outcome == "success"]
+    drops = [1 - sum(tab.accepted_row) / sum(round(price * 100) for price in tab.product.prices) for tab in successes]
+    return {
+        "config": config,
+        "products": len(tabs),
+        "outcomes": dict(outcomes),
+        "success_rate": len(successes) / len(tabs) if tabs else 0.0,
+        "time_to_success_ms": percentiles([tab.done_ms for tab in successes]),
+        "attempts_per_success": percentiles([tab.attempt for tab in successes]),
+        "attempts_per_product": sum(tab.attempt for tab in tabs) / len(tabs) if tabs else 0.0,
+        "first_click_ms": percentiles([tab.first_click_ms for tab in tabs]),
+        "first_click_late_ms": percentiles([tab.first_click_ms - max(tab.slot_ms, tab.product.armed_ms) for tab in tabs]),
+        "clock_checks_per_tab": sum(tab.clock_checks for tab in tabs) / len(tabs) if tabs else 0.0,
+        "premature_checks": sum(tab.premature_checks for tab in tabs), # Resubmits made while a success was on its way
+        "accepted_undetected": sum(1 for tab in tabs if tab.accepted_row is not None and tab.outcome != "success"),
+        "price_drop_pct": 100 * sum(drops) / len(drops) if drops else None,
+    }
+
+
+def sweep_configs(args):
+    configs = []
+    for mode in args.mode:
+        # checkDelay is only used by polling tabs; fire mode runs once with the first value
+        check_delays = args.check_delay if mode == "poll" else args.check_delay[:1]
+        for values in itertools.product(check_delays, args.result_check_delay, args.resubmit_delay,
+                                        args.max_submits_per_second, args.decrement):
+            configs.append(dict(zip(("checkDelay", "resultCheckDelay", "resubmitDelay", "maxSubmitsPerSecond",
+                                     "decrementValue"), values), mode=mode))
+    return configs
+
+
+def rank_key(result):
+    """Most successes first, then the smallest price drop, then the fastest median success."""
+    median = (result["time_to_success_ms"] or {}).get("p50", math.inf)
+    drop = result["price_drop_pct"] if result["price_drop_pct"] is not None else math.inf
+    return -round(result["success_rate"], 3), round(drop, 2), median
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate bidding runs on a virtual clock to tune the panel's delay settings")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", nargs="+", choices=["fire", "poll"], default=["fire", "poll"],
+                        help="fire: server-pushed trigger; poll: the tab checks the clock itself")
+    parser.add_argument("--check-delay", type=int, nargs="+", default=[500], help="Poll mode clock check interval")
+    parser.add_argument("--result-check-delay", type=int, nargs="+", default=[1500])
+    parser.add_argument("--resubmit-delay", type=int, nargs="+", default=[500])
+    parser.add_argument("--max-submits-per-second", type=float, nargs="+", default=[0.0], help="Fire slot rate (0: no limit)")
+    parser.add_argument("--decrement", type=float, nargs="+", default=[0.1])
+    parser.add_argument("--strategy", choices=sorted(STRATEGIES), default="linear")
+    # Backend model
+    parser.add_argument("--latency-ms", type=float, default=400.0, help="Median submit round trip")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Lognormal spread of each leg")
+    parser.add_argument("--accept-depth", type=float, default=0.05, help="Acceptance price is up to this fraction under the start price")
+    parser.add_argument("--max-discount", type=float, default=0.1, help="Card minimums are this fraction under the start price")
+    parser.add_argument("--slot-close-ms", type=float, default=20000.0, help="Mean time until a competitor takes the slot (0: never)")
+    parser.add_argument("--min-gap-ms", type=float, default=0.0, help="Submissions arriving closer together than this are ignored")
+    parser.add_argument("--max-skus", type=int, default=3)
+    parser.add_argument("--arm-lead-ms", type=float, default=30000.0, help="Tabs are started up to this long before the target")
+    parser.add_argument("--timer-align-ms", type=float, default=0.0,
+                        help="Poll mode: tab timers fire on boundaries this far apart (1000 for a hidden tab, 0: on time)")
+    parser.add_argument("--fire-ms", type=float, default=2.0, help="Panel-to-tab delivery of the fire frame")
+    parser.add_argument("--horizon-ms", type=float, default=120000.0, help="Simulated time after the target")
+    parser.add_argument("--output", help="Write results JSON here instead of stdout")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    products = [Product(index, args) for index in range(args.products)]
+    results = sorted((simulate(products, config, args) for config in sweep_configs(args)), key=rank_key)
+
+    output = {
+        "benchmark": "delay_simulator",
+        "format": 1,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "model": {key: value for key, value in vars(args).items() if key != "output"},
+        "elapsed_s": time.perf_counter() - started,
+        "results": results,
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
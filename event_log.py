@@ -0,0 +1,132 @@
+# event_log.py
+#
+# Non-blocking structured logging. Records are put on an in-memory queue by the
+# calling thread (no disk I/O, and no formatting unless the args are mutable) and written as JSONL by a background
+# listener thread, with size- and time-based rotation. Categories are logger names
+# ("panel.send", "panel.recv", ...) and can be given their own level or a sample rate.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+
+class JsonLineFormatter(logging.Formatter):
+    """One JSON object per line: wall time, monotonic time, level, category, message, optional fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "mono": round(getattr(record, "mono", 0.0), 6),
+            "lvl": record.levelname,
+            "cat": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotates when the file exceeds maxBytes or when interval seconds have passed, whichever comes first."""
+
+    def __init__(self, filename, maxBytes=0, backupCount=0, interval=None, encoding="utf-8"):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, encoding=encoding)
+        self.interval = interval
+        self.next_rollover = time.time() + interval if interval else None
+
+    def shouldRollover(self, record):
+        if self.next_rollover is not None and time.time() >= self.next_rollover:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.next_rollover = time.time() + self.interval
+
+
+class CategorySampler(logging.Filter):
+    """
+    Keeps one record in every round(1 / rate) per category; rate 1.0 keeps all.
+    Counting instead of random() keeps the sampled log deterministic.
+    Warnings and above are never sampled out.
+    """
+
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.every = {category: max(1, round(1 / rate)) for category, rate in sample_rates.items() if rate > 0}
+        self.dropped = {category for category, rate in sample_rates.items() if rate <= 0}
+        self.counts = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        category = record.name
+        if category in self.dropped:
+            return False
+        every = self.every.get(category)
+        if every is None or every == 1:
+            return True
+        count = self.counts.get(category, 0)
+        self.counts[category] = count + 1
+        return count % every == 0
+
+
+MUTABLE_ARGS = (dict, list, set)
+
+
+class FastQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues the record as-is; message formatting happens on the listener thread. A record whose args hold
+    a dict, list or set is formatted here instead, since the caller may change that container after logging it.
+    """
+
+    def prepare(self, record):
+        record.mono = time.monotonic()
+        args = record.args
+        if args and (isinstance(args, MUTABLE_ARGS) or any(isinstance(arg, MUTABLE_ARGS) for arg in args)):
+            record.msg, record.args = record.getMessage(), None
+        return record
+
+
+def setup_logging(filename, level=logging.INFO, max_bytes=10 * 1024 * 1024, backup_count=5,
+                  rotate_interval=24 * 3600, category_levels=None, sample_rates=None, console=False):
+    """
+    Routes all logging through a queue to a background JSONL writer. Returns the QueueListener,
+    which is stopped (and flushed) at interpreter exit.
+    """
+    log_queue = queue.SimpleQueue()
+    file_handler = SizeAndTimeRotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count,
+                                                  interval=rotate_interval)
+    file_handler.setFormatter(JsonLineFormatter())
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler(sys.stderr)
+        console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+        handlers.append(console_handler)
+
+    queue_handler = FastQueueHandler(log_queue)
+    if sample_rates:
+        queue_handler.addFilter(CategorySampler(sample_rates))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for category, category_level in (category_levels or {}).items():
+        logging.getLogger(category).setLevel(category_level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
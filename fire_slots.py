@@ -0,0 +1,101 @@
+# fire_slots.py
+#
+# Fire slots: when each product's tab submits. Instead of every tab clicking at its deadline (plus a
+# random 0-500 ms delay), the panel gives each product a deterministic slot. Slots are at least
+# 1000 / rate ms apart across the whole fleet; products are placed highest priority first, so they
+# keep the earliest slots, each at the first free time at or after its deadline plus its own offset.
+# Resubmits stay spread too: a tab's retries only go out on its own slot plus whole periods, where
+# the period is the time the fleet needs to submit once at the rate limit (count * 1000 / rate: 1000
+# tabs at 50/s retry every 20 s). The period is not capped, as that would break the rate limit;
+# period_warning says when it outgrows resubmitDelay. Nothing here depends on the GUI; the same
+# inputs always give the same plan.
+
+from bisect import bisect_right
+
+
+def spacing_ms(rate):
+    """Minimum gap between two submissions for a rate in submissions per second; 0 means no limit."""
+    return 1000.0 / rate if rate > 0 else 0.0
+
+
+def period_ms(count, rate):
+    """How long the fleet of `count` tabs needs to submit once at the rate limit (0 without a limit)."""
+    return round(count * spacing_ms(rate), 3)
+
+
+def period_warning(count, rate, resubmit_delay_ms):
+    """Status text when the resubmit period makes retries wait longer than resubmitDelay, else ""."""
+    period = period_ms(count, rate)
+    if period <= resubmit_delay_ms:
+        return ""
+    return (f"警告: {count} 个标签页每秒最多 {rate:g} 次, 重新提交周期 {period / 1000:.1f}s,"
+            f" 超过重新提交延迟 {resubmit_delay_ms}ms; 提高每秒最多提交或设为 0")
+
+
+class SlotRuns:
+    """
+    Taken slots kept as runs of evenly spaced times (first, first + gap, ..., last). A packed fleet is a
+    few long runs, so finding the next free time skips whole runs instead of walking every slot.
+    """
+
+    EPSILON = 1e-6 # ms; slots this close to a run's next position extend the run
+
+    def __init__(self, gap):
+        self.gap = gap
+        self.firsts = []
+        self.lasts = []
+
+    def take(self, wanted):
+        """Takes and returns the first time >= wanted that is at least gap from every taken time."""
+        gap, firsts, lasts = self.gap, self.firsts, self.lasts
+        i = bisect_right(firsts, wanted) - 1 # The last run starting at or before wanted
+        slot = wanted
+        if i >= 0 and lasts[i] + gap > slot:
+            slot = lasts[i] + gap
+        i += 1
+        while i < len(firsts) and firsts[i] - gap < slot - self.EPSILON:
+            slot = lasts[i] + gap
+            i += 1
+        joins_previous = i > 0 and abs(lasts[i - 1] + gap - slot) < self.EPSILON
+        joins_next = i < len(firsts) and abs(firsts[i] - gap - slot) < self.EPSILON
+        if joins_previous and joins_next:
+            lasts[i - 1] = lasts.pop(i)
+            firsts.pop(i)
+        elif joins_previous:
+            lasts[i - 1] = slot
+        elif joins_next:
+            firsts[i] = slot
+        else:
+            firsts.insert(i, slot)
+            lasts.insert(i, slot)
+        return slot
+
+
+def plan(requests, rate):
+    """
+    Assigns fire slots. `requests` holds (product_id, deadline_ms, priority, offset_ms); a higher priority
+    is placed first. Returns one dict per product, in slot order: productId, slot_ms, deadline_ms, priority,
+    offset_ms and wait_ms (how far past its deadline plus offset the slot landed).
+    """
+    gap = spacing_ms(rate)
+    ordered = sorted(requests, key=lambda r: (-r[2], r[1] + r[3], r[0]))
+    taken, slots = SlotRuns(gap), []
+    for product_id, deadline_ms, priority, offset_ms in ordered:
+        wanted = deadline_ms + offset_ms
+        slot = round(taken.take(wanted), 3) if gap else wanted
+        slots.append({"productId": product_id, "slot_ms": slot, "deadline_ms": deadline_ms, "priority": priority,
+                      "offset_ms": offset_ms, "wait_ms": round(slot - wanted, 3)})
+    slots.sort(key=lambda s: (s["slot_ms"], s["productId"]))
+    return slots
+
+
+def describe(slots, rate, resubmit_delay_ms=None):
+    """Short status text for a plan: how many slots, over what span, the longest wait and any period_warning."""
+    if not slots:
+        return "没有可排程的商品"
+    span = slots[-1]["slot_ms"] - slots[0]["slot_ms"]
+    limit = f"每秒最多 {rate:g} 次" if rate > 0 else "不限速"
+    text = (f"{len(slots)} 个时隙, {limit}, 跨度 {span:.0f}ms, 最长等待 {max(s['wait_ms'] for s in slots):.0f}ms,"
+            f" 重新提交周期 {period_ms(len(slots), rate):.0f}ms")
+    warning = period_warning(len(slots), rate, resubmit_delay_ms) if resubmit_delay_ms is not None else ""
+    return f"{text}\n{warning}" if warning else text
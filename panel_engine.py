@@ -0,0 +1,1531 @@
+# panel_engine.py
+#
+# GUI-independent orchestration engine: client registry, parameters, time sync,
+# trigger scheduling and broadcast. The Tk control panel is one optional front end
+# subscribed to engine events; `python panel_engine.py --config panel_config.json`
+# runs the same engine headless with a local line-JSON control API.
+
+import asyncio
+import contextlib
+import functools
+import os
+import socket
+import threading
+import json
+import logging
+import math
+import argparse
+from datetime import datetime
+import time
+from collections import Counter, deque, namedtuple
+import heapq
+import itertools
+import zlib
+from event_log import setup_logging
+import price_ladder
+import fire_slots
+
+try:
+    import tomllib # Python 3.11+
+except ImportError:
+    tomllib = None
+
+websockets = None # Imported by load_websockets() on the server thread, off the GUI's startup path
+
+def load_websockets():
+    global websockets
+    if websockets is None:
+        import websockets as module
+        websockets = module
+    return websockets
+
+# Log categories; see event_log.py for per-category levels and sampling
+log = logging.getLogger("panel.engine")
+recv_log = logging.getLogger("panel.recv")
+send_log = logging.getLogger("panel.send")
+sync_log = logging.getLogger("panel.sync")
+telemetry_log = logging.getLogger("panel.telemetry")
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 8765
+
+DEFAULT_GLOBAL_PARAMS = {
+    "targetHour": 0,
+    "targetMinute": 0,
+    "targetSecond": 0,
+    "decrementValue": 0.1,
+    "checkDelay": 500,
+    "resultCheckDelay": 1500,
+    "resubmitDelay": 500,
+}
+
+# Matches the defaults of a freshly created card
+DEFAULT_PRODUCT_PARAMS = {
+    "minValues": [0.0],
+    "skuPrices": [0.0],
+    "autoDecrement": True,
+    "targetTime": None, # Optional (hour, minute, second) override
+    "ladderStrategy": "linear", # See price_ladder.STRATEGIES
+    "ladderSteps": [], # Per-SKU steps > 0 (percent for "percentage"); missing ones use decrementValue (percentage: 1%)
+    "priority": 0, # Fire slot order, higher first (see fire_slots); stays in the panel like fireOffsetMs
+    "fireOffsetMs": 0.0, # Moves the product's wished-for fire time off its deadline
+}
+
+# Wall-clock epoch anchored to perf_counter, so timestamps have sub-millisecond resolution on every platform
+_EPOCH_BASE = time.time() - time.perf_counter()
+
+def now_ms():
+    return (_EPOCH_BASE + time.perf_counter()) * 1000
+
+def encode_command(msg_type, global_params_json, specific_params_json):
+    """Builds a command message by splicing together params that were serialized ahead of time."""
+    return '{"type": %s, "globalParams": %s, "specificParams": %s}' % (
+        json.dumps(msg_type), global_params_json, specific_params_json)
+
+def with_fields(object_json, fields):
+    """Appends per-send fields to an already-serialized, non-empty JSON object."""
+    return object_json[:-1] + ", " + json.dumps(fields)[1:]
+
+def parse_target_time(text):
+    """Parses an optional "HH:MM:SS" override. Returns (hour, minute, second), or None when blank."""
+    text = text.strip()
+    if not text:
+        return None
+    hour, minute, second = (int(part) for part in text.split(":"))
+    datetime.now().replace(hour=hour, minute=minute, second=second) # Validates the ranges
+    return hour, minute, second
+
+def target_deadline_ms(hour, minute, second):
+    """Target time as panel-clock epoch ms, using today's date like the userscript does."""
+    target = datetime.now().replace(hour=hour, minute=minute, second=second, microsecond=0)
+    return target.timestamp() * 1000
+
+# --- Wire Protocol ---
+# Protocol 1: every command is a self-contained JSON message.
+# Protocol 2 (offered by the userscript in "register"): fire and stop are one-character frames,
+# global params go out once per version as a "globals" message and commands reference them as "g",
+# and configured bulky message types are sent zlib-compressed as binary frames.
+# Protocol 3 adds delta settings: Apply sends a client only the fields that changed since its last
+# settings ("settings_delta", numbered "sv"), and the client answers with a "settings_ack".
+# Protocol 4 numbers every command ("c") and the client acknowledges it with {"type": "ack", "c": ...}
+# once handled; unacknowledged commands are resent with the same number (see WebSocketServer.broadcast).
+# Newer clients still accept every older message; clients that offer nothing get protocol 1.
+# Resume: a tab that reconnects within the grace period is re-sent its last settings (apply_settings)
+# only if it reports in "register" that it has none ("hasSettings": false, the page was reloaded) or it
+# never confirmed the latest ones, and never while it reports "running": re-typing the base prices
+# would undo the price ladder mid-run. Scripts before 2.24 report neither and are always re-sent.
+PROTOCOL_VERSION = 4
+FIRE_FRAME = '{"type": "fire"}' # Pre-encoded; nothing is serialized at the deadline
+STOP_FRAME = '{"type": "stop"}'
+COMPACT_FRAMES = {1: {"fire": FIRE_FRAME, "stop": STOP_FRAME}, 2: {"fire": "F", "stop": "S"}}
+COMPACT_FRAMES[3] = COMPACT_FRAMES[2]
+COMPACT_FRAMES[4] = {"fire": "F", "stop": STOP_FRAME} # Stop carries a command number from protocol 4
+COMPACT_TYPES = {"F": "fire", "S": "stop"}
+ACKED_COMMANDS = ("arm", "start", "stop", "apply_settings", "settings_delta") # Numbered for protocol 4; fire stays pre-encoded
+DEFAULT_COMPRESS_TYPES = ("globals", "apply_settings") # Compact fire/stop frames are never compressed
+COMPRESS_MIN_BYTES = 1024
+
+def client_state(register):
+    """{"hasSettings", "running"} as reported in a 2.24+ register message, or None for older scripts."""
+    if "running" not in register:
+        return None
+    return {"hasSettings": bool(register.get("hasSettings")), "running": bool(register.get("running"))}
+
+def negotiate_protocol(offered):
+    try:
+        return max(1, min(int(offered or 1), PROTOCOL_VERSION))
+    except (TypeError, ValueError):
+        return 1
+
+def encode_command_v2(msg_type, globals_version, specific_params_json):
+    return '{"type": %s, "g": %d, "specificParams": %s}' % (json.dumps(msg_type), globals_version, specific_params_json)
+
+def command_frames(session, msg_type, global_params, specific_params_json):
+    """
+    The frame(s) carrying a settings command to one client: the protocol 1 message or, for protocol 2,
+    the command referencing the global params by version, preceded by them if the connection lacks that version.
+    """
+    if session.protocol < 2:
+        return encode_command(msg_type, global_params.json, specific_params_json)
+    command = encode_command_v2(msg_type, global_params.version, specific_params_json)
+    if session.globals_version == global_params.version:
+        return command
+    session.globals_version = global_params.version
+    return [global_params.frame, command]
+
+def with_command_id(payload, command_id):
+    """Numbers a command payload (a string, or a list whose last frame is the command) for protocol 4."""
+    if isinstance(payload, list):
+        return payload[:-1] + [with_fields(payload[-1], {"c": command_id})]
+    return with_fields(payload, {"c": command_id})
+
+def frame_type(payload):
+    """Message type of an encoded JSON frame, read from its fixed prefix; None for compact frames."""
+    if payload.startswith('{"type": "'):
+        return payload[10:payload.index('"', 10)]
+    return None
+
+def settings_delta(session, global_params, params):
+    """
+    Protocol 3 apply: only the fields that differ from what this client was last sent (everything the
+    first time), numbered so the client can acknowledge it. Records what was sent on the session.
+    """
+    sent_globals, sent_specific = session.sent_settings or ({}, {})
+    message = {"type": "settings_delta", "sv": session.settings_seq + 1}
+    changed_globals = {key: value for key, value in global_params.snapshot.items()
+                       if key not in sent_globals or sent_globals[key] != value}
+    changed_specific = {key: value for key, value in params.snapshot.items()
+                        if key not in sent_specific or sent_specific[key] != value}
+    if changed_globals:
+        message["globalParams"] = changed_globals
+    if changed_specific:
+        message["specificParams"] = changed_specific
+    session.settings_seq += 1
+    session.pending_ack = (session.settings_seq, (global_params.version, params.version))
+    session.sent_settings = (global_params.snapshot, params.snapshot)
+    return json.dumps(message)
+
+@functools.lru_cache(maxsize=512)
+def deflate(payload):
+    return zlib.compress(payload.encode("utf-8"))
+
+# --- Parameter Model ---
+def finite_number(value):
+    """A config/API number (or numeric text) as a finite float. Raises ValueError."""
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError(f"'{value}' 不是数字")
+    try:
+        number = float(value.strip() if isinstance(value, str) else value)
+    except OverflowError:
+        number = math.inf
+    if not math.isfinite(number):
+        raise ValueError(f"'{value}' 不是有限数字")
+    return number
+
+def number_list(values):
+    if not isinstance(values, (list, tuple)):
+        raise ValueError("应为数字列表")
+    return [finite_number(value) for value in values]
+
+def step_list(values):
+    """Ladder steps: finite numbers above 0 (a zero or negative step would never lower the price)."""
+    steps = number_list(values)
+    if any(step <= 0 for step in steps):
+        raise ValueError("步长必须大于 0")
+    return steps
+
+def target_tuple(value):
+    """A targetTime given as [hour, minute, second], or None for the global time."""
+    if value is None:
+        return None
+    if not isinstance(value, (list, tuple)) or len(value) != 3:
+        raise ValueError("应为 \"时:分:秒\"")
+    return parse_target_time(":".join(str(int(finite_number(part))) for part in value))
+
+def strategy_name(value):
+    if value not in price_ladder.STRATEGIES:
+        raise ValueError(f"未知递减策略 '{value}'")
+    return value
+
+def parse_number_lines(text, cast=float):
+    """Parses one number per line, skipping blank lines. Returns (values, invalid_lines)."""
+    values, invalid = [], []
+    for line in text.splitlines():
+        line = line.strip()
+        if line:
+            try:
+                values.append(cast(line))
+            except ValueError:
+                invalid.append(line)
+    return values, invalid
+
+
+# What a command sends, published in one assignment: the GUI edits on its own thread while the
+# server loop reads, so a command takes one state and uses it for the whole message
+GlobalsState = namedtuple("GlobalsState", "version json snapshot frame")
+ParamsState = namedtuple("ParamsState", "version specific_json snapshot")
+
+
+class GlobalParams:
+    """
+    Validated global settings, updated one field at a time as the operator edits.
+    `published` always holds the current values serialized, so sending never parses or serializes.
+    """
+
+    CASTS = {"targetHour": int, "targetMinute": int, "targetSecond": int, "decrementValue": float,
+             "checkDelay": int, "resultCheckDelay": int, "resubmitDelay": int}
+    RANGES = {"targetHour": (0, 23), "targetMinute": (0, 59), "targetSecond": (0, 59)}
+
+    def __init__(self):
+        self.values = dict(DEFAULT_GLOBAL_PARAMS)
+        self.errors = {} # Maps field to a message; the field keeps its last valid value
+        self.published = None # GlobalsState
+        self.rebuild()
+
+    def parse(self, field, value):
+        """Casts one field from its text or a number and checks its range. Raises ValueError, also for inf/NaN."""
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise ValueError(f"'{value}' 不是数字")
+        try:
+            value = self.CASTS[field](value.strip() if isinstance(value, str) else value)
+        except OverflowError: # int() of an infinite float, e.g. 1e400 from JSON
+            raise ValueError(f"'{value}' 不是有限数字") from None
+        if isinstance(value, float) and not math.isfinite(value):
+            raise ValueError(f"'{value}' 不是有限数字")
+        low, high = self.RANGES.get(field, (0, float("inf")))
+        if not low <= value <= high:
+            raise ValueError(f"{value} 超出范围 {low}-{high}")
+        return value
+
+    def set_text(self, field, text):
+        """Validates and stores one field from its text. Returns an error message or None."""
+        try:
+            value = self.parse(field, text)
+        except ValueError as e:
+            self.errors[field] = f"{field} 无效: {e}"
+            return self.errors[field]
+        self.errors.pop(field, None)
+        if self.values[field] != value:
+            self.values[field] = value
+            self.rebuild()
+        return None
+
+    def update(self, values):
+        """
+        Sets several fields at once (config file, control API) with the same checks as set_text.
+        Returns {field: message} for the fields that were rejected; they keep their last valid value.
+        """
+        parsed, errors = {}, {}
+        for field, value in values.items():
+            if field not in self.CASTS:
+                errors[field] = f"未知参数 {field}"
+                continue
+            try:
+                parsed[field] = self.parse(field, value)
+            except ValueError as e:
+                errors[field] = self.errors[field] = f"{field} 无效: {e}"
+        for field in parsed:
+            self.errors.pop(field, None)
+        changed = {field: value for field, value in parsed.items() if self.values[field] != value}
+        if changed:
+            self.values.update(changed)
+            self.rebuild()
+        return errors
+
+    def rebuild(self):
+        snapshot = dict(self.values) # Never mutated; sessions keep it as what they were sent
+        encoded = json.dumps(snapshot)
+        version = self.published.version + 1 if self.published else 1
+        frame = '{"type": "globals", "v": %d, "globalParams": %s}' % (version, encoded) # Protocol 2
+        self.published = GlobalsState(version, encoded, snapshot, frame)
+
+    @property
+    def version(self):
+        return self.published.version
+
+    @property
+    def json(self):
+        return self.published.json
+
+    @property
+    def snapshot(self):
+        return self.published.snapshot
+
+    @property
+    def frame(self):
+        return self.published.frame
+
+    def target(self):
+        snapshot = self.published.snapshot
+        return snapshot["targetHour"], snapshot["targetMinute"], snapshot["targetSecond"]
+
+
+class ProductParams:
+    """
+    A product's validated settings, updated field by field from the card's text as it is edited.
+    Invalid lines are skipped (and reported in `errors`); the serialized specificParams and
+    apply_settings message are kept current so a click only has to send.
+    """
+
+    def __init__(self):
+        self.min_values = list(DEFAULT_PRODUCT_PARAMS["minValues"])
+        self.sku_prices = list(DEFAULT_PRODUCT_PARAMS["skuPrices"])
+        self.auto_decrement = DEFAULT_PRODUCT_PARAMS["autoDecrement"]
+        self.target_time = DEFAULT_PRODUCT_PARAMS["targetTime"]
+        self.ladder_strategy = DEFAULT_PRODUCT_PARAMS["ladderStrategy"]
+        self.ladder_steps = list(DEFAULT_PRODUCT_PARAMS["ladderSteps"])
+        self.priority = DEFAULT_PRODUCT_PARAMS["priority"]
+        self.fire_offset_ms = DEFAULT_PRODUCT_PARAMS["fireOffsetMs"]
+        self.errors = {} # Maps field (minValues, skuPrices, targetTime, ladderSteps, priority, fireOffsetMs) to a message
+        self.published = None # ParamsState
+        self.apply_cache = (None, None) # (global params version, encoded apply_settings)
+        self.ladder_cache = (None, None, None) # (versions and max steps, ladder rows, specificParams with the ladder)
+        self.rebuild()
+
+    def set_text(self, field, text):
+        """Parses one edited field. Returns an error message or None."""
+        if field == "targetTime":
+            try:
+                self.target_time = parse_target_time(text)
+                self.errors.pop(field, None)
+            except ValueError:
+                self.target_time = None
+                self.errors[field] = f"单独目标时间无效: '{text.strip()}', 使用全局时间"
+        elif field in ("priority", "fireOffsetMs"):
+            # Scheduling only: the tab never sees these, so the settings version is left alone
+            cast, attr = (int, "priority") if field == "priority" else (float, "fire_offset_ms")
+            try:
+                setattr(self, attr, cast(text.strip() or 0))
+                self.errors.pop(field, None)
+            except ValueError:
+                setattr(self, attr, DEFAULT_PRODUCT_PARAMS[field])
+                self.errors[field] = f"{'优先级' if field == 'priority' else '触发偏移'}无效: '{text.strip()}', 使用 0"
+            return self.errors.get(field)
+        else:
+            values, invalid = parse_number_lines(text.replace(",", "\n") if field == "ladderSteps" else text)
+            if field == "ladderSteps":
+                invalid += [f"{step:g}" for step in values if step <= 0]
+                values = [step for step in values if step > 0]
+            if field == "minValues":
+                self.min_values = values
+            elif field == "ladderSteps":
+                self.ladder_steps = values
+            else:
+                self.sku_prices = values
+            if invalid:
+                kind = "无效步长 (须大于 0)" if field == "ladderSteps" else "无效行"
+                self.errors[field] = f"已跳过{kind}: {', '.join(invalid)}"
+            else:
+                self.errors.pop(field, None)
+        self.check_lengths()
+        self.rebuild()
+        return self.errors.get(field) or self.errors.get("lengths")
+
+    def set_auto_decrement(self, value):
+        self.auto_decrement = bool(value)
+        self.rebuild()
+
+    def set_ladder_strategy(self, strategy):
+        if strategy not in price_ladder.STRATEGIES:
+            raise ValueError(f"Unknown ladder strategy: {strategy}")
+        self.ladder_strategy = strategy
+        self.rebuild()
+
+    # Config field -> (attribute, parser); parsers raise ValueError
+    UPDATE_FIELDS = {
+        "minValues": ("min_values", number_list),
+        "skuPrices": ("sku_prices", number_list),
+        "ladderSteps": ("ladder_steps", step_list),
+        "autoDecrement": ("auto_decrement", bool),
+        "targetTime": ("target_time", lambda value: parse_target_time(value) if isinstance(value, str) else target_tuple(value)),
+        "ladderStrategy": ("ladder_strategy", strategy_name),
+        "priority": ("priority", lambda value: int(finite_number(value))),
+        "fireOffsetMs": ("fire_offset_ms", finite_number),
+    }
+
+    def update(self, params):
+        """
+        Sets already-typed values (config file, control API). Every field is parsed before any is assigned, so a
+        rejected field leaves the others consistent; it keeps its last value. Returns {field: message} for those.
+        """
+        parsed, errors = {}, {}
+        for field, value in params.items():
+            if field not in self.UPDATE_FIELDS:
+                errors[field] = f"未知参数 {field}"
+                continue
+            attr, parse = self.UPDATE_FIELDS[field]
+            try:
+                parsed[attr] = parse(value)
+            except (TypeError, ValueError, OverflowError) as e:
+                errors[field] = f"{field} 无效: {e}"
+        for attr, value in parsed.items():
+            setattr(self, attr, value)
+        self.check_lengths()
+        self.rebuild()
+        return errors
+
+    def check_lengths(self):
+        # The userscript compares skuPrices[i] against minValues[i]; a missing minimum never stops decrementing
+        if self.auto_decrement and len(self.min_values) != len(self.sku_prices):
+            self.errors["lengths"] = f"最低值数量 ({len(self.min_values)}) 与SKU价格数量 ({len(self.sku_prices)}) 不一致"
+        else:
+            self.errors.pop("lengths", None)
+
+    def rebuild(self):
+        snapshot = {"minValues": list(self.min_values), "skuPrices": list(self.sku_prices), "autoDecrement": self.auto_decrement,
+                    "ladderStrategy": self.ladder_strategy, "ladderSteps": list(self.ladder_steps)}
+        specific_json = json.dumps(snapshot)
+        if self.published and specific_json == self.published.specific_json:
+            return # An edit that parses to the same values doesn't make clients out of date
+        self.published = ParamsState(self.published.version + 1 if self.published else 1, specific_json, snapshot)
+
+    @property
+    def version(self):
+        return self.published.version
+
+    @property
+    def specific_json(self):
+        return self.published.specific_json
+
+    @property
+    def snapshot(self):
+        return self.published.snapshot
+
+    # The methods below take the states to send (default: the latest); caches are keyed by their versions
+    def apply_payload(self, global_params, state=None):
+        state = state or self.published
+        version, payload = self.apply_cache
+        if version != (global_params.version, state.version):
+            payload = encode_command("apply_settings", global_params.json, state.specific_json)
+            self.apply_cache = ((global_params.version, state.version), payload)
+        return payload
+
+    def ladder(self, global_params, max_steps=price_ladder.MAX_STEPS, state=None):
+        """The resubmit price rows in cents (see price_ladder), computed once per settings version; empty without auto-decrement."""
+        state = state or self.published
+        key, rows, _ = self.ladder_cache
+        if key != (global_params.version, state.version, max_steps):
+            rows, settings = [], state.snapshot
+            if settings["autoDecrement"]:
+                rows = price_ladder.build_ladder(settings["ladderStrategy"], settings["skuPrices"], settings["minValues"],
+                                                 global_params.snapshot["decrementValue"], settings["ladderSteps"], max_steps)
+            self.ladder_cache = ((global_params.version, state.version, max_steps), rows, None)
+        return rows
+
+    def arm_json(self, global_params, max_steps=price_ladder.MAX_STEPS, state=None):
+        """specificParams for arm/start: the settings plus the precomputed "ladder", serialized once per version."""
+        state = state or self.published
+        key = (global_params.version, state.version, max_steps)
+        cached_key, _, encoded = self.ladder_cache
+        if cached_key != key or encoded is None:
+            rows = self.ladder(global_params, max_steps, state)
+            encoded = state.specific_json[:-1] + ', "ladder": ' + json.dumps(rows) + "}"
+            self.ladder_cache = (key, rows, encoded)
+        return encoded
+
+# --- Telemetry ---
+def percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": ordered[-1], "n": len(ordered)}
+
+
+class ProductTimeline:
+    """One product's client-reported state transitions for the current run, in panel-clock epoch ms."""
+
+    def __init__(self, product_id, deadline_ms=None):
+        self.product_id = product_id
+        self.deadline_ms = deadline_ms
+        self.events = [] # {"event", "t", ...client fields}
+        self.state = None # Latest event by timestamp; "fired" is sent after the click it triggers
+        self.state_ms = float("-inf")
+        self.armed_ms = None
+        self.fired_ms = None
+        self.clicks = [] # Time of each submit click
+        self.resubmits = 0
+        self.outcome = None # success | min_reached | apply_fail | submit_fail
+        self.result_ms = None
+
+    def add(self, event, at_ms, fields):
+        self.events.append({"event": event, "t": round(at_ms, 3), **fields})
+        if at_ms >= self.state_ms:
+            self.state, self.state_ms = event, at_ms
+        if event == "armed":
+            self.armed_ms = at_ms
+        elif event == "fired":
+            self.fired_ms = at_ms
+        elif event == "click":
+            self.clicks.append(at_ms)
+        elif event == "resubmit":
+            self.resubmits += 1
+        elif event == "result":
+            self.outcome = fields.get("outcome")
+            self.result_ms = at_ms
+
+    def summary(self):
+        return {
+            "state": self.state,
+            "outcome": self.outcome,
+            "clicks": len(self.clicks),
+            "resubmits": self.resubmits,
+            "fire_lateness_ms": self.fired_ms - self.deadline_ms if self.fired_ms is not None and self.deadline_ms else None,
+            "fire_to_first_click_ms": self.clicks[0] - self.fired_ms if self.clicks and self.fired_ms is not None else None,
+            "click_to_result_ms": self.result_ms - self.clicks[-1] if self.clicks and self.result_ms is not None else None,
+        }
+
+
+class TelemetryCollector:
+    """
+    Aggregates telemetry messages from clients into per-product timelines for the latest run.
+    Client timestamps are moved onto the panel clock with the product's measured offset,
+    so latencies across tabs are comparable. Runs on the server loop.
+    """
+
+    def __init__(self):
+        self.run_id = 0
+        self.run_started = None
+        self.timelines = {} # Maps product_id to ProductTimeline for the current run
+
+    def new_run(self, deadlines):
+        """Starts a fresh set of timelines; deadlines maps product_id to its deadline in panel-clock ms."""
+        self.run_id += 1
+        self.run_started = time.time()
+        self.timelines = {product_id: ProductTimeline(product_id, deadline_ms) for product_id, deadline_ms in deadlines.items()}
+
+    def record(self, product_id, event, client_ms, offset_ms, fields):
+        timeline = self.timelines.get(product_id)
+        if timeline is None:
+            timeline = self.timelines[product_id] = ProductTimeline(product_id)
+        timeline.add(event, client_ms - offset_ms, fields)
+        return timeline
+
+    def stats(self):
+        timelines = list(self.timelines.values())
+        summaries = [timeline.summary() for timeline in timelines]
+        successes = [timeline for timeline in timelines if timeline.outcome == "success"]
+        collect = lambda key: [summary[key] for summary in summaries if summary[key] is not None]
+        return {
+            "run": self.run_id,
+            "products": len(timelines),
+            "outcomes": dict(Counter(timeline.outcome for timeline in timelines if timeline.outcome)),
+            "fire_lateness_ms": percentiles(collect("fire_lateness_ms")),
+            "fire_to_first_click_ms": percentiles(collect("fire_to_first_click_ms")),
+            "click_to_result_ms": percentiles(collect("click_to_result_ms")),
+            "resubmits_per_success": sum(t.resubmits for t in successes) / len(successes) if successes else None,
+        }
+
+    def report(self):
+        """Full run export: aggregate stats plus every product's summary and event timeline."""
+        return {
+            "run": self.run_id,
+            "started": datetime.fromtimestamp(self.run_started).isoformat(timespec="milliseconds") if self.run_started else None,
+            "stats": self.stats(),
+            "products": {
+                product_id: {**timeline.summary(), "deadline_ms": timeline.deadline_ms, "events": timeline.events}
+                for product_id, timeline in self.timelines.items()
+            },
+        }
+
+
+# --- Trigger Scheduler ---
+class TriggerScheduler:
+    """
+    Fires armed clients at their deadlines from the server's event loop.
+    Deadlines are panel-clock epoch ms held in a heap; entries sharing a deadline
+    fire in one concurrent broadcast. All methods must be called on the server loop.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.heap = [] # (deadline_ms, seq, product_id)
+        self.seq = itertools.count()
+        self.spin_ms = 20.0 if os.name == "nt" else 2.0 # Sleep until this close to the deadline, then yield-spin; covers coarse OS timers (~15.6 ms on Windows)
+        self.wakeup = None
+        self.runner = None
+
+    def schedule(self, plan):
+        for deadline_ms, product_id in plan:
+            heapq.heappush(self.heap, (deadline_ms, next(self.seq), product_id))
+        if self.runner is None or self.runner.done():
+            self.wakeup = asyncio.Event()
+            self.runner = asyncio.create_task(self.run())
+        else:
+            self.wakeup.set() # An earlier deadline may have been added
+
+    def clear(self):
+        self.heap.clear()
+        if self.wakeup:
+            self.wakeup.set()
+
+    async def run(self):
+        while self.heap:
+            deadline_ms = self.heap[0][0]
+            remaining_ms = deadline_ms - now_ms()
+            if remaining_ms > self.spin_ms:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), (remaining_ms - self.spin_ms) / 1000)
+                except asyncio.TimeoutError:
+                    pass
+                continue # Re-read the heap head; it may have changed while sleeping
+            while now_ms() < deadline_ms:
+                await asyncio.sleep(0)
+
+            due = []
+            while self.heap and self.heap[0][0] <= deadline_ms:
+                due.append(heapq.heappop(self.heap)[2])
+            if not due:
+                continue # Cleared while spinning
+            lateness_ms = now_ms() - deadline_ms
+            # Resolved at fire time, so a client that resumed its session since arming still fires
+            outgoing, offline = [], []
+            for product_id in due:
+                session = self.server.sessions.get(product_id)
+                if session is None or session.websocket is None:
+                    offline.append(product_id)
+                else:
+                    outgoing.append((session.websocket, COMPACT_FRAMES[session.protocol]["fire"]))
+            report = await self.server.broadcast(outgoing)
+            report["failed"].update({product_id: "disconnected" for product_id in offline})
+            send_log.info("Fired %d clients %.2fms after deadline, skew %.2fms", len(due), lateness_ms, report["skew_ms"],
+                          extra={"fields": {"event": "fire", "clients": len(due), "lateness_ms": lateness_ms, "skew_ms": report["skew_ms"]}})
+            self.server.engine.emit("fired", report=report, lateness_ms=lateness_ms, deadline_ms=deadline_ms)
+
+# --- WebSocket Server ---
+class ClientSession:
+    """A product's connection state; outlives its socket for the reconnect grace period."""
+
+    def __init__(self, product_id, image_url):
+        self.product_id = product_id
+        self.image_url = image_url
+        self.websocket = None # None while disconnected
+        self.expiry = None # Grace-period TimerHandle while disconnected
+        self.settings_payload = None # Last settings sent, as a self-contained (protocol 1) apply_settings message
+        self.protocol = 1 # Negotiated at register; see PROTOCOL_VERSION
+        self.globals_version = None # Global params version the current connection already has (protocol 2)
+        # Settings sync: targets are (global params version, product params version)
+        self.sent_target = None # Settings the client was last sent (apply, start or arm)
+        self.acked_target = None # Settings the client confirmed; older protocols count as confirmed when sent
+        self.sent_settings = None # (globals snapshot, specific snapshot) last sent, for deltas (protocol 3)
+        self.settings_seq = 0
+        self.pending_ack = None # (seq, target) of the delta awaiting settings_ack
+
+
+class WebSocketServer:
+    def __init__(self, engine, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.clients = {} # Maps websocket to product_id (connected only)
+        self.sessions = {} # Maps product_id to ClientSession (connected or within grace)
+        self.session_grace_period = 30.0 # Seconds a disconnected product keeps its card and settings
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.loop = None # Will hold the event loop for this thread
+        self.server_task = None
+        self.sockets = [] # Listening sockets bound ahead of the event loop; see bind()
+        self.max_fanout_skew_ms = 20.0 # Skew between first and last send above this is reported as a warning
+        self.time_sync_interval = 10.0 # Seconds between time-sync rounds per client
+        self.time_sync_burst = 5 # Pings per round; the lowest-RTT sample wins
+        self.time_sync_tasks = {} # Maps websocket to its time-sync task
+        self.sync_samples = {} # Maps product_id to recent (rtt_ms, offset_ms) samples
+        self.clock_stats = {} # Maps product_id to {"offset_ms", "rtt_ms"}; offset is client clock minus panel clock
+        self.scheduler = TriggerScheduler(self)
+        self.telemetry = TelemetryCollector()
+        self.compress_types = set(DEFAULT_COMPRESS_TYPES) # Message types sent deflated to protocol 2 clients
+        self.compress_min_bytes = COMPRESS_MIN_BYTES
+        self.ack_timeout_ms = 250.0 # Deadline for a command's ack before it is resent (protocol 4)
+        self.ack_retries = 2 # Resends before a client is reported as failed
+        self.settings_ack_timeout_ms = 5000.0 # A settings delta not confirmed by then counts as failed (protocol 3)
+        self.command_ids = itertools.count(1)
+        self.awaiting_acks = {} # Maps command id to (websocket, future resolved by the client's ack)
+
+    async def handle_connection(self, websocket, path=None):
+        client_id = None
+        try:
+            log.info(f"New client connected: {websocket.remote_address}")
+            async for message in websocket:
+                data = json.loads(message)
+                if data.get("type") == "pong":
+                    sync_log.debug("Pong from %s: %s", client_id, message)
+                else:
+                    recv_log.info("Received message: %s", message)
+                
+                if data.get("type") == "register":
+                    product_id = data.get("productId")
+                    image_url = data.get("imageUrl")
+                    client_id = product_id
+                    
+                    protocol = negotiate_protocol(data.get("protocol"))
+                    session = self.sessions.get(product_id)
+                    if not product_id or (session and session.websocket is not None):
+                        log.warning(f"Product {product_id} is already registered or ID is null.")
+                    elif session:
+                        await self.resume_session(session, websocket, protocol, client_state(data))
+                    else:
+                        session = self.sessions[product_id] = ClientSession(product_id, image_url)
+                        session.websocket = websocket
+                        session.protocol = protocol
+                        self.clients[websocket] = product_id
+                        self.engine.emit("client_registered", product_id=product_id, image_url=image_url, protocol=protocol,
+                                         client_state=client_state(data))
+                        self.time_sync_tasks[websocket] = asyncio.create_task(self.time_sync_loop(websocket, product_id))
+
+                elif data.get("type") == "pong":
+                    self.handle_pong(websocket, data)
+
+                elif data.get("type") == "telemetry":
+                    self.handle_telemetry(websocket, data)
+
+                elif data.get("type") == "ack":
+                    self.record_ack(websocket, data.get("c"))
+
+                elif data.get("type") == "settings_ack":
+                    product_id = self.clients.get(websocket)
+                    if product_id is not None:
+                        self.record_settings_ack(product_id, data.get("sv"), data.get("ok", True))
+
+        except websockets.exceptions.ConnectionClosed as e:
+            log.info(f"Client {client_id or websocket.remote_address} disconnected. Reason: {e.code} {e.reason}")
+        except Exception as e:
+            log.error(f"Error handling client {client_id or websocket.remote_address}: {e}", exc_info=True)
+        finally:
+            sync_task = self.time_sync_tasks.pop(websocket, None)
+            if sync_task:
+                sync_task.cancel()
+            for command_id, (ack_socket, future) in list(self.awaiting_acks.items()):
+                if ack_socket is websocket and not future.done():
+                    future.set_exception(ConnectionError("closed before ack"))
+            if websocket in self.clients:
+                product_id = self.clients.pop(websocket)
+                session = self.sessions[product_id]
+                session.websocket = None
+                session.expiry = self.loop.call_later(self.session_grace_period, self.expire_session, product_id)
+                self.engine.emit("client_disconnected", product_id=product_id)
+
+    async def resume_session(self, session, websocket, protocol=1, state=None):
+        """Re-binds a product inside its grace period to its new socket and re-sends its last settings if it needs them."""
+        product_id = session.product_id
+        session.expiry.cancel()
+        session.expiry = None
+        session.websocket = websocket
+        session.protocol = protocol
+        session.globals_version = None # A new connection starts without any globals
+        self.clients[websocket] = product_id
+        log.info(f"Session resumed for product {product_id}")
+        self.engine.emit("client_resumed", product_id=product_id, protocol=protocol, client_state=state)
+        self.time_sync_tasks[websocket] = asyncio.create_task(self.time_sync_loop(websocket, product_id))
+        if self.resend_needed(session, state):
+            self.settings_resent(session)
+            await self.send_message(websocket, session.settings_payload)
+
+    def resend_needed(self, session, state):
+        """Whether a resumed tab gets its last settings again; see the resume note above PROTOCOL_VERSION."""
+        if not session.settings_payload:
+            return False
+        if state is None:
+            return True # Older script: cannot tell, keep re-sending as before
+        if state["running"]:
+            return False # Never re-type prices under a running ladder
+        return not state["hasSettings"] or session.acked_target != session.sent_target
+
+    def expire_session(self, product_id):
+        session = self.sessions.get(product_id)
+        if session is None or session.websocket is not None:
+            return
+        del self.sessions[product_id]
+        self.sync_samples.pop(product_id, None)
+        self.clock_stats.pop(product_id, None)
+        log.info(f"Session for product {product_id} expired after {self.session_grace_period}s")
+        self.engine.emit("client_removed", product_id=product_id)
+
+    def websocket_for(self, product_id):
+        session = self.sessions.get(product_id)
+        return session.websocket if session else None
+
+    def remember_settings(self, product_id, payload):
+        session = self.sessions.get(product_id)
+        if session:
+            session.settings_payload = payload
+
+    async def time_sync_loop(self, websocket, product_id):
+        """Periodically sends bursts of pings; the client echoes t0 with its own clock reading t1."""
+        try:
+            while True:
+                for _ in range(self.time_sync_burst):
+                    await websocket.send(json.dumps({"type": "ping", "t0": now_ms()}))
+                    await asyncio.sleep(0.05)
+                await asyncio.sleep(self.time_sync_interval)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def handle_pong(self, websocket, data):
+        product_id = self.clients.get(websocket)
+        if product_id is None:
+            return
+        try:
+            t0, t1 = float(data["t0"]), float(data["t1"])
+        except (KeyError, TypeError, ValueError):
+            sync_log.warning(f"Malformed pong from {product_id}: {data}")
+            return
+        t3 = now_ms()
+        rtt_ms = t3 - t0
+        offset_ms = t1 - (t0 + t3) / 2 # Assumes a symmetric path; error is bounded by rtt/2
+        samples = self.sync_samples.setdefault(product_id, deque(maxlen=self.time_sync_burst * 3))
+        samples.append((rtt_ms, offset_ms))
+        best_rtt, best_offset = min(samples)
+        self.clock_stats[product_id] = {"offset_ms": best_offset, "rtt_ms": best_rtt}
+        self.engine.emit("clock", product_id=product_id, offset_ms=best_offset, rtt_ms=best_rtt)
+
+    def handle_telemetry(self, websocket, data):
+        product_id = self.clients.get(websocket)
+        if product_id is not None:
+            self.record_telemetry(product_id, data)
+
+    def record_telemetry(self, product_id, data):
+        """Records a client state transition; "t" is the client's Date.now() when it happened."""
+        fields = {key: value for key, value in data.items() if key not in ("type", "event", "t")}
+        try:
+            event, client_ms = str(data["event"]), float(data["t"])
+        except (KeyError, TypeError, ValueError):
+            telemetry_log.warning(f"Malformed telemetry from {product_id}: {data}")
+            return
+        offset_ms = self.clock_stats.get(product_id, {"offset_ms": 0.0})["offset_ms"]
+        timeline = self.telemetry.record(product_id, event, client_ms, offset_ms, fields)
+        summary = timeline.summary()
+        telemetry_log.info("%s %s", product_id, event, extra={"fields": {"product_id": product_id, "event": event,
+                                                                          "panel_ms": client_ms - offset_ms, **fields}})
+        self.engine.emit("telemetry", product_id=product_id, state=event, summary=summary)
+
+    def wire_frames(self, websocket, payload):
+        """The frames actually sent for a payload (a string or list of strings); configured large types are deflated for protocol 2."""
+        frames = payload if isinstance(payload, list) else (payload,)
+        if not self.compress_types:
+            return frames
+        return [self.compress_frame(websocket, frame) for frame in frames]
+
+    def compress_frame(self, websocket, frame):
+        if len(frame) < self.compress_min_bytes or frame_type(frame) not in self.compress_types:
+            return frame
+        session = self.sessions.get(self.clients.get(websocket))
+        if session is None or session.protocol < 2:
+            return frame
+        return deflate(frame)
+
+    def record_settings_ack(self, product_id, seq, ok=True):
+        """A protocol 3 client applied (or failed to apply) the numbered settings delta; stale numbers are ignored."""
+        session = self.sessions.get(product_id)
+        if session and session.pending_ack and session.pending_ack[0] == seq:
+            if ok:
+                session.acked_target = session.pending_ack[1]
+            else:
+                log.warning(f"Product {product_id} could not apply settings #{seq}")
+                session.sent_settings = None # Unknown what the tab kept; the next Apply sends everything
+            session.pending_ack = None
+            self.engine.emit("settings_acked", product_id=product_id, ok=bool(ok))
+
+    def expect_settings_ack(self, session):
+        """Starts the deadline for the settings delta just numbered on this session."""
+        self.loop.call_later(self.settings_ack_timeout_ms / 1000, self.expire_settings_ack, session.product_id, session.pending_ack[0])
+
+    def expire_settings_ack(self, product_id, seq):
+        session = self.sessions.get(product_id)
+        if session and session.pending_ack and session.pending_ack[0] == seq:
+            log.warning(f"Product {product_id} did not confirm settings #{seq} within {self.settings_ack_timeout_ms:.0f}ms")
+            session.sent_settings = None # Unknown what the tab kept; the next Apply sends everything
+            session.pending_ack = None
+            self.engine.emit("settings_acked", product_id=product_id, ok=False)
+
+    def settings_resent(self, session):
+        """
+        A resumed tab is re-sent its last settings in full, in a message it does not acknowledge. They
+        replace any delta still awaiting its ack, so the session counts as confirmed up to what was sent.
+        """
+        if session.pending_ack:
+            session.pending_ack = None
+            session.sent_settings = None # The delta's ack will never come; the next Apply sends everything
+        session.acked_target = session.sent_target
+        self.engine.emit("settings_acked", product_id=session.product_id, ok=True)
+
+    def abandon_acks(self, websockets, reason):
+        """Stops waiting for the acks of earlier commands to these clients (they fail with `reason`), so a stop need not queue behind them."""
+        websockets = set(websockets)
+        for ack_socket, future in list(self.awaiting_acks.values()):
+            if ack_socket in websockets and not future.done():
+                future.set_exception(ConnectionError(reason))
+
+    def record_ack(self, websocket, command_id):
+        entry = self.awaiting_acks.get(command_id)
+        if entry and entry[0] is websocket and not entry[1].done():
+            entry[1].set_result(time.perf_counter())
+
+    async def send_message(self, websocket, message):
+        try:
+            for frame in self.wire_frames(websocket, message if isinstance(message, (str, list)) else json.dumps(message)):
+                await websocket.send(frame)
+            send_log.debug("Sent message to %s: %.200s", self.clients.get(websocket, 'unknown'), message)
+        except websockets.exceptions.ConnectionClosed:
+            # The main handler will deal with cleanup
+            pass
+        except Exception as e:
+            log.error(f"Failed to send message: {e}")
+
+    async def _timed_send(self, websocket, payload, started):
+        try:
+            for frame in self.wire_frames(websocket, payload):
+                await websocket.send(frame)
+            return (time.perf_counter() - started) * 1000, None
+        except websockets.exceptions.ConnectionClosed as e:
+            return None, f"closed ({e.code})"
+        except Exception as e:
+            return None, str(e)
+
+    async def broadcast(self, outgoing):
+        """
+        Sends a batch of (websocket, message) pairs concurrently, then waits for the acks of numbered commands.
+        Messages may be dicts, already-encoded strings or lists of them (sent in order);
+        a dict shared by several clients is serialized only once. Returns a delivery report; see confirm().
+        """
+        report, pending = await self.send_batch(outgoing)
+        return await self.confirm(report, pending)
+
+    async def send_batch(self, outgoing):
+        """
+        Puts a batch on the wire. Commands to protocol 4 clients are numbered first. Returns a report with each
+        client's send time in ms relative to the start of the fan-out, and the commands awaiting an ack.
+        """
+        encoded = {}
+        jobs = []
+        unconfirmed = []
+        for websocket, message in outgoing:
+            if isinstance(message, (str, list)):
+                payload = message
+            else:
+                payload = encoded.get(id(message))
+                if payload is None:
+                    payload = encoded[id(message)] = json.dumps(message)
+            command_id = None
+            product_id = self.clients.get(websocket)
+            frame = payload[-1] if isinstance(payload, list) else payload
+            if (frame_type(frame) or COMPACT_TYPES.get(frame)) in ACKED_COMMANDS:
+                session = self.sessions.get(product_id)
+                if session and session.protocol >= 4:
+                    command_id = next(self.command_ids)
+                    payload = with_command_id(payload, command_id)
+                    self.awaiting_acks[command_id] = (websocket, self.loop.create_future())
+                else:
+                    unconfirmed.append(product_id)
+            jobs.append((websocket, payload, command_id))
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(self._timed_send(ws, payload, started) for ws, payload, _ in jobs))
+
+        sent, failed, pending = {}, {}, []
+        for (websocket, payload, command_id), (elapsed_ms, error) in zip(jobs, results):
+            product_id = self.clients.get(websocket, str(websocket.remote_address))
+            if error is None:
+                sent[product_id] = elapsed_ms
+                if command_id is not None:
+                    pending.append((product_id, websocket, payload, command_id, started))
+            else:
+                failed[product_id] = error
+                self.awaiting_acks.pop(command_id, None)
+        skew_ms = max(sent.values()) - min(sent.values()) if sent else 0.0
+        report = {"sent": sent, "failed": failed, "skew_ms": skew_ms,
+                  "delivered": {}, "late": {}, "unconfirmed": [pid for pid in unconfirmed if pid in sent], "retries": 0}
+        return report, pending
+
+    async def confirm(self, report, pending):
+        """
+        Waits for the acks of a sent batch and completes its report: ack time per client in ms from the start
+        of the fan-out, "delivered" if acked within ack_timeout_ms of the first send and "late" if only after a
+        resend; clients still silent after ack_retries resends (or that disconnected) go to "failed".
+        "unconfirmed" lists clients whose protocol has no acks; they count as sent.
+        """
+        results = await asyncio.gather(*(self.await_ack(*entry) for entry in pending))
+        for (product_id, *_), (ack_ms, attempts, error) in zip(pending, results):
+            report["retries"] += attempts
+            if error is not None:
+                report["failed"][product_id] = error
+            elif attempts:
+                report["late"][product_id] = ack_ms
+            else:
+                report["delivered"][product_id] = ack_ms
+        self.log_broadcast(report)
+        return report
+
+    async def await_ack(self, product_id, websocket, payload, command_id, started):
+        """Returns (ack_ms, resends, error) for one numbered command, resending it after each missed deadline."""
+        future = self.awaiting_acks[command_id][1]
+        try:
+            for attempt in range(self.ack_retries + 1):
+                if attempt:
+                    elapsed_ms, error = await self._timed_send(websocket, payload, started)
+                    if error is not None:
+                        return None, attempt, error
+                    send_log.info("Resent command #%d to %s (attempt %d)", command_id, product_id, attempt + 1)
+                try:
+                    acked_at = await asyncio.wait_for(asyncio.shield(future), self.ack_timeout_ms / 1000)
+                    return (acked_at - started) * 1000, attempt, None
+                except asyncio.TimeoutError:
+                    continue
+                except ConnectionError as e:
+                    return None, attempt, str(e)
+            return None, self.ack_retries, f"no ack after {self.ack_retries} resends"
+        finally:
+            self.awaiting_acks.pop(command_id, None)
+
+    def log_broadcast(self, report):
+        # Copies: callers keep adding to the report (fire adds offline clients) after it is logged
+        sent, failed, skew_ms = dict(report["sent"]), dict(report["failed"]), report["skew_ms"]
+        delivered, late = dict(report.get("delivered", {})), dict(report.get("late", {}))
+        clients = len(sent) + len([pid for pid in failed if pid not in sent])
+        acked = list(delivered.values()) + list(late.values())
+        send_log.info("Broadcast to %d clients: %d sent, %d acked (%d late), %d failed, skew %.2fms", clients, len(sent),
+                      len(acked), len(late), len(failed), skew_ms,
+                      extra={"fields": {"event": "broadcast", "clients": clients, "failed": len(failed), "skew_ms": skew_ms,
+                                        "acked": len(acked), "late": len(late), "max_ack_ms": max(acked, default=None)}})
+        if late:
+            send_log.warning("Acked only after a resend: %s", late)
+        if failed:
+            send_log.warning("Broadcast failures: %s", failed)
+        if skew_ms > self.max_fanout_skew_ms:
+            send_log.warning("Broadcast skew %.2fms exceeds %sms. Send times: %s", skew_ms, self.max_fanout_skew_ms, sent)
+
+    async def arm(self, outgoing, fire_plan):
+        """Sends the arm commands, schedules the fire frames once every arm is on the wire, then waits for the acks."""
+        report, pending = await self.send_batch(outgoing)
+        self.scheduler.schedule(fire_plan)
+        return await self.confirm(report, pending)
+
+    async def disarm(self, outgoing):
+        self.scheduler.clear()
+        self.abandon_acks([websocket for websocket, _ in outgoing], "superseded by stop")
+        return await self.broadcast(outgoing)
+
+    async def _websocket_handler(self, websocket, path=None):
+        await self.handle_connection(websocket, path)
+
+    @property
+    def url(self):
+        return f"ws://{self.host}:{self.port}"
+
+    def bind(self):
+        """
+        Binds and listens on every address of host:port on the calling thread, before the event loop
+        (or the GUI) exists. Tabs that reconnect during startup wait in the accept backlog instead of
+        being refused and backing off for 5 s. Raises OSError if no address could be bound.
+        """
+        if self.sockets:
+            return
+        addresses = socket.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+        error = None
+        for family, sock_type, proto, _, address in dict.fromkeys(addresses): # getaddrinfo can repeat entries
+            sock = socket.socket(family, sock_type, proto)
+            try:
+                if os.name == "posix": # Same as asyncio's create_server; on Windows it would allow port hijacking
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if family == socket.AF_INET6:
+                    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+                sock.bind(address)
+                sock.listen(128)
+                sock.setblocking(False)
+            except OSError as e:
+                sock.close()
+                log.warning(f"Could not bind {address}: {e}")
+                error = e
+                continue
+            self.sockets.append(sock)
+        if not self.sockets:
+            raise error or OSError(f"No address to bind for {self.host}:{self.port}")
+        log.info(f"Bound {len(self.sockets)} listening socket(s) for {self.url}")
+
+    async def main(self):
+        load_websockets()
+        self.loop = asyncio.get_running_loop()
+        async with contextlib.AsyncExitStack() as stack:
+            if self.sockets:
+                for sock in self.sockets:
+                    await stack.enter_async_context(websockets.serve(self._websocket_handler, sock=sock))
+            else:
+                await stack.enter_async_context(websockets.serve(self._websocket_handler, self.host, self.port))
+            log.info(f"WebSocket server started on {self.url}")
+            self.engine.emit("listening", url=self.url)
+            await asyncio.Future()  # run forever
+
+
+# --- Engine ---
+class PanelEngine:
+    """
+    Owns the client registry, parameters, scheduling and broadcast.
+    Front ends edit parameters through engine.globals / engine.product(pid) and run
+    commands with submit(engine.start_all()) etc. Subscribers receive events as
+    callback(event, data) on the server thread and must marshal to their own thread.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, control_port=None, session_grace_period=None, shards=0):
+        if shards:
+            from panel_shards import ShardedServer # Optional mode; panel_shards imports this module
+            self.server = ShardedServer(self, host, port, shards)
+        else:
+            self.server = WebSocketServer(self, host, port)
+        if session_grace_period is not None:
+            self.server.session_grace_period = session_grace_period
+        self.control_port = control_port
+        self.globals = GlobalParams()
+        self.products = {} # Maps product_id to ProductParams
+        self.server_fire = True # Arm + server-pushed fire; False uses the polling "start" command
+        self.ladder_max_steps = price_ladder.MAX_STEPS
+        self.max_submits_per_second = 0.0 # Fleet-wide fire slot rate (see fire_slots); 0 (default) fires every tab at its deadline
+        self.subscribers = []
+        self.pending_events = deque(maxlen=10000) # Events emitted before anyone subscribed
+        self.events_lock = threading.RLock()
+        self.thread = None
+
+    # --- Events ---
+    def subscribe(self, callback):
+        """
+        Adds a subscriber. Events emitted while there were no subscribers (the engine can start
+        before the GUI exists) are replayed to the first one, in order, on the calling thread.
+        """
+        with self.events_lock:
+            self.subscribers.append(callback)
+            pending, self.pending_events = list(self.pending_events), deque(maxlen=self.pending_events.maxlen)
+            for event, data in pending:
+                self._deliver(callback, event, data)
+
+    def emit(self, event, **data):
+        with self.events_lock:
+            if not self.subscribers:
+                self.pending_events.append((event, data))
+                return
+            for callback in self.subscribers:
+                self._deliver(callback, event, data)
+
+    def _deliver(self, callback, event, data):
+        try:
+            callback(event, data)
+        except Exception as e:
+            log.error(f"Engine subscriber failed on '{event}': {e}", exc_info=True)
+
+    # --- Parameters ---
+    @property
+    def global_params(self):
+        return self.globals.values
+
+    def set_global_params(self, params):
+        """Returns {field: message} for rejected values; see GlobalParams.update."""
+        return self.globals.update(params)
+
+    def product(self, product_id):
+        """The product's parameter model, created with defaults on first use."""
+        params = self.products.get(product_id)
+        if params is None:
+            params = self.products[product_id] = ProductParams()
+        return params
+
+    def set_product_params(self, product_id, params):
+        """Returns {field: message} for rejected values; see ProductParams.update."""
+        return self.product(product_id).update(params)
+
+    def product_ladder(self, product_id):
+        """The resubmit price rows the product's tab would be armed with now."""
+        return self.product(product_id).ladder(self.globals, self.ladder_max_steps)
+
+    def product_deadline_ms(self, product_id, global_params=None):
+        snapshot = (global_params or self.globals.published).snapshot
+        target = self.product(product_id).target_time or (snapshot["targetHour"], snapshot["targetMinute"], snapshot["targetSecond"])
+        return target_deadline_ms(*target)
+
+    def plan_fire_slots(self, product_ids=None, global_params=None):
+        """The fire slots start_all would give the connected clients (or `product_ids`) now; see fire_slots.plan."""
+        if product_ids is None:
+            product_ids = list(self.server.clients.values())
+        requests = []
+        for product_id in product_ids:
+            params = self.product(product_id)
+            requests.append((product_id, self.product_deadline_ms(product_id, global_params), params.priority, params.fire_offset_ms))
+        return fire_slots.plan(requests, self.max_submits_per_second)
+
+    # --- Registry ---
+    @property
+    def url(self):
+        return self.server.url
+
+    def client_count(self):
+        return len(self.server.clients)
+
+    def status(self):
+        return {
+            "url": self.url,
+            "clients": sorted(self.server.clients.values()),
+            "disconnected": sorted(pid for pid, session in self.server.sessions.items() if session.websocket is None),
+            "clock": self.server.clock_stats,
+            "globalParams": self.global_params,
+            "serverFire": self.server_fire,
+        }
+
+    # --- Commands (coroutines; run on the server loop) ---
+    async def start_all(self):
+        """Arms every client for a server-pushed fire, or sends the polling start command."""
+        global_params = self.globals.published # One state for the whole run, whatever the GUI edits meanwhile
+        log.info(f"Global parameters for start: {global_params.json}")
+        outgoing = []
+        fire_plan = []
+        deadlines = {}
+        clients = list(self.server.clients.items())
+        slots = {slot["productId"]: slot["slot_ms"] for slot in self.plan_fire_slots([pid for _, pid in clients], global_params)}
+        # Retries go out on the tab's own slot plus whole periods, so resubmits stay spread over the fleet
+        extra = {"slotPeriod": fire_slots.period_ms(len(clients), self.max_submits_per_second)}
+        period_warning = fire_slots.period_warning(len(clients), self.max_submits_per_second, global_params.snapshot["resubmitDelay"])
+        if period_warning:
+            log.warning(f"Resubmit period {extra['slotPeriod']:.0f}ms exceeds resubmitDelay: {period_warning}")
+        for websocket, product_id in clients:
+            params = self.product(product_id)
+            state = params.published
+            session = self.server.sessions[product_id]
+            self.server.remember_settings(product_id, params.apply_payload(global_params, state))
+            self.mark_sent(session, global_params, state) # start/arm carry the full settings
+            specific_json = params.arm_json(global_params, self.ladder_max_steps, state) # Carries the resubmit price ladder
+            slot_ms = deadlines[product_id] = slots[product_id]
+            if self.server_fire:
+                # Client waits for the panel's "fire" frame instead of polling the clock
+                fire_plan.append((slot_ms, product_id))
+                outgoing.append((websocket, command_frames(session, "arm", global_params, with_fields(specific_json, extra))))
+            else:
+                # Slot in the client's own clock, corrected by the measured offset
+                clock = self.server.clock_stats.get(product_id, {"offset_ms": 0.0})
+                fields = dict(extra, targetTimestamp=round(slot_ms + clock["offset_ms"]))
+                outgoing.append((websocket, command_frames(session, "start", global_params, with_fields(specific_json, fields))))
+        self.server.telemetry.new_run(deadlines)
+        self.emit("run_started", run=self.server.telemetry.run_id, products=len(deadlines))
+        self.emit("settings_sent", products=list(deadlines))
+        if self.server_fire:
+            return await self.server.arm(outgoing, fire_plan)
+        return await self.server.broadcast(outgoing)
+
+    async def apply_all(self):
+        """
+        Sends settings only to clients that are out of date: protocol 3 clients get just the changed
+        fields and acknowledge them, older ones get their full settings. Clients already sent the current
+        settings are skipped unless they reported a failure.
+        """
+        global_params = self.globals.published
+        log.info(f"Global parameters for apply: {global_params.json}")
+        outgoing, changed, up_to_date = [], [], 0
+        for websocket, product_id in list(self.server.clients.items()):
+            params = self.product(product_id)
+            state = params.published
+            session = self.server.sessions[product_id]
+            if self.settings_status(product_id, (global_params.version, state.version)) in ("synced", "pending"):
+                up_to_date += 1
+                continue
+            self.server.remember_settings(product_id, params.apply_payload(global_params, state))
+            if session.protocol >= 3:
+                outgoing.append((websocket, settings_delta(session, global_params, state)))
+                session.sent_target = session.pending_ack[1]
+                self.server.expect_settings_ack(session)
+            else:
+                outgoing.append((websocket, command_frames(session, "apply_settings", global_params, state.specific_json)))
+                self.mark_sent(session, global_params, state)
+            changed.append(product_id)
+        report = await self.server.broadcast(outgoing)
+        report["up_to_date"] = up_to_date
+        self.emit("settings_sent", products=changed)
+        return report
+
+    def mark_sent(self, session, global_params, state):
+        """Records that a client was sent these settings in full (GlobalsState, ParamsState), in a message it does not acknowledge."""
+        session.sent_target = session.acked_target = (global_params.version, state.version)
+        session.sent_settings = (global_params.snapshot, state.snapshot)
+        session.pending_ack = None
+
+    def settings_status(self, product_id, target=None):
+        """
+        "synced", "pending" (sent, not yet acknowledged), "failed" (the tab could not apply it),
+        "stale" (edited since last sent) or "offline", against the current settings or `target` versions.
+        """
+        session = self.server.sessions.get(product_id)
+        if session is None or session.websocket is None:
+            return "offline"
+        target = target or (self.globals.version, self.product(product_id).version)
+        if session.sent_target != target:
+            return "stale"
+        if session.acked_target == target:
+            return "synced"
+        return "pending" if session.pending_ack else "failed"
+
+    async def stop_all(self):
+        """Stops every client and drops pending fires."""
+        return await self.server.disarm([(websocket, COMPACT_FRAMES[self.server.sessions[product_id].protocol]["stop"])
+                                         for websocket, product_id in list(self.server.clients.items())])
+
+    async def telemetry_report(self):
+        return self.server.telemetry.report()
+
+    async def export_telemetry(self, path):
+        """Writes the latest run's telemetry report as JSON."""
+        report = self.server.telemetry.report()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        log.info(f"Telemetry for run {report['run']} exported to {path}")
+        return report["stats"]
+
+    def submit(self, coro):
+        """Runs a command coroutine on the server loop with a single cross-thread call. Returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.server.loop)
+
+    # --- Lifecycle ---
+    async def main(self):
+        if self.control_port:
+            await ControlAPI(self, self.server.host, self.control_port).start()
+        await self.server.main()
+
+    def run(self):
+        """Runs the engine on a new event loop in the current thread, until the process exits."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.main())
+
+    def bind(self):
+        """Binds the WebSocket port now, on the calling thread; see WebSocketServer.bind."""
+        self.server.bind()
+
+    def start_thread(self):
+        """Binds the port, then runs the engine on a daemon thread. Does nothing if already started."""
+        if self.thread is not None:
+            return
+        self.bind()
+        self.thread = threading.Thread(target=self.run, name="PanelEngine", daemon=True)
+        self.thread.start()
+
+    def load_config(self, config):
+        """
+        Applies a parsed JSON/TOML config (see panel_config.example.json). Returns the values that were
+        rejected, as {"global": {field: message}, "products": {product_id: {field: message}}} (only parts that
+        have any); the rest of the config is applied.
+        """
+        self.server_fire = config.get("server_fire", self.server_fire)
+        if "compress_types" in config:
+            self.server.compress_types = set(config["compress_types"])
+        self.server.compress_min_bytes = config.get("compress_min_bytes", self.server.compress_min_bytes)
+        self.server.ack_timeout_ms = float(config.get("ack_timeout_ms", self.server.ack_timeout_ms))
+        self.server.ack_retries = int(config.get("ack_retries", self.server.ack_retries))
+        self.server.settings_ack_timeout_ms = float(config.get("settings_ack_timeout_ms", self.server.settings_ack_timeout_ms))
+        self.ladder_max_steps = int(config.get("ladder_max_steps", self.ladder_max_steps))
+        self.max_submits_per_second = float(config.get("max_submits_per_second", self.max_submits_per_second))
+        global_params = dict(config.get("global", {}))
+        errors = {}
+        if "targetTime" in global_params:
+            target_time = global_params.pop("targetTime")
+            try:
+                hour, minute, second = parse_target_time(str(target_time))
+                global_params.update(targetHour=hour, targetMinute=minute, targetSecond=second)
+            except (TypeError, ValueError): # Blank, or not H:M:S
+                errors["targetTime"] = f"目标时间无效: '{target_time}'"
+        errors.update(self.set_global_params(global_params))
+        for message in errors.values():
+            log.error(f"Global parameter rejected: {message}")
+        rejected = {"global": errors} if errors else {}
+        for product_id, params in config.get("products", {}).items():
+            product_errors = self.set_product_params(str(product_id), params) if isinstance(params, dict) else {"": "不是对象"}
+            for message in product_errors.values():
+                log.error(f"Parameter for product {product_id} rejected: {message}")
+            if product_errors:
+                rejected.setdefault("products", {})[str(product_id)] = product_errors
+        return rejected
+
+
+# --- Control API ---
+class ControlAPI:
+    """
+    Local line-delimited JSON control channel for headless runs. One request per line:
+      {"cmd": "status"} | {"cmd": "start"} | {"cmd": "apply"} | {"cmd": "stop"}
+      {"cmd": "set_global", "params": {...}} | {"cmd": "set_product", "productId": "...", "params": {...}}
+      {"cmd": "telemetry"} | {"cmd": "telemetry", "path": "run.json"} (report, or export to a file)
+      {"cmd": "plan"} (the fire slots a start would use now)
+    Each request gets one JSON response line.
+    """
+
+    def __init__(self, engine, host, port):
+        self.engine = engine
+        self.host = host
+        self.port = port
+
+    async def start(self):
+        await asyncio.start_server(self.handle, self.host, self.port)
+        log.info(f"Control API listening on {self.host}:{self.port}")
+
+    async def handle(self, reader, writer):
+        try:
+            async for line in reader:
+                if not line.strip():
+                    continue
+                try:
+                    response = await self.dispatch(json.loads(line))
+                except Exception as e:
+                    response = {"ok": False, "error": str(e)}
+                writer.write((json.dumps(response) + "\n").encode("utf-8"))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def dispatch(self, request):
+        cmd = request.get("cmd")
+        if cmd == "status":
+            return {"ok": True, **self.engine.status()}
+        if cmd == "start":
+            return {"ok": True, "report": await self.engine.start_all()}
+        if cmd == "apply":
+            return {"ok": True, "report": await self.engine.apply_all()}
+        if cmd == "stop":
+            return {"ok": True, "report": await self.engine.stop_all()}
+        if cmd == "telemetry":
+            if request.get("path"):
+                return {"ok": True, "stats": await self.engine.export_telemetry(request["path"])}
+            return {"ok": True, "report": await self.engine.telemetry_report()}
+        if cmd == "plan":
+            slots = self.engine.plan_fire_slots()
+            rate = self.engine.max_submits_per_second
+            return {"ok": True, "slots": slots, "period_ms": fire_slots.period_ms(len(slots), rate),
+                    "warning": fire_slots.period_warning(len(slots), rate, self.engine.global_params["resubmitDelay"])}
+        if cmd == "set_global":
+            errors = self.engine.load_config({"global": request["params"]}).get("global")
+            return {"ok": not errors, **({"errors": errors} if errors else {}), "globalParams": self.engine.global_params}
+        if cmd == "set_product":
+            product_id = str(request["productId"])
+            errors = self.engine.load_config({"products": {product_id: request["params"]}}).get("products", {}).get(product_id)
+            return {"ok": not errors, **({"errors": errors} if errors else {})}
+        return {"ok": False, "error": f"Unknown command: {cmd}"}
+
+
+def load_config_file(path):
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise RuntimeError("TOML configs need Python 3.11+ (tomllib); use a JSON config instead.")
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def log_event(event, data):
+    if event not in ("clock", "telemetry"): # Clock updates arrive with every ping; telemetry has its own category
+        log.info(f"Event {event}: {data}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless control panel engine")
+    parser.add_argument("--config", help="JSON or TOML config file")
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--control-port", type=int, default=None, help="Local control API port (default 8766)")
+    parser.add_argument("--shards", type=int, default=None, help="Worker processes for client connections (default 0: none)")
+    args = parser.parse_args()
+
+    config = load_config_file(args.config) if args.config else {}
+    log_config = config.get("logging", {})
+    setup_logging(
+        log_config.get("file", "panel_engine_log.jsonl"),
+        category_levels=log_config.get("levels", {"panel.sync": "WARNING"}),
+        sample_rates=log_config.get("sample_rates"),
+        console=True,
+    )
+    engine = PanelEngine(
+        host=args.host or config.get("host", DEFAULT_HOST),
+        port=args.port or config.get("port", DEFAULT_PORT),
+        control_port=args.control_port or config.get("control_port", 8766),
+        session_grace_period=config.get("session_grace_s"),
+        shards=args.shards if args.shards is not None else config.get("shards", 0),
+    )
+    if engine.load_config(config):
+        parser.error(f"{args.config}: invalid values (see the log above)")
+    engine.subscribe(log_event)
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        log.info("--- Engine Stopped ---")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,454 @@
+# panel_shards.py
+#
+# Optional sharded mode for the panel engine (PanelEngine(shards=N), `--shards N`).
+# N worker processes each run their own WebSocket server and own a subset of the tabs;
+# the coordinator (ShardedServer, in the panel's process) keeps the registry, clock
+# offsets and telemetry, and fans commands out to the workers over local line-JSON IPC.
+# Sends and fires then run on N loops in parallel instead of one.
+#
+# Tabs still connect to the panel's port. The coordinator reads their register message
+# and answers with {"type": "redirect", "url": ...} pointing at the worker that owns the
+# product (a stable hash of productId, so a reconnecting tab resumes on the same worker).
+#
+#   python panel_engine.py --shards 4            # headless
+#   python control_panel.py --shards 4           # GUI
+#   python bench_load.py --clients 1000 --shards 0 4
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import zlib
+
+from event_log import setup_logging
+from panel_engine import COMPRESS_MIN_BYTES, ClientSession, WebSocketServer, load_websockets, now_ms, send_log
+
+log = logging.getLogger("panel.shards")
+
+SHARD_SCRIPT = os.path.abspath(__file__)
+IPC_LINE_LIMIT = 64 * 1024 * 1024 # One IPC line carries a whole batch of encoded commands
+
+
+def merge_reports(parts):
+    """
+    Combines broadcast reports from several processes. parts is [(start_ms, report)], where start_ms
+    is the panel-clock epoch ms the shard started sending; send times are re-based on the earliest start.
+    """
+    merged = {"sent": {}, "failed": {}, "skew_ms": 0.0, "delivered": {}, "late": {}, "unconfirmed": [], "retries": 0,
+              "shards": len(parts)}
+    if not parts:
+        return merged
+    base_ms = min(start_ms for start_ms, _ in parts)
+    for start_ms, report in parts:
+        for key in ("sent", "delivered", "late"):
+            merged[key].update({product_id: start_ms - base_ms + elapsed_ms
+                                for product_id, elapsed_ms in report.get(key, {}).items()})
+        merged["failed"].update(report["failed"])
+        merged["unconfirmed"].extend(report.get("unconfirmed", ()))
+        merged["retries"] += report.get("retries", 0)
+    sent = merged["sent"]
+    merged["skew_ms"] = max(sent.values()) - min(sent.values()) if sent else 0.0
+    return merged
+
+
+# --- Coordinator ---
+class ShardSession(ClientSession):
+    def __init__(self, product_id, image_url, shard):
+        super().__init__(product_id, image_url)
+        self.shard = shard # ShardLink of the worker that owns the product's socket
+
+
+class RemoteClient:
+    """Stands in for a tab's websocket in the coordinator's registry; the socket itself lives in a worker."""
+
+    def __init__(self, shard, product_id):
+        self.shard = shard
+        self.product_id = product_id
+        self.remote_address = f"shard{shard.index}/{product_id}"
+
+
+class ShardLink:
+    """The coordinator's end of one worker process: its IPC stream and pending requests."""
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.writer = None
+        self.url = None # The worker's WebSocket URL, handed to tabs in redirects
+        self.alive = False
+        self.ready = asyncio.get_running_loop().create_future()
+        self.requests = {} # Maps request id to the future of its response
+        self.ids = itertools.count(1)
+
+    async def request(self, op, **fields):
+        if not self.alive:
+            raise ConnectionError(f"shard {self.index} is down")
+        request_id = next(self.ids)
+        future = self.requests[request_id] = asyncio.get_running_loop().create_future()
+        self.writer.write((json.dumps({"id": request_id, "op": op, **fields}) + "\n").encode("utf-8"))
+        await self.writer.drain()
+        return await future
+
+    def resolve(self, message):
+        future = self.requests.pop(message["id"], None)
+        if future and not future.done():
+            if "error" in message:
+                future.set_exception(RuntimeError(message["error"]))
+            else:
+                future.set_result(message["result"])
+
+    def down(self):
+        self.alive = False
+        for future in self.requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"shard {self.index} is down"))
+        self.requests.clear()
+
+
+class ShardedServer(WebSocketServer):
+    """
+    Drop-in replacement for WebSocketServer that keeps the registry but not the sockets.
+    `clients` maps RemoteClient handles to product ids, so PanelEngine's commands work unchanged;
+    broadcast/arm/disarm group their batches by worker and merge the workers' reports.
+    """
+
+    def __init__(self, engine, host, port, shards):
+        super().__init__(engine, host, port)
+        self.shard_count = shards
+        self.shards = [] # ShardLink by index
+        self.ipc_server = None
+        self.startup_timeout = 15.0 # Seconds for every worker to start and say hello
+        self.fire_merge_timeout = 1.0 # Seconds after a deadline to wait for the workers' fire reports of it
+        self.pending_fires = {} # Maps deadline_ms to {"expected": shard indices, "parts": [...], "timer": ...}
+
+    # --- Workers ---
+    async def start_shards(self):
+        self.ipc_server = await asyncio.start_server(self.handle_shard, "127.0.0.1", 0, limit=IPC_LINE_LIMIT)
+        ipc_port = self.ipc_server.sockets[0].getsockname()[1]
+        worker_host = "127.0.0.1" if self.host == "localhost" else self.host # One address, so one ephemeral port
+        self.shards = [ShardLink(index) for index in range(self.shard_count)]
+        for link in self.shards:
+            link.process = subprocess.Popen(
+                [sys.executable, SHARD_SCRIPT, "--worker", str(link.index), "--ipc-port", str(ipc_port),
+                 "--host", worker_host, "--grace", str(self.session_grace_period),
+                 "--compress-types", ",".join(sorted(self.compress_types)), "--compress-min-bytes", str(self.compress_min_bytes),
+                 "--ack-timeout-ms", str(self.ack_timeout_ms), "--ack-retries", str(self.ack_retries)],
+                creationflags=subprocess.CREATE_NO_WINDOW if os.name == "nt" else 0)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(link.ready for link in self.shards)), self.startup_timeout)
+        except asyncio.TimeoutError:
+            log.error(f"Shard workers did not start within {self.startup_timeout}s")
+            raise
+        log.info(f"{self.shard_count} shard workers ready: {[link.url for link in self.shards]}")
+
+    async def handle_shard(self, reader, writer):
+        hello = json.loads(await reader.readline())
+        link = self.shards[hello["hello"]]
+        link.writer, link.url, link.alive = writer, hello["url"], True
+        link.ready.set_result(link.url)
+        try:
+            async for line in reader:
+                message = json.loads(line)
+                if "id" in message:
+                    link.resolve(message)
+                else:
+                    self.on_shard_event(link, message["event"], message["data"])
+        finally:
+            log.error(f"Shard {link.index} disconnected; its tabs will reconnect through {self.url}")
+            link.down()
+            for handle, product_id in list(self.clients.items()):
+                if handle.shard is link: # The worker's grace timers died with it; keep them here instead
+                    self.on_shard_event(link, "client_disconnected", {"product_id": product_id})
+                    self.sessions[product_id].expiry = self.loop.call_later(self.session_grace_period,
+                                                                            self.expire_session, product_id)
+            writer.close()
+
+    def shard_for(self, product_id):
+        """The worker that owns a product: a stable hash over the live workers."""
+        live = [link for link in self.shards if link.alive]
+        return live[zlib.crc32(product_id.encode("utf-8")) % len(live)] if live else None
+
+    def on_shard_event(self, link, event, data):
+        """Mirrors a worker's registry and clock events into the coordinator, then emits them to the engine."""
+        product_id = data.get("product_id")
+        if event == "client_registered" or event == "client_resumed":
+            session = self.sessions.get(product_id)
+            protocol = data.get("protocol", 1)
+            state = data.get("client_state")
+            if session is None:
+                session = self.sessions[product_id] = ShardSession(product_id, data.get("image_url"), link)
+                event, data = "client_registered", {"product_id": product_id, "image_url": session.image_url, "protocol": protocol}
+            else: # Includes a product re-registering on another worker after its worker went down
+                self.clients.pop(session.websocket, None)
+                if session.expiry:
+                    session.expiry.cancel()
+                    session.expiry = None
+                session.shard = link
+                event, data = "client_resumed", {"product_id": product_id, "protocol": protocol}
+            session.protocol = protocol
+            session.globals_version = None # Mirrors the worker: the new connection has no globals yet
+            session.websocket = RemoteClient(link, product_id)
+            self.clients[session.websocket] = product_id
+            # The coordinator keeps the sync state, so it decides whether a resumed tab needs its settings again
+            if event == "client_resumed" and self.resend_needed(session, state):
+                self.settings_resent(session)
+                asyncio.create_task(self.broadcast([(session.websocket, session.settings_payload)]))
+        elif event == "client_disconnected":
+            session = self.sessions.get(product_id)
+            if session is None or session.websocket is None:
+                return
+            self.clients.pop(session.websocket, None)
+            session.websocket = None
+        elif event == "client_removed":
+            self.sessions.pop(product_id, None)
+            self.clock_stats.pop(product_id, None)
+        elif event == "clock":
+            self.clock_stats[product_id] = {"offset_ms": data["offset_ms"], "rtt_ms": data["rtt_ms"]}
+        elif event == "client_telemetry":
+            self.record_telemetry(product_id, data["data"])
+            return
+        elif event == "client_settings_ack":
+            self.record_settings_ack(product_id, data["seq"], data["ok"])
+            return
+        elif event == "fired":
+            self.on_shard_fired(link, data)
+            return
+        else:
+            return # "listening" etc. concern only the worker
+        self.engine.emit(event, **data)
+
+    # --- Front door ---
+    async def handle_connection(self, websocket, path=None):
+        """Reads the tab's register message and redirects it to the worker that owns its product."""
+        try:
+            data = json.loads(await asyncio.wait_for(websocket.recv(), 10))
+            product_id = data.get("productId") if data.get("type") == "register" else None
+            link = self.shard_for(product_id) if product_id else None
+            if link is None:
+                log.warning(f"Cannot route {websocket.remote_address}: {'no live shard' if product_id else data}")
+                await websocket.close(1013, "no shard")
+                return
+            await websocket.send(json.dumps({"type": "redirect", "url": link.url}))
+            await websocket.close()
+        except (asyncio.TimeoutError, ValueError, load_websockets().exceptions.WebSocketException) as e:
+            log.info(f"Front door connection from {websocket.remote_address} dropped: {e!r}")
+
+    # --- Commands ---
+    async def fan_out(self, op, batches, plans=None, links=None):
+        """Sends one request per worker and merges the reports. batches maps ShardLink to [[product_id, payload]]."""
+        plans = plans or {}
+        links = [link for link in self.shards if link in batches or link in plans or link in (links or ())]
+
+        async def call(link):
+            batch = batches.get(link, [])
+            try:
+                return await link.request(op, batch=batch, plan=plans.get(link, []))
+            except Exception as e:
+                return {"started_ms": now_ms(), "report": {"sent": {}, "failed": {product_id: str(e) for product_id, _ in batch},
+                                                           "skew_ms": 0.0}, "error": str(e)}
+        results = await asyncio.gather(*(call(link) for link in links))
+        report = merge_reports([(result["started_ms"], result["report"]) for result in results])
+        failed_shards = [link.index for link, result in zip(links, results) if "error" in result]
+        if failed_shards:
+            report["failed_shards"] = failed_shards # Workers that never got the request
+        self.log_broadcast(report)
+        return report
+
+    def group(self, outgoing):
+        encoded = {}
+        batches = {}
+        for handle, message in outgoing:
+            if isinstance(message, (str, list)):
+                payload = message
+            else:
+                payload = encoded.get(id(message))
+                if payload is None:
+                    payload = encoded[id(message)] = json.dumps(message)
+            batches.setdefault(handle.shard, []).append([handle.product_id, payload])
+        return batches
+
+    async def broadcast(self, outgoing):
+        return await self.fan_out("send", self.group(outgoing))
+
+    async def arm(self, outgoing, fire_plan):
+        """Each worker sends its arm commands and schedules its own fires, so fires go out from N loops at once."""
+        plans = {}
+        for deadline_ms, product_id in fire_plan:
+            session = self.sessions.get(product_id)
+            if session is None:
+                continue
+            plans.setdefault(session.shard, []).append([deadline_ms, product_id])
+            pending = self.pending_fires.setdefault(deadline_ms, {"expected": set(), "parts": [], "timer": None})
+            pending["expected"].add(session.shard.index)
+            if pending["timer"] is None:
+                # The merge window closes fire_merge_timeout after the deadline, even if no worker reports
+                delay = max(0.0, (deadline_ms - now_ms()) / 1000) + self.fire_merge_timeout
+                pending["timer"] = self.loop.call_later(delay, self.flush_fire, deadline_ms)
+        report = await self.fan_out("arm", self.group(outgoing), plans)
+        # A worker whose arm request failed has no fire scheduled; stop waiting for its report
+        for deadline_ms, pending in list(self.pending_fires.items()):
+            pending["expected"].difference_update(report.get("failed_shards", ()))
+            if not pending["expected"]:
+                self.flush_fire(deadline_ms)
+        return report
+
+    async def disarm(self, outgoing):
+        for pending in self.pending_fires.values():
+            if pending["timer"]:
+                pending["timer"].cancel()
+        self.pending_fires.clear()
+        return await self.fan_out("stop", self.group(outgoing), links=[link for link in self.shards if link.alive])
+
+    def on_shard_fired(self, link, data):
+        deadline_ms, lateness_ms = data["deadline_ms"], data["lateness_ms"]
+        pending = self.pending_fires.get(deadline_ms)
+        if pending is None: # Merge window already closed; report this worker on its own
+            self.engine.emit("fired", report=data["report"], lateness_ms=lateness_ms, deadline_ms=deadline_ms)
+            return
+        pending["parts"].append((deadline_ms + lateness_ms, data["report"]))
+        pending["expected"].discard(link.index)
+        if not pending["expected"]:
+            self.flush_fire(deadline_ms)
+
+    def flush_fire(self, deadline_ms):
+        pending = self.pending_fires.pop(deadline_ms, None)
+        if pending is None:
+            return
+        if pending["timer"]:
+            pending["timer"].cancel()
+        if not pending["parts"]:
+            if pending["expected"]:
+                log.warning(f"No fire report for deadline {deadline_ms} from shards {sorted(pending['expected'])}")
+            return
+        report = merge_reports(pending["parts"])
+        lateness_ms = min(start_ms for start_ms, _ in pending["parts"]) - deadline_ms
+        send_log.info("Fired %d clients on %d shards %.2fms after deadline, skew %.2fms", len(report["sent"]) + len(report["failed"]),
+                      report["shards"], lateness_ms, report["skew_ms"],
+                      extra={"fields": {"event": "fire", "clients": len(report["sent"]), "shards": report["shards"],
+                                        "lateness_ms": lateness_ms, "skew_ms": report["skew_ms"]}})
+        self.engine.emit("fired", report=report, lateness_ms=lateness_ms, deadline_ms=deadline_ms)
+
+    async def main(self):
+        load_websockets()
+        self.loop = asyncio.get_running_loop()
+        await self.start_shards()
+        await super().main()
+
+
+# --- Worker ---
+class ShardServer(WebSocketServer):
+    """A worker's WebSocket server: forwards raw telemetry and settings acks, since the coordinator keeps that state."""
+
+    def record_telemetry(self, product_id, data):
+        self.engine.emit("client_telemetry", product_id=product_id, data=data)
+
+    def record_settings_ack(self, product_id, seq, ok=True):
+        self.engine.emit("client_settings_ack", product_id=product_id, seq=seq, ok=ok)
+
+    def resend_needed(self, session, state):
+        return False # The coordinator keeps the sync state and re-sends through a "send" request
+
+
+class ShardWorker:
+    """
+    One worker process. Stands in for PanelEngine as its server's `engine`: every emitted event
+    is written to the coordinator, and the coordinator's requests (send / arm / stop) run here.
+    """
+
+    def __init__(self, index, host, ipc_port, session_grace_period, compress_types, compress_min_bytes,
+                 ack_timeout_ms, ack_retries):
+        self.index = index
+        self.ipc_port = ipc_port
+        self.server = ShardServer(self, host, 0)
+        self.server.session_grace_period = session_grace_period
+        self.server.compress_types = compress_types # Compression happens where the sockets are
+        self.server.compress_min_bytes = compress_min_bytes
+        self.server.ack_timeout_ms = ack_timeout_ms # Acks arrive on the worker's sockets, so delivery is tracked here
+        self.server.ack_retries = ack_retries
+        self.writer = None
+        self.write_lock = None
+        self.requests = set() # Coordinator requests still running
+
+    def emit(self, event, **data):
+        self.send({"event": event, "data": data})
+
+    def send(self, message):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write((json.dumps(message) + "\n").encode("utf-8"))
+
+    async def handle(self, request):
+        op = request["op"]
+        outgoing, offline = [], []
+        for product_id, payload in request.get("batch", []):
+            websocket = self.server.websocket_for(product_id)
+            if websocket is None:
+                offline.append(product_id)
+            else:
+                outgoing.append((websocket, payload))
+        if op == "stop":
+            self.server.scheduler.clear()
+            self.server.abandon_acks([websocket for websocket, _ in outgoing], "superseded by stop")
+        started_ms = now_ms()
+        report, pending = await self.server.send_batch(outgoing)
+        if op == "arm":
+            self.server.scheduler.schedule([(deadline_ms, product_id) for deadline_ms, product_id in request.get("plan", [])])
+        report = await self.server.confirm(report, pending)
+        report["failed"].update({product_id: "disconnected" for product_id in offline})
+        return {"started_ms": started_ms, "report": report}
+
+    async def answer(self, request):
+        """Runs one coordinator request and writes its response. Requests run concurrently, so a stop is not held up by an earlier arm's acks."""
+        try:
+            response = {"id": request["id"], "result": await self.handle(request)}
+        except Exception as e:
+            log.error(f"Shard {self.index} failed on {request.get('op')}: {e}", exc_info=True)
+            response = {"id": request["id"], "error": str(e)}
+        async with self.write_lock:
+            self.send(response)
+            await self.writer.drain()
+
+    async def main(self):
+        self.server.bind()
+        self.server.port = self.server.sockets[0].getsockname()[1]
+        reader, self.writer = await asyncio.open_connection("127.0.0.1", self.ipc_port, limit=IPC_LINE_LIMIT)
+        self.write_lock = asyncio.Lock()
+        self.send({"hello": self.index, "url": self.server.url})
+        serving = asyncio.create_task(self.server.main())
+        try:
+            async for line in reader:
+                # Not awaited: the next request is read while this one waits for its acks
+                task = asyncio.create_task(self.answer(json.loads(line)))
+                self.requests.add(task)
+                task.add_done_callback(self.requests.discard)
+        except ConnectionError:
+            pass
+        log.info(f"Coordinator closed the link; shard {self.index} exiting")
+        for task in self.requests:
+            task.cancel()
+        serving.cancel()
+
+
+def worker_main():
+    parser = argparse.ArgumentParser(description="Panel shard worker (started by the coordinator)")
+    parser.add_argument("--worker", type=int, required=True)
+    parser.add_argument("--ipc-port", type=int, required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--grace", type=float, default=30.0)
+    parser.add_argument("--compress-types", default="", help="Comma-separated message types")
+    parser.add_argument("--compress-min-bytes", type=int, default=COMPRESS_MIN_BYTES)
+    parser.add_argument("--ack-timeout-ms", type=float, default=250.0)
+    parser.add_argument("--ack-retries", type=int, default=2)
+    parser.add_argument("--log-file", default=None)
+    args = parser.parse_args()
+    setup_logging(args.log_file or f"panel_shard{args.worker}_log.jsonl", category_levels={"panel.sync": "WARNING"})
+    compress_types = {msg_type for msg_type in args.compress_types.split(",") if msg_type}
+    asyncio.run(ShardWorker(args.worker, args.host, args.ipc_port, args.grace, compress_types, args.compress_min_bytes,
+                            args.ack_timeout_ms, args.ack_retries).main())
+
+
+if __name__ == "__main__":
+    worker_main()
@@ -0,0 +1,107 @@
+# price_ladder.py
+#
+# Price ladders: the prices a tab resubmits with after each failed submission. The panel
+# computes a product's whole ladder when it arms the tab and ships it in the arm/start
+# command, so the userscript only looks up the next row; it does no price arithmetic or
+# floor checks of its own. Strategies work on whole price columns (one per SKU) in integer
+# cents, and the ladder is cut where the first column runs out. Nothing here depends on the GUI.
+
+import math
+
+MAX_STEPS = 200 # Rows per ladder at most; also bounds zero-step ladders
+DEFAULT_PERCENT = 1.0 # "percentage" step for a SKU without its own; decrementValue is a price, not a percent
+
+# Strategy name -> card label
+STRATEGY_LABELS = {"linear": "线性", "percentage": "百分比", "per_sku": "按SKU步长", "floor_aware": "保底"}
+
+
+def to_cents(price):
+    return round(price * 100)
+
+
+def floor_cents(floor):
+    """Lowest allowed price in cents; a fractional-cent floor rounds up."""
+    return math.ceil(round(floor * 100, 6))
+
+
+def linear_column(price, floor, step, max_steps):
+    """price - k * step for k = 1..max_steps, ending before the first price under the floor."""
+    if price < floor:
+        return []
+    if step <= 0:
+        return [price] * max_steps
+    lowest = max(floor, price - step * max_steps)
+    return list(range(price - step, lowest - 1, -step))
+
+
+def percentage_column(price, floor, percent, max_steps):
+    """Takes `percent` % off the price k times over; ends before the first price under the floor."""
+    factor = 1 - percent / 100
+    column = []
+    for k in range(1, max_steps + 1):
+        cents = round(price * factor ** k)
+        if cents < floor:
+            break
+        column.append(cents)
+    return column
+
+
+def floor_aware_column(price, floor, step, max_steps):
+    """Like linear, but a SKU that reaches its floor stays there for the remaining rows."""
+    floor = min(floor, price) # A price already under its floor is held, not raised
+    column = linear_column(price, floor, step, max_steps)
+    return column + [floor] * (max_steps - len(column))
+
+
+def cut_rows(columns):
+    """Transposes per-SKU columns into rows, as many as the shortest column has."""
+    return [list(row) for row in zip(*columns)]
+
+
+def linear(prices, floors, steps, max_steps):
+    return cut_rows([linear_column(*args, max_steps) for args in zip(prices, floors, steps)])
+
+
+def percentage(prices, floors, steps, max_steps):
+    return cut_rows([percentage_column(*args, max_steps) for args in zip(prices, floors, steps)])
+
+
+def floor_aware(prices, floors, steps, max_steps):
+    """Ends once no SKU can go any lower: as many rows as the longest linear column."""
+    rows = max((len(linear_column(price, min(floor, price), step, max_steps))
+                for price, floor, step in zip(prices, floors, steps)), default=0)
+    return cut_rows([floor_aware_column(*args, rows) for args in zip(prices, floors, steps)])
+
+
+# Strategy name -> function(prices, floors, steps, max_steps) -> rows, all in cents (steps in percent
+# for "percentage"). "linear" steps every SKU by the global decrement; the others use the card's
+# per-SKU steps, falling back to it (to DEFAULT_PERCENT for "percentage").
+STRATEGIES = {"linear": linear, "percentage": percentage, "per_sku": linear, "floor_aware": floor_aware}
+
+
+def build_ladder(strategy, prices, floors, decrement, sku_steps=(), max_steps=MAX_STEPS):
+    """
+    The resubmit rows for one product, in integer cents: row k holds every SKU's price for attempt k + 2
+    (the first attempt uses `prices`). A SKU without a floor is never cut. Raises KeyError for an unknown strategy.
+    """
+    function = STRATEGIES[strategy]
+    count = len(prices)
+    floors = [floor_cents(floor) for floor in floors[:count]] + [-math.inf] * (count - len(floors))
+    if strategy == "linear":
+        steps = [decrement] * count
+    else:
+        fallback = DEFAULT_PERCENT if strategy == "percentage" else decrement
+        steps = list(sku_steps[:count]) + [fallback] * (count - len(sku_steps))
+    if strategy != "percentage":
+        steps = [to_cents(step) for step in steps]
+    return function([to_cents(price) for price in prices], floors, steps, max_steps)
+
+
+def describe(rows, limit=3):
+    """Short card text for a ladder (in cents): step count and the first and last rows."""
+    if not rows:
+        return "无递减阶梯"
+    fmt = lambda row: "/".join(f"{cents / 100:.2f}" for cents in row[:limit]) + ("/…" if len(row) > limit else "")
+    if len(rows) == 1:
+        return f"1 步: {fmt(rows[0])}"
+    return f"{len(rows)} 步: {fmt(rows[0])} → {fmt(rows[-1])}"
@@ -0,0 +1,227 @@
+# settings_store.py
+#
+# Persistent per-product card settings (minimums, SKU prices, auto-decrement, target time, ladder
+# strategy and steps) in a local SQLite file keyed by productId. The whole table is read into memory
+# once on the store's own thread (the caller is told when it is done), so a new card is filled from a
+# dict lookup and the GUI thread never waits on the disk; edits update that dict
+# at once and reach the disk in batched transactions on the same thread, never on the GUI thread.
+# Settings are kept as the card shows them (one number per line), so a half-typed card comes back as
+# it was left. CSV and JSON files import and export many products at once; the JSON form is the
+# headless engine config's "products" section. Nothing here depends on the GUI.
+
+import atexit
+import csv
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from panel_engine import parse_number_lines
+from price_ladder import STRATEGIES
+
+log = logging.getLogger("panel.store")
+
+# A fresh card's settings; list fields hold the card text, one value per line
+DEFAULT_SETTINGS = {"minValues": "0.0", "skuPrices": "0.0", "autoDecrement": True, "targetTime": "",
+                    "ladderStrategy": "linear", "ladderSteps": "", "priority": "0", "fireOffsetMs": "0"}
+LIST_FIELDS = ("minValues", "skuPrices", "ladderSteps")
+COLUMNS = {"minValues": "min_values", "skuPrices": "sku_prices", "autoDecrement": "auto_decrement",
+           "targetTime": "target_time", "ladderStrategy": "ladder_strategy", "ladderSteps": "ladder_steps",
+           "priority": "priority", "fireOffsetMs": "fire_offset_ms"}
+CSV_SEPARATOR = ";" # Between the values of a list field in a CSV cell
+
+
+class SettingsStore:
+    """Card settings by productId, cached in memory and written back to SQLite in the background."""
+
+    def __init__(self, path, flush_interval=0.5, on_loaded=None):
+        self.path = path
+        self.flush_interval = flush_interval # Edits within this many seconds share one transaction
+        self.on_loaded = on_loaded # Called on the store thread once the saved settings are in memory
+        self.settings = {} # Maps product_id to its settings (DEFAULT_SETTINGS keys)
+        self.loaded = threading.Event()
+        self.queue = queue.SimpleQueue() # (product_id, settings), or None to stop
+        self.thread = threading.Thread(target=self.run, name="SettingsStore", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def get(self, product_id):
+        """A copy of the product's saved settings, or None (also while the initial load runs; see on_loaded). Never blocks."""
+        saved = self.settings.get(product_id)
+        return dict(saved) if saved is not None else None
+
+    def all(self):
+        """Copies of every product's saved settings; like get(), only complete once on_loaded was called."""
+        return {product_id: dict(saved) for product_id, saved in self.settings.items()}
+
+    def put(self, product_id, settings):
+        """Saves (part of) a product's settings; returns at once, the write happens on the store thread."""
+        merged = {**DEFAULT_SETTINGS, **self.settings.get(product_id, {}), **settings}
+        self.settings[product_id] = merged
+        self.queue.put((product_id, dict(merged)))
+
+    def close(self):
+        """Writes what is still queued and stops the store thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+
+    # --- Store thread ---
+    def run(self):
+        db = self.open()
+        while True:
+            batch, stopping = self.next_batch()
+            if batch and db is not None:
+                self.write(db, batch)
+            if stopping:
+                break
+        if db is not None:
+            db.close()
+
+    def open(self):
+        try:
+            db = sqlite3.connect(self.path)
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS products (product_id TEXT PRIMARY KEY, min_values TEXT,"
+                           " sku_prices TEXT, auto_decrement INTEGER, target_time TEXT, ladder_strategy TEXT,"
+                           " ladder_steps TEXT, updated REAL)")
+                # Columns added after the first release; older files get them with their defaults
+                existing = {row[1] for row in db.execute("PRAGMA table_info(products)")}
+                for field, column in COLUMNS.items():
+                    if column not in existing:
+                        db.execute(f"ALTER TABLE products ADD COLUMN {column} TEXT DEFAULT '{DEFAULT_SETTINGS[field]}'")
+            rows = db.execute(f"SELECT product_id, {', '.join(COLUMNS.values())} FROM products").fetchall()
+        except sqlite3.Error as e:
+            log.error(f"Settings store {self.path} unavailable, edits will not be saved: {e}")
+            self.loaded.set()
+            if self.on_loaded:
+                self.on_loaded() # Nothing more will arrive; the caller stops waiting
+            return None
+        for product_id, *values in rows:
+            saved = dict(zip(COLUMNS, values))
+            saved["autoDecrement"] = bool(saved["autoDecrement"])
+            self.settings.setdefault(product_id, {**DEFAULT_SETTINGS, **saved}) # Edits made during the load win
+        self.loaded.set()
+        log.info(f"Loaded settings for {len(rows)} products from {self.path}")
+        if self.on_loaded:
+            self.on_loaded()
+        return db
+
+    def next_batch(self):
+        """Blocks for the next edit, then collects the others that arrive within flush_interval, latest per product."""
+        item = self.queue.get()
+        batch = {}
+        deadline = time.monotonic() + self.flush_interval
+        while item is not None:
+            batch[item[0]] = item[1]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+        return batch, item is None
+
+    def write(self, db, batch):
+        now = time.time()
+        rows = [(product_id, *(saved[field] for field in COLUMNS), now) for product_id, saved in batch.items()]
+        try:
+            with db:
+                db.executemany(f"INSERT OR REPLACE INTO products (product_id, {', '.join(COLUMNS.values())}, updated)"
+                               f" VALUES ({', '.join('?' * (len(COLUMNS) + 2))})", rows)
+            log.debug(f"Saved settings for {len(rows)} products")
+        except sqlite3.Error as e:
+            log.error(f"Saving settings for {len(rows)} products failed: {e}")
+
+
+# --- Import / Export ---
+def from_params(params):
+    """Card settings from config-style params (numbers as lists, see panel_config.example.json). Raises ValueError."""
+    if not isinstance(params, dict):
+        raise ValueError("不是对象")
+    settings = {}
+    for field in DEFAULT_SETTINGS:
+        if field not in params:
+            continue
+        value = params[field]
+        if value in ("", None) and field in ("autoDecrement", "ladderStrategy"):
+            continue # An empty CSV cell keeps the current value
+        if field in LIST_FIELDS:
+            if isinstance(value, str):
+                value = value.replace(CSV_SEPARATOR, "\n").replace(",", "\n").split("\n")
+            elif not isinstance(value, list):
+                value = [value]
+            value = "\n".join(str(item).strip() for item in value if str(item).strip())
+        elif field == "autoDecrement":
+            value = value if isinstance(value, bool) else str(value).strip().lower() in ("1", "true", "yes", "y", "是")
+        else:
+            value = str(value).strip() if value is not None else ""
+        settings[field] = value
+    if "ladderStrategy" in settings and settings["ladderStrategy"] not in STRATEGIES:
+        raise ValueError(f"未知递减策略 '{settings['ladderStrategy']}'")
+    return settings
+
+
+def to_params(settings):
+    """Config-style params from card settings; lines that are not numbers are left out."""
+    params = {field: parse_number_lines(settings[field])[0] for field in LIST_FIELDS}
+    params["autoDecrement"] = settings["autoDecrement"]
+    params["ladderStrategy"] = settings["ladderStrategy"]
+    for field, cast in (("priority", int), ("fireOffsetMs", float)):
+        try:
+            params[field] = cast(settings[field].strip() or 0)
+        except ValueError:
+            pass
+    if settings["targetTime"]:
+        params["targetTime"] = settings["targetTime"]
+    return params
+
+
+def read_file(path):
+    """
+    Reads settings from a .csv file (a productId column plus DEFAULT_SETTINGS columns, list values separated
+    by ';') or a JSON file ({"products": {productId: params}} or just the mapping). Returns (settings by
+    product_id, errors); a bad row is skipped and reported. Raises OSError / ValueError for an unreadable file.
+    """
+    if path.lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            records = [(row.get("productId"), {k: v for k, v in row.items() if k in DEFAULT_SETTINGS and v is not None})
+                       for row in csv.DictReader(f)]
+    else:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict) and isinstance(data.get("products"), dict):
+            data = data["products"]
+        if not isinstance(data, dict):
+            raise ValueError("JSON 应为 {商品ID: 设置} 或含 \"products\" 的配置")
+        records = list(data.items())
+    imported, errors = {}, []
+    for line, (product_id, params) in enumerate(records, 1):
+        product_id = str(product_id or "").strip()
+        if not product_id:
+            errors.append(f"第 {line} 条: 缺少 productId")
+            continue
+        try:
+            imported[product_id] = from_params(params)
+        except ValueError as e:
+            errors.append(f"{product_id}: {e}")
+    return imported, errors
+
+
+def write_file(path, settings_by_product):
+    """Writes settings as .csv or as a JSON config "products" section, depending on the extension."""
+    if path.lower().endswith(".csv"):
+        with open(path, "w", newline="", encoding="utf-8-sig") as f: # The BOM lets Excel read the Chinese text
+            writer = csv.writer(f)
+            writer.writerow(["productId", *DEFAULT_SETTINGS])
+            for product_id, settings in sorted(settings_by_product.items()):
+                params = to_params(settings)
+                writer.writerow([product_id, *(CSV_SEPARATOR.join(map(str, params[field])) if field in LIST_FIELDS
+                                               else params.get(field, "") for field in DEFAULT_SETTINGS)])
+    else:
+        products = {product_id: to_params(settings) for product_id, settings in sorted(settings_by_product.items())}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"products": products}, f, ensure_ascii=False, indent=2)
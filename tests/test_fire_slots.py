@@ -0,0 +1,59 @@
+# tests/test_fire_slots.py
+#
+# fire_slots.plan: slot spacing, priority order, offsets and the resubmit period.
+
+import random
+
+import fire_slots
+
+
+def slot_times(slots):
+    return {slot["productId"]: slot["slot_ms"] for slot in slots}
+
+
+def test_spacing_and_period():
+    assert fire_slots.spacing_ms(50) == 20.0
+    assert fire_slots.spacing_ms(0) == 0.0
+    assert fire_slots.period_ms(1000, 50) == 20000.0
+    assert fire_slots.period_ms(1000, 0) == 0.0
+
+
+def test_no_limit_fires_at_deadline_plus_offset():
+    slots = fire_slots.plan([("a", 1000.0, 0, 0.0), ("b", 1000.0, 0, 0.0), ("c", 1000.0, 0, 25.0)], 0)
+    assert slot_times(slots) == {"a": 1000.0, "b": 1000.0, "c": 1025.0}
+    assert all(slot["wait_ms"] == 0 for slot in slots)
+
+
+def test_minimum_gap_between_slots():
+    slots = fire_slots.plan([(i, 0.0, 0, 0.0) for i in range(5)], 50)
+    assert [slot["slot_ms"] for slot in slots] == [0.0, 20.0, 40.0, 60.0, 80.0]
+    assert [slot["wait_ms"] for slot in slots] == [0.0, 20.0, 40.0, 60.0, 80.0]
+
+
+def test_higher_priority_keeps_the_earliest_slot():
+    slots = fire_slots.plan([("low", 0.0, 0, 0.0), ("high", 0.0, 5, 0.0), ("mid", 0.0, 1, 0.0)], 50)
+    assert [slot["productId"] for slot in slots] == ["high", "mid", "low"]
+    assert slot_times(slots) == {"high": 0.0, "mid": 20.0, "low": 40.0}
+
+
+def test_offset_takes_a_free_gap_or_the_next_free_time():
+    taken = [("a", 0.0, 1, 0.0), ("b", 0.0, 1, 100.0)]
+    slots = slot_times(fire_slots.plan(taken + [("fits", 0.0, 0, 50.0), ("late", 0.0, 0, 90.0)], 50))
+    assert slots["fits"] == 50.0 # 50 ms from both neighbours
+    assert slots["late"] == 120.0 # 90 is within 20 ms of 100
+
+
+def test_random_plans_keep_the_gap_and_never_fire_early():
+    rng = random.Random(7)
+    requests = [(i, rng.choice([0.0, 500.0, 1000.0]), rng.randint(0, 3), rng.uniform(-50, 300)) for i in range(400)]
+    slots = fire_slots.plan(requests, 40)
+    times = [slot["slot_ms"] for slot in slots]
+    assert len(times) == len(requests)
+    assert all(later - earlier >= 25.0 - 1e-3 for earlier, later in zip(times, times[1:]))
+    assert all(slot["slot_ms"] >= slot["deadline_ms"] + slot["offset_ms"] - 1e-3 for slot in slots)
+
+
+def test_period_warning_only_when_the_period_outgrows_resubmit_delay():
+    assert fire_slots.period_warning(1000, 50, 500) # 20 s period
+    assert fire_slots.period_warning(10, 50, 500) == "" # 200 ms period
+    assert fire_slots.period_warning(1000, 0, 500) == ""
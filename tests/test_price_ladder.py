@@ -0,0 +1,57 @@
+# tests/test_price_ladder.py
+#
+# price_ladder.build_ladder: steps, floor clamping, percentage rounding and the per-SKU step fallbacks.
+
+import pytest
+
+from price_ladder import DEFAULT_PERCENT, build_ladder
+
+
+def test_linear_steps_down_to_the_floor_inclusive():
+    assert build_ladder("linear", [1.00], [0.70], 0.1) == [[90], [80], [70]]
+
+
+def test_floor_clamping_cuts_before_the_first_price_under_it():
+    assert build_ladder("linear", [1.00], [0.75], 0.1) == [[90], [80]]
+    assert build_ladder("linear", [1.00], [0.705], 0.1) == [[90], [80]] # A fractional-cent floor rounds up
+    assert build_ladder("linear", [1.00], [1.50], 0.1) == [] # Already under its floor
+
+
+def test_ladder_ends_where_the_first_column_runs_out():
+    assert build_ladder("linear", [1.00, 2.00], [0.80, 1.00], 0.1) == [[90, 190], [80, 180]]
+
+
+def test_sku_without_floor_runs_to_max_steps():
+    assert len(build_ladder("linear", [100.00], [], 0.1, max_steps=5)) == 5
+
+
+def test_percentage_rounds_each_step_to_whole_cents():
+    assert build_ladder("percentage", [9.99], [9.00], 0.1, [3]) == [[969], [940], [912]]
+
+
+def test_percentage_without_step_uses_default_percent_not_decrement():
+    assert DEFAULT_PERCENT == 1.0
+    expected = [[9900], [9801]] # 1% off 100.00 twice; 97.03 is under the floor
+    assert build_ladder("percentage", [100.00], [98.00], 0.1) == expected
+    assert build_ladder("percentage", [100.00], [98.00], 5.0) == expected
+
+
+def test_per_sku_steps_fall_back_to_decrement():
+    assert build_ladder("per_sku", [1.00, 5.00], [0.50, 4.00], 0.1, [0.1, 0.5]) == [[90, 450], [80, 400]]
+    assert build_ladder("per_sku", [1.00, 5.00], [0.80, 4.00], 0.2, [0.1]) == [[90, 480], [80, 460]]
+
+
+def test_floor_aware_holds_a_sku_at_its_floor():
+    rows = build_ladder("floor_aware", [1.00, 5.00], [0.80, 4.00], 0.1)
+    assert len(rows) == 10
+    assert rows[:3] == [[90, 490], [80, 480], [80, 470]]
+    assert rows[-1] == [80, 400]
+
+
+def test_max_steps_caps_the_ladder():
+    assert len(build_ladder("linear", [100.00], [0.00], 0.01, max_steps=20)) == 20
+
+
+def test_unknown_strategy():
+    with pytest.raises(KeyError):
+        build_ladder("random", [1.00], [0.50], 0.1)
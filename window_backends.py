@@ -0,0 +1,272 @@
+# window_backends.py
+#
+# Window-system backends for browser_grid_arranger.py. The arranger only talks to
+# a backend (enumerate windows, launch the browser, wait for window changes, close),
+# so the same launch pipeline runs against real Win32 windows or, on any OS, against
+# FakeBackend, which simulates a browser that opens windows after a delay.
+# Backends also report monitor work areas and move windows in one batch (see window_layout.py).
+
+import itertools
+import logging
+import random
+import subprocess
+import threading
+import time
+
+try:
+    import ctypes
+    from ctypes import wintypes
+    import win32api
+    import win32con
+    import win32gui
+except ImportError: # Not on Windows, or pywin32 missing; only FakeBackend is available
+    win32gui = None
+
+log = logging.getLogger("arranger.backend")
+
+BROWSER_TITLES = ["Chrome", "Firefox", "Edge", "Brave", "Opera", "谷歌浏览器"]
+
+def is_browser_title(title):
+    return bool(title) and any(browser in title for browser in BROWSER_TITLES)
+
+
+class Win32Backend:
+    """
+    Real windows via pywin32. Window changes are pushed by a WinEvent hook
+    (create/destroy/show/hide/name change) running on its own message-loop thread;
+    if the hook cannot be installed, waiters fall back to short polling.
+    """
+
+    EVENT_RANGES = ((0x8000, 0x8003), (0x800C, 0x800C)) # OBJECT_CREATE..HIDE, OBJECT_NAMECHANGE
+    POLL_INTERVAL = 0.1
+
+    def __init__(self):
+        if win32gui is None:
+            raise RuntimeError("Win32Backend needs Windows with pywin32 installed")
+        self.changed = threading.Condition()
+        self.generation = 0
+        self.hooked = False
+        self.hook_thread = threading.Thread(target=self._hook_loop, name="WinEventHook", daemon=True)
+        self.hook_thread.start()
+
+    def _hook_loop(self):
+        user32 = ctypes.windll.user32
+        proc_type = ctypes.WINFUNCTYPE(None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND,
+                                       wintypes.LONG, wintypes.LONG, wintypes.DWORD, wintypes.DWORD)
+
+        def on_event(hook, event, hwnd, id_object, id_child, thread_id, event_time):
+            if id_object == 0 and id_child == 0: # OBJID_WINDOW, CHILDID_SELF
+                self._bump()
+
+        self._proc = proc_type(on_event) # Keep a reference; the hook calls back into it
+        user32.SetWinEventHook.restype = wintypes.HANDLE
+        hooks = [user32.SetWinEventHook(low, high, 0, self._proc, 0, 0, 0) # WINEVENT_OUTOFCONTEXT
+                 for low, high in self.EVENT_RANGES]
+        if not all(hooks):
+            log.warning("SetWinEventHook failed; falling back to polling for window changes")
+            return
+        self.hooked = True
+        msg = wintypes.MSG()
+        while user32.GetMessageW(ctypes.byref(msg), 0, 0, 0) > 0:
+            user32.TranslateMessage(ctypes.byref(msg))
+            user32.DispatchMessageW(ctypes.byref(msg))
+
+    def _bump(self):
+        with self.changed:
+            self.generation += 1
+            self.changed.notify_all()
+
+    def list_windows(self):
+        """Maps hwnd to title for every visible top-level window with a title."""
+        windows = {}
+        def collect(hwnd, _):
+            if win32gui.IsWindowVisible(hwnd):
+                title = win32gui.GetWindowText(hwnd)
+                if title:
+                    windows[hwnd] = title
+            return True
+        win32gui.EnumWindows(collect, None)
+        return windows
+
+    def wait_for_change(self, since, timeout):
+        """
+        Blocks until the window generation moves past `since` or timeout. Returns the current generation.
+        Without the hook nothing bumps the generation: it waits one poll interval, and callers re-enumerate after every wait.
+        """
+        with self.changed:
+            if not self.hooked:
+                self.changed.wait(min(timeout, self.POLL_INTERVAL))
+            else:
+                self.changed.wait_for(lambda: self.generation != since, timeout)
+            return self.generation
+
+    def launch(self, args):
+        subprocess.Popen(args)
+
+    def close(self, hwnd):
+        win32gui.PostMessage(hwnd, win32con.WM_CLOSE, 0, 0)
+
+    def monitors(self):
+        """Every display's work area (left, top, width, height), not just the one at (0, 0)."""
+        monitors = []
+        for hmonitor, _, _ in win32api.EnumDisplayMonitors():
+            info = win32api.GetMonitorInfo(hmonitor)
+            left, top, right, bottom = info["Work"]
+            monitors.append({"work": (left, top, right - left, bottom - top), "primary": bool(info["Flags"] & 1),
+                             "name": info.get("Device", "")})
+        return monitors
+
+    def get_rect(self, hwnd):
+        if not win32gui.IsWindow(hwnd):
+            return None
+        left, top, right, bottom = win32gui.GetWindowRect(hwnd)
+        return left, top, right - left, bottom - top
+
+    def apply_layout(self, placements):
+        """
+        Moves and sizes every window in one DeferWindowPos batch, without activating them.
+        Minimized/maximized windows are restored first. Returns {hwnd: error} for windows that failed.
+        """
+        errors = {}
+        for hwnd, _ in placements:
+            try:
+                if win32gui.IsIconic(hwnd) or win32gui.IsZoomed(hwnd):
+                    win32gui.ShowWindow(hwnd, win32con.SW_SHOWNOACTIVATE)
+            except Exception as e:
+                errors[hwnd] = str(e)
+        flags = win32con.SWP_NOZORDER | win32con.SWP_NOACTIVATE
+        placements = [(hwnd, rect) for hwnd, rect in placements if hwnd not in errors]
+        try:
+            batch = win32gui.BeginDeferWindowPos(len(placements))
+            for hwnd, (x, y, width, height) in placements:
+                batch = win32gui.DeferWindowPos(batch, hwnd, 0, x, y, width, height, flags)
+            win32gui.EndDeferWindowPos(batch)
+        except Exception as e:
+            # One bad handle fails the whole batch; place the rest individually, without waiting on each window
+            log.warning(f"DeferWindowPos batch failed ({e}); falling back to asynchronous SetWindowPos")
+            for hwnd, (x, y, width, height) in placements:
+                try:
+                    win32gui.SetWindowPos(hwnd, 0, x, y, width, height, flags | win32con.SWP_ASYNCWINDOWPOS)
+                except Exception as e:
+                    errors[hwnd] = str(e)
+        return errors
+
+
+class FakeBackend:
+    """
+    Simulated browser for headless runs and benchmarks. launch() behaves like
+    `chrome --new-window [--window-name=NAME] URL...`: one window per call, appearing
+    after base_delay + jitter + per_url_delay per extra URL + contention_delay per
+    window still loading. All timing is real wall-clock time. Windows are clamped to
+    min_size when placed, like a browser's minimum window size.
+    """
+
+    def __init__(self, base_delay=0.4, jitter=0.6, per_url_delay=0.05, contention_delay=0.03,
+                 launch_cost=0.01, seed=0, existing=0, monitors=None, min_size=(0, 0), place_cost=0.0005):
+        self.base_delay = base_delay
+        self.jitter = jitter
+        self.per_url_delay = per_url_delay
+        self.contention_delay = contention_delay
+        self.launch_cost = launch_cost # Blocking cost of starting the browser process
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.generation = 0
+        self.windows = {} # Maps hwnd to title
+        self.tabs = {} # Maps hwnd to the URLs it was opened with
+        self.rects = {} # Maps hwnd to (x, y, width, height)
+        self.minimized = set()
+        self.monitor_list = monitors or [{"work": (0, 0, 1920, 1040), "primary": True, "name": "FAKE1"}]
+        self.min_size = min_size
+        self.place_cost = place_cost # Seconds per window placed
+        self.loading = 0
+        self.handles = itertools.count(0x10000, 4)
+        self.launches = 0
+        for i in range(existing):
+            self._add_window(f"Existing page {i} - Google Chrome", [])
+
+    def _add_window(self, title, urls):
+        with self.changed:
+            hwnd = next(self.handles)
+            self.windows[hwnd] = title
+            self.tabs[hwnd] = urls
+            self.rects[hwnd] = (100, 100, 1200, 800)
+            self.generation += 1
+            self.changed.notify_all()
+            return hwnd
+
+    def list_windows(self):
+        with self.lock:
+            return dict(self.windows)
+
+    def wait_for_change(self, since, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.generation != since, timeout)
+            return self.generation
+
+    def launch(self, args):
+        time.sleep(self.launch_cost)
+        name = next((arg.split("=", 1)[1] for arg in args[1:] if arg.startswith("--window-name=")), None)
+        urls = [arg for arg in args[1:] if not arg.startswith("--")]
+        with self.lock:
+            self.launches += 1
+            delay = (self.base_delay + self.random.uniform(0, self.jitter)
+                     + self.per_url_delay * max(0, len(urls) - 1) + self.contention_delay * self.loading)
+            self.loading += 1
+        title = f"{name or 'Page'} - Google Chrome"
+
+        def appear():
+            with self.lock:
+                self.loading -= 1
+            self._add_window(title, urls)
+        timer = threading.Timer(delay, appear)
+        timer.daemon = True
+        timer.start()
+
+    def close(self, hwnd):
+        with self.changed:
+            if self.windows.pop(hwnd, None) is not None:
+                self.tabs.pop(hwnd, None)
+                self.rects.pop(hwnd, None)
+                self.minimized.discard(hwnd)
+                self.generation += 1
+                self.changed.notify_all()
+
+
+    def monitors(self):
+        return [dict(monitor) for monitor in self.monitor_list]
+
+    def get_rect(self, hwnd):
+        with self.lock:
+            return self.rects.get(hwnd)
+
+    def minimize(self, hwnd):
+        with self.lock:
+            self.minimized.add(hwnd)
+
+    def is_minimized(self, hwnd):
+        with self.lock:
+            return hwnd in self.minimized
+
+    def apply_layout(self, placements):
+        time.sleep(self.place_cost * len(placements))
+        errors = {}
+        min_width, min_height = self.min_size
+        with self.lock:
+            for hwnd, (x, y, width, height) in placements:
+                if hwnd not in self.windows:
+                    errors[hwnd] = "invalid window handle"
+                    continue
+                self.minimized.discard(hwnd)
+                self.rects[hwnd] = (x, y, max(width, min_width), max(height, min_height))
+        return errors
+
+
+def default_backend(name=None):
+    """"win32" or "fake"; by default the real backend where it is available."""
+    if name == "fake":
+        return FakeBackend()
+    if name is None and win32gui is None:
+        log.warning("pywin32 is not available; using the simulated window backend")
+        return FakeBackend()
+    return Win32Backend()
@@ -0,0 +1,85 @@
+# window_layout.py
+#
+# Grid layout for browser_grid_arranger.py. Layout is computed as plain data
+# (monitor work areas in, one (x, y, width, height) rect per window out) and applied
+# by a window backend in a single batch; verification re-reads the rects afterwards.
+# Nothing here touches the window system directly, so it runs anywhere.
+
+import math
+import time
+
+
+def grid_shape(count):
+    """Columns and rows for `count` windows: as square as possible, filled row by row."""
+    cols = math.ceil(math.sqrt(count))
+    rows = math.ceil(count / cols)
+    return cols, rows
+
+
+def grid_cells(count, area):
+    """`count` equal cells tiling a work area (left, top, width, height), row-major."""
+    if count <= 0:
+        return []
+    left, top, width, height = area
+    cols, rows = grid_shape(count)
+    cell_width, cell_height = width // cols, height // rows
+    return [(left + (i % cols) * cell_width, top + (i // cols) * cell_height, cell_width, cell_height)
+            for i in range(count)]
+
+
+def split_counts(count, areas):
+    """Splits `count` windows across work areas in proportion to their pixel area (largest remainder)."""
+    sizes = [width * height for _, _, width, height in areas]
+    total = sum(sizes)
+    if not total:
+        return [count] + [0] * (len(areas) - 1)
+    shares = [count * size / total for size in sizes]
+    counts = [int(share) for share in shares]
+    by_remainder = sorted(range(len(areas)), key=lambda i: shares[i] - counts[i], reverse=True)
+    for i in by_remainder[:count - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+
+def select_monitors(monitors, target="all"):
+    """
+    Work areas to lay out on, left to right. monitors are dicts with "work" (left, top, width, height)
+    and "primary"; target is "all", "primary" or a monitor index.
+    """
+    if target == "primary":
+        chosen = [m for m in monitors if m.get("primary")] or monitors[:1]
+    elif target == "all":
+        chosen = monitors
+    else:
+        chosen = [monitors[int(target)]]
+    return sorted((m["work"] for m in chosen), key=lambda work: (work[0], work[1]))
+
+
+def compute_layout(count, monitors, target="all"):
+    """One rect per window: the first windows fill the leftmost monitor's grid, the rest the next monitor's."""
+    areas = select_monitors(monitors, target)
+    rects = []
+    for area, n in zip(areas, split_counts(count, areas)):
+        rects.extend(grid_cells(n, area))
+    return rects
+
+
+def verify_layout(backend, placements, tolerance=8, timeout=1.0, interval=0.05):
+    """
+    Re-reads window rects until they match the placements or timeout passes (windows apply
+    moves asynchronously). Returns {"ok": [hwnd], "mismatched": {hwnd: (expected, actual)}, "gone": [hwnd]}.
+    """
+    deadline = time.perf_counter() + timeout
+    while True:
+        ok, mismatched, gone = [], {}, []
+        for hwnd, expected in placements:
+            actual = backend.get_rect(hwnd)
+            if actual is None:
+                gone.append(hwnd)
+            elif all(abs(a - e) <= tolerance for a, e in zip(actual, expected)):
+                ok.append(hwnd)
+            else:
+                mismatched[hwnd] = (expected, actual)
+        if not mismatched or time.perf_counter() >= deadline:
+            return {"ok": ok, "mismatched": mismatched, "gone": gone}
+        time.sleep(interval)